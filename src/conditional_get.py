@@ -0,0 +1,77 @@
+import functools
+import hashlib
+from datetime import timezone
+
+from flask import current_app, make_response, request
+from sqlalchemy import select
+
+from main import db
+from serializer import wants_ndjson
+from models.server import Server
+
+# Version of one server and when it last changed, from its primary key
+# Channel and member changes bump the server, so this covers the server and member responses
+def server_version(server_id):
+    row = db.session.execute(
+        select(Server.version, Server.updated_at)
+        .where(Server.server_id == server_id, Server.deleted_at.is_(None))
+    ).first()
+    if row is None:
+        return None
+    return (row.version,), row.updated_at
+
+# Version of a server's channel list, also from its primary key
+# Message changes bump their channel, which bumps channels_version of the server rather than its version
+def channels_version(server_id):
+    row = db.session.execute(
+        select(Server.version, Server.updated_at, Server.channels_version, Server.channels_updated_at)
+        .where(Server.server_id == server_id, Server.deleted_at.is_(None))
+    ).first()
+    if row is None:
+        return None
+    updated = [value for value in (row.updated_at, row.channels_updated_at) if value is not None]
+    return (row.version, row.channels_version), max(updated, default=None)
+
+# Strong ETag for the current representation, query string included since ?fields= changes the body
+# and the negotiated format since Accept picks JSON or NDJSON
+def _etag(versions):
+    representation = (f"{request.endpoint}|{sorted(request.view_args.items())}|{request.query_string.decode()}|"
+                      f"{'ndjson' if wants_ndjson() else 'json'}")
+    digest = hashlib.sha1(representation.encode("utf-8")).hexdigest()[:16]
+    return "-".join(str(version) for version in versions) + "-" + digest
+
+# If-None-Match takes precedence, If-Modified-Since is only used without it
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified <= request.if_modified_since
+    return False
+
+# Answer conditional GETs from a version lookup, before the resource is loaded or dumped
+# version(id) returns (versions, updated_at) or None when the resource does not exist
+# Goes below the authorisation decorators so a 304 never skips their checks
+def conditional(version, id_arg):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            state = version(kwargs[id_arg])
+            if state is None:
+                return fn(*args, **kwargs)
+            versions, updated_at = state
+            etag = _etag(versions)
+            last_modified = updated_at.replace(tzinfo=timezone.utc) if updated_at else None
+            if _not_modified(etag, last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(fn(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if last_modified:
+                response.last_modified = last_modified
+            # Clients may keep the response but must revalidate it every time
+            response.headers["Cache-Control"] = "private, no-cache"
+            return response
+        return wrapper
+    return decorator
@@ -5,7 +5,8 @@ from flask_jwt_extended import create_access_token
 from sqlalchemy.exc import IntegrityError
 from psycopg2 import errorcodes
 
-from main import db, bcrypt
+from main import db
+from password_hasher import password_hasher
 from models.user import User, UserSchema, user_schema
 
 auth_bp = Blueprint("auth", __name__, url_prefix="/auth")
@@ -27,7 +28,7 @@ def register_user():
         password = body_data.get("password")
         # If password exists, hash password
         if password:
-            user.password = bcrypt.generate_password_hash(password).decode("utf-8")
+            user.password = password_hasher.hash_password(password)
         # Add and commit to database
         db.session.add(user)
         db.session.commit()
@@ -52,10 +53,14 @@ def login_user():
     # Get data from body of request
     body_data = request.get_json()
     # Fetch user in database
-    stmt = db.select(User).filter_by(email=body_data.get("email"))
+    stmt = db.select(User).filter_by(email=body_data.get("email"), deleted_at=None)
     user = db.session.scalar(stmt)
     # Check if user exists and password is correct
-    if user and bcrypt.check_password_hash(user.password, body_data.get("password")):
+    if user and password_hasher.check_password(user.password, body_data.get("password")):
+        # If password was hashed with an older work factor, upgrade stored hash
+        if password_hasher.needs_rehash(user.password):
+            user.password = password_hasher.hash_password(body_data.get("password"))
+            db.session.commit()
         # Create JWT token
         token = create_access_token(identity=str(user.user_id), expires_delta=timedelta(days=1))
         # Return response
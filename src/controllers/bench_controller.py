@@ -0,0 +1,412 @@
+import itertools
+import json
+import math
+import os
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+
+import click
+from flask import Blueprint, current_app
+from flask_jwt_extended import create_access_token
+from sqlalchemy import event
+
+from main import db, create_app
+from group_commit import group_committer
+from serializer import dump_many, json_response
+from models.user import User
+from models.server import Server
+from models.server_member import ServerMember
+from models.channel import Channel, channels_schema
+from models.message import Message, messages_schema
+from synthetic_data import seed_synthetic, SYNTHETIC_PASSWORD
+
+bench_commands = Blueprint("bench", __name__)
+
+# Dataset sizes the benchmark can seed, passed straight to seed_synthetic
+DATASET_SIZES = {
+    "small": {"users": 200, "servers": 20, "channels": 60, "messages": 5000},
+    "medium": {"users": 2000, "servers": 100, "channels": 400, "messages": 100000},
+    "large": {"users": 20000, "servers": 500, "channels": 2000, "messages": 1000000}
+}
+
+_unique = itertools.count()
+
+# A route to benchmark, setup runs untimed before every call and returns path values and body
+class Scenario:
+    def __init__(self, name, method, path, body=None, setup=None):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.setup = setup
+
+    def prepare(self, fixture):
+        values = dict(fixture)
+        if self.setup:
+            values.update(self.setup(fixture))
+        body = self.body(values) if callable(self.body) else self.body
+        return self.path.format(**values), body, values["token"]
+
+# Untimed helpers that create fresh rows for routes which consume them
+def _new_user(fixture):
+    number = next(_unique)
+    user = User(username=f"bench_{fixture['run']}_{number}", email=f"bench_{fixture['run']}_{number}@example.com",
+                password=fixture["password_hash"], name="bench user", status="online")
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+def _setup_new_user_token(fixture):
+    user = _new_user(fixture)
+    return {"token": create_access_token(identity=str(user.user_id))}
+
+def _setup_new_user_id(fixture):
+    return {"new_user_id": _new_user(fixture).user_id}
+
+def _setup_new_server(fixture):
+    server = Server(server_name="bench server", created_on=date.today(), creator_user_id=fixture["admin_id"])
+    db.session.add(server)
+    db.session.commit()
+    db.session.add(ServerMember(joined_on=date.today(), is_admin=True, server_id=server.server_id,
+                                user_id=fixture["admin_id"]))
+    db.session.commit()
+    return {"new_server_id": server.server_id}
+
+def _setup_new_member(fixture):
+    user = _new_user(fixture)
+    member = ServerMember(joined_on=date.today(), server_id=fixture["server_id"], user_id=user.user_id)
+    db.session.add(member)
+    db.session.commit()
+    return {"new_member_id": member.member_id}
+
+def _setup_new_channel(fixture):
+    channel = Channel(channel_name="bench channel", created_on=date.today(),
+                      creator_user_id=fixture["admin_id"], server_id=fixture["server_id"])
+    db.session.add(channel)
+    db.session.commit()
+    return {"new_channel_id": channel.channel_id}
+
+def _setup_new_message(fixture):
+    message = Message(content="bench message",
+                      channel_id=fixture["channel_id"], sender_user_id=fixture["admin_id"])
+    db.session.add(message)
+    db.session.commit()
+    return {"new_message_id": message.message_id}
+
+# Every route of every blueprint, run as the admin of the biggest server unless setup says otherwise
+SCENARIOS = [
+    Scenario("auth.register", "POST", "/auth/register",
+             body=lambda values: {"username": f"bench_reg_{values['run']}_{next(_unique)}",
+                                  "email": f"bench_reg_{values['run']}_{next(_unique)}@example.com",
+                                  "password": SYNTHETIC_PASSWORD, "name": "bench", "status": "online"}),
+    Scenario("auth.login", "POST", "/auth/login",
+             body=lambda values: {"email": values["admin_email"], "password": SYNTHETIC_PASSWORD}),
+    Scenario("user.update_account", "PATCH", "/user/updateaccount", body={"status": "away"}),
+    Scenario("user.delete_user", "DELETE", "/user/deleteaccount", setup=_setup_new_user_token),
+    Scenario("server.view_all_servers", "GET", "/server/all/user/{admin_id}"),
+    Scenario("server.view_one_server", "GET", "/server/{server_id}"),
+    Scenario("server.create_server", "POST", "/server/create", body={"server_name": "bench server"}),
+    Scenario("server.update_server", "PATCH", "/server/update/{server_id}", body={"server_name": "bench server renamed"}),
+    Scenario("server.delete_server", "DELETE", "/server/delete/{new_server_id}", setup=_setup_new_server),
+    Scenario("member.view_all_members", "GET", "/server/{server_id}/member/all"),
+    Scenario("member.view_one_member", "GET", "/server/{server_id}/member/{member_id}"),
+    Scenario("member.join_server", "POST", "/server/{server_id}/member/join", setup=_setup_new_user_token),
+    Scenario("member.add_member", "POST", "/server/{server_id}/member/add/{new_user_id}", setup=_setup_new_user_id),
+    Scenario("member.update_member", "PATCH", "/server/{server_id}/member/update/{member_id}", body={"is_admin": False}),
+    Scenario("member.delete_member", "DELETE", "/server/{server_id}/member/delete/{new_member_id}",
+             setup=_setup_new_member),
+    Scenario("channel.view_all_channels", "GET", "/server/{server_id}/channel/all"),
+    Scenario("channel.view_one_channel", "GET", "/server/{server_id}/channel/{channel_id}"),
+    Scenario("channel.create_channel", "POST", "/server/{server_id}/channel/create", body={"channel_name": "bench channel"}),
+    Scenario("channel.update_channel", "PATCH", "/server/{server_id}/channel/update/{channel_id}",
+             body={"channel_name": "bench channel renamed"}),
+    Scenario("channel.delete_channel", "DELETE", "/server/{server_id}/channel/delete/{new_channel_id}",
+             setup=_setup_new_channel),
+    Scenario("message_user.view_all_direct_messages", "GET", "/user/message/all"),
+    Scenario("message_user.send_direct_message", "POST", "/user/message/send/{member_user_id}",
+             body={"content": "bench direct message"}),
+    Scenario("message_user.search_direct_messages", "GET", "/user/message/search?q=hello"),
+    Scenario("message_channel.view_all_channel_messages", "GET", "/channel/{channel_id}/message/all"),
+    Scenario("message_channel.search_channel_messages", "GET", "/channel/{channel_id}/message/search?q=hello"),
+    Scenario("message_server.search_server_messages", "GET", "/server/{server_id}/message/search?q=hello"),
+    Scenario("message_channel.view_one_channel_message", "GET", "/channel/{channel_id}/message/{message_id}"),
+    Scenario("message_channel.add_channel_message", "POST", "/channel/{channel_id}/message/post",
+             body={"title": "bench", "content": "bench channel message"}),
+    Scenario("message_channel.add_channel_messages", "POST", "/channel/{channel_id}/message/bulk",
+             body=[{"title": "bench", "content": f"bench bulk message {index}"} for index in range(50)]),
+    Scenario("message.update_message", "PATCH", "/message/update/{message_id}", body={"content": "bench edited"}),
+    Scenario("message.delete_message", "DELETE", "/message/delete/{new_message_id}", setup=_setup_new_message)
+]
+
+# Pick the biggest server, its admin, a regular member, a busy channel and a message to drive routes with
+def _load_fixture():
+    server = Server.query.order_by(Server.server_id).first()
+    admin = User.query.get(server.creator_user_id)
+    member = ServerMember.query.filter(ServerMember.server_id == server.server_id,
+                                       ServerMember.user_id != admin.user_id).first()
+    channel = Channel.query.filter_by(server_id=server.server_id).order_by(Channel.channel_id).first()
+    message = Message(content="bench message",
+                      channel_id=channel.channel_id, sender_user_id=admin.user_id)
+    db.session.add(message)
+    db.session.commit()
+    fixture = {
+        "run": f"{os.getpid()}_{int(time.time())}",
+        "password_hash": admin.password,
+        "token": create_access_token(identity=str(admin.user_id)),
+        "admin_id": admin.user_id,
+        "admin_email": admin.email,
+        "server_id": server.server_id,
+        "member_id": member.member_id,
+        "member_user_id": member.user_id,
+        "channel_id": channel.channel_id,
+        "message_id": message.message_id
+    }
+    # Release the session so setup reads do not hold locks during requests
+    db.session.commit()
+    return fixture
+
+def _percentile(sorted_values, fraction):
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+# Call one route repeatedly and summarise latency, throughput, statement count and peak memory
+# Setup runs in its own app context, requests must not share it or they would share g and the session
+def _run_scenario(app, client, scenario, fixture, iterations, statements):
+    latencies = []
+    query_counts = []
+    for _ in range(iterations):
+        with app.app_context():
+            path, body, token = scenario.prepare(fixture)
+        statements[0] = 0
+        start = time.perf_counter()
+        response = client.open(path, method=scenario.method, json=body,
+                               headers={"Authorization": f"Bearer {token}"})
+        latencies.append(time.perf_counter() - start)
+        query_counts.append(statements[0])
+        if response.status_code >= 400:
+            raise click.ClickException(f"{scenario.name} failed with status {response.status_code}")
+
+    # Peak memory is measured on a separate call so tracing does not skew latency
+    with app.app_context():
+        path, body, token = scenario.prepare(fixture)
+    tracemalloc.start()
+    client.open(path, method=scenario.method, json=body, headers={"Authorization": f"Bearer {token}"})
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "p50_ms": round(_percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(_percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 3),
+        "throughput_rps": round(len(latencies) / sum(latencies), 1),
+        "queries": max(query_counts),
+        "peak_memory_kb": round(peak_memory / 1024, 1)
+    }
+
+# Create an app on a freshly seeded database of the given size
+def _seeded_app(database_url, size):
+    # The benchmark is the only process using its database, so it can make ids as worker 0
+    app = create_app({"SQLALCHEMY_DATABASE_URI": database_url, "TESTING": True, "SNOWFLAKE_WORKER_ID": 0})
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed_synthetic(seed=size, **DATASET_SIZES[size])
+        fixture = _load_fixture()
+    return app, fixture
+
+# Seed a fresh database of the given size and benchmark every scenario against it
+def _run_size(database_url, size, iterations, only):
+    app, fixture = _seeded_app(database_url, size)
+    with app.app_context():
+        engine = db.engine
+
+    statements = [0]
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements[0] += 1
+    event.listen(engine, "before_cursor_execute", count_statement)
+
+    results = {}
+    try:
+        client = app.test_client()
+        for scenario in SCENARIOS:
+            if only and not any(scenario.name.startswith(prefix) for prefix in only):
+                continue
+            result = _run_scenario(app, client, scenario, fixture, iterations, statements)
+            results[scenario.name] = result
+            print(f"{size:<7} {scenario.name:<45} p50 {result['p50_ms']:>9} ms  "
+                  f"p95 {result['p95_ms']:>9} ms  queries {result['queries']:>3}")
+    finally:
+        event.remove(engine, "before_cursor_execute", count_statement)
+    return results
+
+# Compare results with a baseline, returning a description of every regression
+def _find_regressions(results, baseline, threshold):
+    regressions = []
+    for size, routes in results.items():
+        for name, result in routes.items():
+            base = baseline.get(size, {}).get(name)
+            if not base:
+                continue
+            if result["p95_ms"] > base["p95_ms"] * (1 + threshold):
+                regressions.append(f"{size} {name}: p95 {result['p95_ms']} ms > baseline {base['p95_ms']} ms")
+            if result["queries"] > base["queries"]:
+                regressions.append(f"{size} {name}: {result['queries']} queries > baseline {base['queries']}")
+            if result["peak_memory_kb"] > base["peak_memory_kb"] * (1 + threshold):
+                regressions.append(f"{size} {name}: peak memory {result['peak_memory_kb']} kB "
+                                   f"> baseline {base['peak_memory_kb']} kB")
+    return regressions
+
+# Run route benchmarks against a seeded local database
+# In terminal: python3 -m flask bench run --sizes small,medium --baseline bench_baseline.json
+# Record a new baseline: python3 -m flask bench run --sizes small,medium --save
+@bench_commands.cli.command("run")
+@click.option("--database-url", default=lambda: os.environ.get("BENCHMARK_DATABASE_URL", "sqlite:///benchmark.db"),
+              help="Database to seed and benchmark, it is dropped and recreated for every size")
+@click.option("--sizes", default="small", show_default=True, help="Comma separated dataset sizes (small, medium, large)")
+@click.option("--iterations", type=click.IntRange(min=1), default=50, show_default=True, help="Calls per route")
+@click.option("--only", default="", help="Comma separated route name prefixes to run, e.g. server.,message")
+@click.option("--baseline", "baseline_path", default="bench_baseline.json", show_default=True,
+              help="JSON baseline to compare against or save to")
+@click.option("--threshold", type=float, default=0.25, show_default=True, help="Allowed slowdown before failing, 0.25 = 25%")
+@click.option("--save", is_flag=True, help="Write results to the baseline file instead of comparing")
+def run_benchmarks(database_url, sizes, iterations, only, baseline_path, threshold, save):
+    if database_url == os.environ.get("DATABASE_URL"):
+        raise click.ClickException("benchmark database must not be the application database")
+    size_names = [size.strip() for size in sizes.split(",") if size.strip()]
+    unknown = [size for size in size_names if size not in DATASET_SIZES]
+    if unknown:
+        raise click.ClickException(f"unknown dataset size {', '.join(unknown)}")
+    only = [prefix.strip() for prefix in only.split(",") if prefix.strip()]
+
+    results = {size: _run_size(database_url, size, iterations, only) for size in size_names}
+
+    if save:
+        with open(baseline_path, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f"baseline saved to {baseline_path}")
+        return
+    if not os.path.exists(baseline_path):
+        print(f"no baseline at {baseline_path}, run with --save to record one")
+        return
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = _find_regressions(results, baseline, threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        raise SystemExit(1)
+    print("no regressions against baseline")
+
+# Post messages from many threads at once and summarise latency and throughput
+def _concurrent_posts(app, fixture, threads, posts):
+    local = threading.local()
+    path = f"/channel/{fixture['channel_id']}/message/post"
+    headers = {"Authorization": f"Bearer {fixture['token']}"}
+
+    def post(index):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        start = time.perf_counter()
+        response = local.client.post(path, json={"title": "bench", "content": f"group commit {index}"}, headers=headers)
+        if response.status_code != 201:
+            raise click.ClickException(f"post failed with status {response.status_code}")
+        return time.perf_counter() - start
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        latencies = sorted(executor.map(post, range(posts)))
+    elapsed = time.perf_counter() - started
+    return {
+        "throughput_rps": round(posts / elapsed, 1),
+        "p50_ms": round(_percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(_percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 3)
+    }
+
+# Compare message posting with group commit off and on
+# In terminal: python3 -m flask bench group-commit --threads 32 --posts 2000
+# Use a Postgres database, sqlite serialises writers and hides the difference
+@bench_commands.cli.command("group-commit")
+@click.option("--database-url", default=lambda: os.environ.get("BENCHMARK_DATABASE_URL", "sqlite:///benchmark.db"),
+              help="Database to seed and benchmark, it is dropped and recreated")
+@click.option("--size", default="small", show_default=True, type=click.Choice(list(DATASET_SIZES)))
+@click.option("--threads", type=click.IntRange(min=1), default=32, show_default=True, help="Concurrent posters")
+@click.option("--posts", type=click.IntRange(min=1), default=2000, show_default=True, help="Posts per mode")
+@click.option("--window-ms", type=float, default=None, help="Group commit window, defaults to GROUP_COMMIT_WINDOW_MS")
+def compare_group_commit(database_url, size, threads, posts, window_ms):
+    if database_url == os.environ.get("DATABASE_URL"):
+        raise click.ClickException("benchmark database must not be the application database")
+    app, fixture = _seeded_app(database_url, size)
+    if window_ms is not None:
+        group_committer.window = window_ms / 1000
+    results = {}
+    for enabled in (False, True):
+        group_committer.enabled = enabled
+        mode = "on" if enabled else "off"
+        results[mode] = _concurrent_posts(app, fixture, threads, posts)
+        print(f"group commit {mode:<3} {results[mode]['throughput_rps']:>9} req/s  p50 {results[mode]['p50_ms']:>9} ms  "
+              f"p95 {results[mode]['p95_ms']:>9} ms  p99 {results[mode]['p99_ms']:>9} ms")
+    print(json.dumps(results, indent=2))
+
+# Unsaved rows shaped like real list responses, including unicode, quotes and missing relationships
+def _serializer_rows(rows):
+    users = [User(user_id=number, username=f"user{number}", name=f"Usér \"{number}\"", status="online")
+             for number in range(1, 51)]
+    servers = [Server(server_id=number, server_name=f"server {number}") for number in range(1, 11)]
+    channels = [Channel(channel_id=number, channel_name=f"channel {number}", created_on=date(2024, 1, number % 28 + 1),
+                        user=users[number % len(users)], server=servers[number % len(servers)])
+                for number in range(1, 101)]
+    messages = []
+    for number in range(1, rows + 1):
+        direct = number % 10 == 0
+        messages.append(Message(message_id=number, title=f"title {number}" if number % 3 else None,
+                                content=f"message {number} ✓ <b>&</b>\n",
+                                timestamp=datetime(2024, 1, 1, number % 24, number % 60, number % 60),
+                                channel=None if direct else channels[number % len(channels)],
+                                sender_user=users[number % len(users)],
+                                receiver_user=users[(number + 1) % len(users)] if direct else None))
+    return messages, channels
+
+# Time one way of producing a response body, returning the body and the best of iterations
+def _time_body(build, iterations):
+    best = math.inf
+    for _ in range(iterations):
+        start = time.perf_counter()
+        body = build()
+        best = min(best, time.perf_counter() - start)
+    return body, best
+
+# Check the compiled serializer matches schema dumps byte for byte and compare their speed
+# In terminal: python3 -m flask bench serializer --rows 10000
+@bench_commands.cli.command("serializer")
+@click.option("--rows", type=click.IntRange(min=1), default=10000, show_default=True, help="Messages per list dump")
+@click.option("--iterations", type=click.IntRange(min=1), default=5, show_default=True)
+def compare_serializer(rows, iterations):
+    app = current_app
+    messages, channels = _serializer_rows(rows)
+    cases = {
+        "messages": (messages_schema, messages, lambda data: {"messages": data, "before": "cursor", "after": None}),
+        "channels": (channels_schema, channels, lambda data: data)
+    }
+    results = {}
+    with app.test_request_context():
+        for name, (schema, objs, envelope) in cases.items():
+            schema_body, schema_seconds = _time_body(
+                lambda: app.json.response(envelope(schema.dump(objs))).get_data(), iterations)
+            compiled_body, compiled_seconds = _time_body(
+                lambda: json_response(envelope(dump_many(schema, objs))).get_data(), iterations)
+            if compiled_body != schema_body:
+                raise click.ClickException(f"{name}: compiled output differs from schema dump")
+            results[name] = {
+                "rows": len(objs),
+                "schema_ms": round(schema_seconds * 1000, 3),
+                "compiled_ms": round(compiled_seconds * 1000, 3),
+                "speedup": round(schema_seconds / compiled_seconds, 2)
+            }
+            print(f"{name:<10} identical output  schema {results[name]['schema_ms']:>9} ms  "
+                  f"compiled {results[name]['compiled_ms']:>9} ms  x{results[name]['speedup']}")
+    print(json.dumps(results, indent=2))
@@ -6,43 +6,61 @@ from sqlalchemy.exc import IntegrityError
 from psycopg2 import errorcodes
 
 from main import db
-from utils import current_member, auth_as_admin, channel_exist
-from models.server import Server
+from eager_loading import eager_load
+from sparse_fields import select_fields
+from conditional_get import conditional, channels_version
+from response_cache import response_cache
+from serializer import dump_many, json_response, stream_response, varies_by_accept, wants_stream
+from utils import auth_context, current_member, auth_as_admin, channel_exist
 from models.channel import Channel, channel_schema, channels_schema
 
 channel_bp = Blueprint("channel", __name__, url_prefix="/<int:server_id>/channel")
 
-# View all channels - GET - route: /server/<int:server_id>/channel/all
+# View all channels - GET - route: /server/<int:server_id>/channel/all?fields=<names>&expand=<names>&stream=1
 @channel_bp.route("/all")
 @jwt_required()
+@varies_by_accept
 @current_member("server_id")
+@conditional(channels_version, "server_id")
+@response_cache.cached("server", "server_id")
 def view_all_channels(server_id):
-    # Fetch server from database
-    server = Server.query.get(server_id)
-    # If server does not exist
-    if not server:
-        # Return response
-        return {"error": f"server with id {server_id} not found"}, 404
+    # Get server checked by decorator
+    server = auth_context().server
+    stream = wants_stream()
+    # Get schema narrowed by ?fields= and ?expand=
+    # Streamed channels leave out their messages unless ?expand=messages asks for them, so memory stays flat
+    schema, options = select_fields(channels_schema, Channel, opt_in=("messages",) if stream else ())
+    query = Channel.query.options(*options).filter_by(server_id=server_id)
+    # Stream channels as they are read when asked to with ?stream=1 or Accept: application/x-ndjson
+    if stream:
+        response = stream_response(schema, query)
+        # If channels exist
+        if response is not None:
+            # Return response
+            return response
     # Fetch channels from database
-    channels = Channel.query.filter_by(server_id=server_id).all()
+    channels = query.all()
     # If no channel exists
     if not channels:
         # Return response
         return {"message": f"no channels created in server {server.server_name} yet"}, 200
     else:
         # Return response if successful
-        return channels_schema.dump(channels)
+        return json_response(dump_many(schema, channels))
     
-# View one channel - GET - route: /server/<int:server_id>/channel/<int:channel_id>
+# View one channel - GET - route: /server/<int:server_id>/channel/<int:channel_id>?fields=<names>&expand=<names>
 @channel_bp.route("/<int:channel_id>")
 @jwt_required()
 @channel_exist("server_id", "channel_id")
 @current_member("server_id")
+@response_cache.cached("server", "server_id")
 def view_one_channel(server_id, channel_id):
-    # Fetch channel from database
-    channel = Channel.query.filter_by(server_id=server_id, channel_id=channel_id).first()
-    # Return response 
-    return channel_schema.dump(channel)
+    # Get schema narrowed by ?fields= and ?expand=
+    schema, options = select_fields(channel_schema, Channel)
+    # Fetch channel with requested messages from database
+    channel = Channel.query.options(*options).filter_by(channel_id=channel_id).first()
+    # Return response
+    return schema.dump(channel)
     
 # Add channel - POST - route: /server/<int:server_id>/channel/create
 @channel_bp.route("/create", methods=["POST"])
@@ -63,6 +81,9 @@ def create_channel(server_id):
         # Add and commit to database
         db.session.add(new_channel)
         db.session.commit()
+        # Fetch channel again with its creator, server and messages loaded for the response
+        new_channel = (Channel.query.options(*eager_load(channel_schema, Channel))
+                       .filter_by(channel_id=new_channel.channel_id).one())
         # Return response
         return channel_schema.dump(new_channel), 201
     except IntegrityError as err:
@@ -78,12 +99,14 @@ def create_channel(server_id):
 def update_channel(server_id, channel_id):
     # Get data from body of request
     body_data = channel_schema.load(request.get_json())
-    # Fetch channel from database
-    channel = Channel.query.get(channel_id)
+    # Get channel checked by decorator
+    channel = auth_context().channel
     # Update fields
     channel.channel_name = body_data.get("channel_name") or channel.channel_name
     # Commit to database
     db.session.commit()
+    # Fetch channel again with its creator, server and messages loaded for the response
+    channel = Channel.query.options(*eager_load(channel_schema, Channel)).filter_by(channel_id=channel_id).one()
     # Return response
     return channel_schema.dump(channel)
 
@@ -94,10 +117,11 @@ def update_channel(server_id, channel_id):
 @current_member("server_id")
 @auth_as_admin("server_id")
 def delete_channel(server_id, channel_id):
-    # Fetch channel from database
-    channel = Channel.query.get(channel_id)
+    # Get channel checked by decorator
+    context = auth_context()
+    channel = context.channel
     # Delete and commit to database
     db.session.delete(channel)
     db.session.commit()
     # Return response
-    return {"message": f"channel {channel.channel_name} has been deleted from server {channel.server.server_name}"}
\ No newline at end of file
+    return {"message": f"channel {channel.channel_name} has been deleted from server {context.server.server_name}"}
\ No newline at end of file
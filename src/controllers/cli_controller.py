@@ -1,6 +1,6 @@
-import datetime
 from datetime import date
 
+import click
 from flask import Blueprint
 
 from main import db, bcrypt
@@ -9,16 +9,69 @@ from models.server import Server
 from models.server_member import ServerMember
 from models.channel import Channel
 from models.message import Message
+from snowflake import MAX_WORKER_ID
+from synthetic_data import seed_synthetic
+from read_markers import add_missing_markers, reconcile_all_markers
+from counters import reconcile_all
+from deletions import deleter
+from exports import export_server, import_server
+from partitions import archive_expired, ensure_partitions, plan_archive
+from migrations import (MIGRATIONS, MigrationError, applied_versions, index_report, stamp, time_ordered_message_ids,
+                        upgrade)
 
 db_commands = Blueprint("db", __name__)
 
 # Create tables in database
 # In terminal: python3 -m flask db create
+# Tables are built from the current models, so every migration is recorded as applied
 @db_commands.cli.command("create")
 def create_table():
     db.create_all()
+    stamp(db.engine)
+    ensure_partitions(db.engine)
     print("tables created")
 
+# Apply schema migrations the database has not had yet
+# In terminal: python3 -m flask db upgrade
+# Indexes are built without blocking writes, so this can run while the app is up
+@db_commands.cli.command("upgrade")
+def upgrade_schema():
+    try:
+        applied = upgrade(db.engine)
+    except MigrationError as err:
+        raise click.ClickException(str(err))
+    for name in applied:
+        print(f"applied: {name}")
+    print("database is up to date" if not applied else f"{len(applied)} migrations applied")
+
+# List schema migrations and whether they have been applied
+# In terminal: python3 -m flask db migrations
+@db_commands.cli.command("migrations")
+def list_migrations():
+    done = applied_versions(db.engine)
+    for version, name, _ in sorted(MIGRATIONS):
+        print(f"{version:4} {'applied' if version in done else 'pending'}  {name}")
+
+# Report indexes the controllers' queries need but the database lacks, and indexes never used
+# In terminal: python3 -m flask db index-report
+@db_commands.cli.command("index-report")
+def report_indexes():
+    missing, unused = index_report(db.engine)
+    if missing:
+        print("missing indexes (run python3 -m flask db upgrade):")
+        for table, columns, used_by in missing:
+            print(f"  {table} ({', '.join(columns)}) - {used_by}")
+    else:
+        print("no missing indexes")
+    if db.engine.dialect.name != "postgresql":
+        print("index usage is only tracked on postgres")
+    elif unused:
+        print("indexes with no scans since statistics were last reset:")
+        for index_name, table, scans, size in unused:
+            print(f"  {index_name} on {table}, {size}")
+    else:
+        print("no unused indexes")
+
 # Drop tables in database
 # In terminal: python3 -m flask db drop
 @db_commands.cli.command("drop")
@@ -26,10 +79,127 @@ def drop_table():
     db.drop_all()
     print("tables dropped")
 
+# Move existing messages to time ordered ids made from their timestamps
+# In terminal: python3 -m flask db migrate-message-ids
+# flask db upgrade does this as migration 4, this runs it again with another batch size
+# Run it with the app stopped, the whole move is one transaction
+@db_commands.cli.command("migrate-message-ids")
+@click.option("--batch-size", type=click.IntRange(min=1), default=10000, show_default=True, help="Rows per update batch")
+def migrate_message_ids(batch_size):
+    moved = time_ordered_message_ids(db.engine, batch_size)
+    print(f"{moved} messages moved to time ordered ids")
+
+# Add read markers for existing memberships and direct message conversations
+# In terminal: python3 -m flask db create-read-markers
+# Everything already posted counts as read, only users without a marker get one
+@db_commands.cli.command("create-read-markers")
+def create_read_markers():
+    channel_count, direct_count = add_missing_markers(db.session.connection())
+    db.session.commit()
+    print(f"{channel_count} channel and {direct_count} direct message read markers created")
+
+# Recount member_count, message_count and last_message_at from the rows they count
+# In terminal: python3 -m flask db reconcile-counters
+# Safe to run while the app is up, each batch is its own short transaction
+@db_commands.cli.command("reconcile-counters")
+@click.option("--batch-size", type=click.IntRange(min=1), default=1000, show_default=True, help="Servers or channels per batch")
+def reconcile_counters(batch_size):
+    servers_fixed, channels_fixed = reconcile_all(db.session, batch_size)
+    print(f"counters fixed on {servers_fixed} servers and {channels_fixed} channels")
+
+# Recount unread_count of every read marker from the messages after it
+# In terminal: python3 -m flask db reconcile-read-markers
+# Safe to run while the app is up, each batch is its own short transaction
+@db_commands.cli.command("reconcile-read-markers")
+@click.option("--batch-size", type=click.IntRange(min=1), default=1000, show_default=True, help="Markers per batch")
+def reconcile_read_markers(batch_size):
+    fixed = reconcile_all_markers(db.session, batch_size)
+    print(f"unread counts fixed on {fixed} read markers")
+
+# Run queued server and user deletions in this process until none are left
+# In terminal: python3 -m flask db run-deletions
+# Workers run them too, this is for catching up after a restart or retrying failed ones
+@db_commands.cli.command("run-deletions")
+@click.option("--retry-failed", is_flag=True, help="Run failed deletions again")
+def run_deletions(retry_failed):
+    completed = 0
+    while True:
+        job_id = deleter.claim(db.engine, retry_failed=retry_failed)
+        if job_id is None:
+            break
+        if deleter.run(db.engine, job_id):
+            completed += 1
+            print(f"deletion job {job_id} done")
+        else:
+            print(f"deletion job {job_id} failed")
+            break
+    print(f"{completed} deletion jobs completed")
+
+# Archive messages past their server's retention to gzipped NDJSON files and remove them
+# In terminal: python3 -m flask db archive-messages
+# Run it daily, it also makes next months' partitions. Partitions that have fully expired are dropped whole
+@db_commands.cli.command("archive-messages")
+@click.option("--default-retention-days", type=click.IntRange(min=1), envvar="MESSAGE_RETENTION_DAYS",
+              help="Days to keep direct messages and messages of servers without their own retention")
+@click.option("--archive-dir", envvar="MESSAGE_ARCHIVE_DIR", default="archive", show_default=True,
+              type=click.Path(file_okay=False), help="Directory archive files are written to")
+@click.option("--dry-run", is_flag=True, help="Only show what would be archived")
+def archive_messages(default_retention_days, archive_dir, dry_run):
+    if dry_run:
+        for name, expired, kept in plan_archive(db.engine, default_retention_days):
+            print(f"{name}: {expired} messages to archive, {kept} kept")
+        return
+    archived = archive_expired(db.engine, default_retention_days, archive_dir)
+    for result in archived:
+        print(f"{result.name}: {result.rows} messages archived to {result.path}"
+              f"{', partition dropped' if result.dropped else ''}")
+    print(f"{sum(result.rows for result in archived)} messages archived")
+
+# Write a server with its members, channels and messages to a gzipped NDJSON file
+# In terminal: python3 -m flask db export 1 server-1.ndjson.gz
+# Rows are streamed from one consistent snapshot, so this can run while the app is up
+@db_commands.cli.command("export")
+@click.argument("server_id", type=int)
+@click.argument("path", type=click.Path(dir_okay=False))
+def export_server_file(server_id, path):
+    try:
+        counts = export_server(db.engine, server_id, path)
+    except LookupError as err:
+        raise click.ClickException(str(err))
+    print(", ".join(f"{count} {kind}s" for kind, count in counts.items()) + f" exported to {path}")
+
+# Load a file written by export as a new server, with new ids for everything in it
+# In terminal: python3 -m flask db import server-1.ndjson.gz
+# Users are matched by email. The server only shows up once everything is loaded
+@db_commands.cli.command("import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--batch-size", type=click.IntRange(min=1), default=10000, show_default=True, help="Records per insert batch")
+@click.option("--worker-id", type=click.IntRange(0, MAX_WORKER_ID), default=MAX_WORKER_ID, show_default=True,
+              help="Worker id new message ids are made with, keep it apart from SNOWFLAKE_WORKER_ID of running apps")
+def import_server_file(path, batch_size, worker_id):
+    try:
+        server_id, counts = import_server(db.engine, path, batch_size, worker_id)
+    except ValueError as err:
+        raise click.ClickException(str(err))
+    print(", ".join(f"{count} {kind}s" for kind, count in counts.items() if kind != "user")
+          + f" imported as server {server_id}, {counts['user']} new users")
+
 # Seed tables in database
-# In terminal: python3 -m flask db drop
+# In terminal: python3 -m flask db seed
+# For a generated dataset: python3 -m flask db seed --users 100000 --servers 2000 --channels 10000 --messages 5000000 --seed 1
 @db_commands.cli.command("seed")
-def seed_table():
+@click.option("--users", type=click.IntRange(min=2), help="Generate this many synthetic users")
+@click.option("--servers", type=click.IntRange(min=1), default=100, show_default=True, help="Synthetic servers")
+@click.option("--channels", type=click.IntRange(min=1), default=500, show_default=True, help="Synthetic channels")
+@click.option("--messages", type=click.IntRange(min=0), default=100000, show_default=True, help="Synthetic messages")
+@click.option("--seed", "random_seed", type=int, help="Random seed for a reproducible dataset")
+@click.option("--batch-size", type=click.IntRange(min=1), default=10000, show_default=True, help="Rows per insert batch")
+def seed_table(users, servers, channels, messages, random_seed, batch_size):
+    # Generate synthetic dataset when a number of users is given
+    if users:
+        seed_synthetic(users, servers, channels, messages, seed=random_seed, batch_size=batch_size)
+        return
+
     users = [
         User(
             username = "user1",
@@ -128,14 +298,12 @@ def seed_table():
     messages = [
         Message(
             content = "message 1",
-            timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             sender_user = users[0],
             receiver_user = users[1]
         ),
         Message(
             title = "message title 1",
             content = "message 2",
-            timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             channel = channels[0],
             sender_user = users[1]
         )
@@ -0,0 +1,20 @@
+from flask import Blueprint
+from flask_jwt_extended import jwt_required, get_jwt_identity
+
+from main import db
+from models.deletion_job import DeletionJob, deletion_job_schema
+
+deletion_bp = Blueprint("deletion", __name__, url_prefix="/deletion")
+
+# View deletion progress - GET - route: /deletion/<int:job_id>
+@deletion_bp.route("/<int:job_id>")
+@jwt_required()
+def view_deletion(job_id):
+    # Fetch deletion job from database
+    job = db.session.get(DeletionJob, job_id)
+    # If job does not exist or was started by another user
+    if not job or str(job.requested_by_user_id) != get_jwt_identity():
+        # Return response
+        return {"error": f"deletion job with id {job_id} not found"}, 404
+    # Return response
+    return deletion_job_schema.dump(job)
@@ -1,47 +1,111 @@
-import datetime
+import json
 
-from flask import Blueprint, request
+from flask import Blueprint, Response, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from sqlalchemy import and_, insert
 from sqlalchemy.exc import IntegrityError
 from psycopg2 import errorcodes
 
 from main import db
-from utils import current_member_check, message_exist, channel_message_exist
-from models.user import User
-from models.message import Message, message_schema, messages_schema
+from eager_loading import eager_load
+from utils import active_user, auth_context, current_member, current_member_check, message_exist, channel_message_exist
+from pagination import page_args, paginate_messages
+from message_events import message_events
+from group_commit import group_committer
+from versioning import bump_session_versions
+import counters
+import read_markers
+from read_markers import mark_read
+from serializer import dump_many, json_response
+from search import search_text, search_channel, search_server, search_direct
+from models.message import Message, MessageSchema, message_schema, messages_schema
+from models.read_marker import ReadMarker, read_marker_schema, read_markers_schema
 
 message_bp = Blueprint("message", __name__, url_prefix="/message")
 message_user_bp = Blueprint("message_user", __name__, url_prefix="/user/message")
 message_channel_bp = Blueprint("message_channel", __name__, url_prefix="/channel/<int:channel_id>/message")
+message_server_bp = Blueprint("message_server", __name__, url_prefix="/server/<int:server_id>/message")
 
-# View all direct messages received - GET - route: /user/message/all
+# Seconds between keep-alive comments on an idle stream
+STREAM_KEEPALIVE = 15
+
+# Most messages and request bytes accepted by one bulk post
+MAX_BULK_MESSAGES = 500
+MAX_BULK_BYTES = 1024 * 1024
+
+# View all direct messages received - GET - route: /user/message/all?before=<cursor>&after=<cursor>&limit=<n>
 @message_user_bp.route("/all")
 @jwt_required()
 def view_all_direct_messages():
-    # Fetch messages from database
-    messages = Message.query.filter_by(receiver_user_id=get_jwt_identity()).order_by(Message.timestamp.desc()).all()
+    # Get cursor and page size from query string
+    before, after, limit = page_args()
+    # Fetch one page of messages from database
+    query = Message.query.options(*eager_load(messages_schema, Message)).filter_by(receiver_user_id=get_jwt_identity())
+    messages, older_cursor, newer_cursor = paginate_messages(query, before, after, limit)
     # If no messages exist
-    if not messages:
+    if not messages and not (before or after):
         # Return response
         return {"message": "no messages sent to user yet"}, 200
     else:
         # Return response if messages exist
-        return messages_schema.dump(messages)
+        return json_response({
+            "messages": dump_many(messages_schema, messages),
+            "before": older_cursor,
+            "after": newer_cursor
+        })
 
-# View all channel messages - GET - route: /channel/<int:channel_id>/message/all
+# View all channel messages - GET - route: /channel/<int:channel_id>/message/all?before=<cursor>&after=<cursor>&limit=<n>
 @message_channel_bp.route("/all")
 @jwt_required()
 @current_member_check("channel_id")
 def view_all_channel_messages(channel_id):
-    # Fetch messages from database
-    messages = Message.query.filter_by(channel_id=channel_id).order_by(Message.timestamp.desc()).all()
+    # Get cursor and page size from query string
+    before, after, limit = page_args()
+    # Fetch one page of messages from database
+    query = Message.query.options(*eager_load(messages_schema, Message)).filter_by(channel_id=channel_id)
+    messages, older_cursor, newer_cursor = paginate_messages(query, before, after, limit)
     # If no messages exist
-    if not messages:
+    if not messages and not (before or after):
+        # Get channel checked by decorator
+        channel = auth_context().channel
         # Return response
-        return {"message": f"no messages posted to {messages.channel.channel_name} yet"}, 200
+        return {"message": f"no messages posted to {channel.channel_name} yet"}, 200
     else:
         # Return response if messages exist
-        return messages_schema.dump(messages)
+        return json_response({
+            "messages": dump_many(messages_schema, messages),
+            "before": older_cursor,
+            "after": newer_cursor
+        })
+
+# Search direct messages - GET - route: /user/message/search?q=<text>&before=<cursor>&limit=<n>
+@message_user_bp.route("/search")
+@jwt_required()
+def search_direct_messages():
+    # Fetch one page of matching messages sent or received by user, best match first
+    messages, next_cursor = search_direct(search_text(), get_jwt_identity())
+    # Return response
+    return json_response({"messages": dump_many(messages_schema, messages), "before": next_cursor})
+
+# Search channel messages - GET - route: /channel/<int:channel_id>/message/search?q=<text>&before=<cursor>&limit=<n>
+@message_channel_bp.route("/search")
+@jwt_required()
+@current_member_check("channel_id")
+def search_channel_messages(channel_id):
+    # Fetch one page of matching messages, best match first
+    messages, next_cursor = search_channel(search_text(), channel_id, get_jwt_identity())
+    # Return response
+    return json_response({"messages": dump_many(messages_schema, messages), "before": next_cursor})
+
+# Search server messages - GET - route: /server/<int:server_id>/message/search?q=<text>&before=<cursor>&limit=<n>
+@message_server_bp.route("/search")
+@jwt_required()
+@current_member("server_id")
+def search_server_messages(server_id):
+    # Fetch one page of matching messages from every channel in server, best match first
+    messages, next_cursor = search_server(search_text(), server_id, get_jwt_identity())
+    # Return response
+    return json_response({"messages": dump_many(messages_schema, messages), "before": next_cursor})
 
 # View one channel messages - GET - route: /channel/<int:channel_id>/message/<int:message_id>
 @message_channel_bp.route("/<int:message_id>")
@@ -49,11 +113,107 @@ def view_all_channel_messages(channel_id):
 @current_member_check("channel_id")
 @channel_message_exist("channel_id", "message_id")
 def view_one_channel_message(channel_id, message_id):
-    # Fetch message from database
-    message = Message.query.filter_by(channel_id=channel_id, message_id=message_id).first()
+    # Get message checked by decorator
+    message = auth_context().message
     # Return response
     return message_schema.dump(message)
 
+# View unread counts - GET - route: /user/message/unread
+# Counts come from the read markers, one row per channel and direct message sender
+@message_user_bp.route("/unread")
+@jwt_required()
+def view_unread_counts():
+    # Fetch all read markers of user from database
+    markers = (ReadMarker.query.options(*eager_load(read_markers_schema, ReadMarker))
+               .filter_by(user_id=get_jwt_identity()).order_by(ReadMarker.marker_id).all())
+    # Return response
+    return {
+        "unread": read_markers_schema.dump(markers),
+        "total_unread_count": sum(marker.unread_count for marker in markers)
+    }
+
+# Get message_id to read up to from body of request, None to read everything
+def _read_up_to():
+    body_data = request.get_json(silent=True) or {}
+    message_id = body_data.get("message_id")
+    # Ids are sent as strings in responses, so take them back either way
+    if isinstance(message_id, str) and message_id.isdigit():
+        message_id = int(message_id)
+    if message_id is not None and (isinstance(message_id, bool) or not isinstance(message_id, int) or message_id < 0):
+        return None, ({"error": "message_id must be a non-negative integer or a string of digits"}, 400)
+    return message_id, None
+
+# Get read marker of user, added to session if user has none yet
+def _read_marker(**filter_by):
+    marker = ReadMarker.query.filter_by(**filter_by).first()
+    if marker is None:
+        marker = ReadMarker(**filter_by)
+        db.session.add(marker)
+    return marker
+
+# Mark channel messages read - POST - route: /channel/<int:channel_id>/message/read
+# Body may give {"message_id": <id>} to read up to, otherwise all messages are read
+@message_channel_bp.route("/read", methods=["POST"])
+@jwt_required()
+@current_member_check("channel_id")
+def read_channel_messages(channel_id):
+    # Get message to read up to from body of request
+    up_to, error = _read_up_to()
+    if error:
+        return error
+    # Move marker forward and commit to database
+    marker = _read_marker(user_id=int(get_jwt_identity()), channel_id=channel_id)
+    marker = mark_read(marker, Message.channel_id == channel_id, up_to)
+    # Return response
+    return read_marker_schema.dump(marker)
+
+# Format one server-sent event
+def _sse(event_id, event_type, data):
+    return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+# Yield missed events, then live events, until the client goes away or falls too far behind
+def _stream_events(subscription, channel_id, last_seq):
+    try:
+        yield "retry: 3000\n\n"
+        sent = last_seq or 0
+        if last_seq is not None:
+            missed = message_events.replay(channel_id, last_seq)
+            # If events were missed beyond the kept history, client needs to reload /message/all
+            if missed is None:
+                yield _sse(sent, "reset", {"channel_id": channel_id})
+                missed = []
+            for event in missed:
+                sent = event.seq
+                yield _sse(event.seq, f"message.{event.kind}", event.data)
+        while not subscription.overflowed:
+            event = subscription.get(timeout=STREAM_KEEPALIVE)
+            if event is None:
+                yield ": keep-alive\n\n"
+            elif event.seq > sent:
+                sent = event.seq
+                yield _sse(event.seq, f"message.{event.kind}", event.data)
+        yield _sse(sent, "reset", {"channel_id": channel_id})
+    finally:
+        subscription.close()
+
+# Stream channel messages - GET - route: /channel/<int:channel_id>/message/stream
+# Server-sent events, EventSource clients can pass their token as ?jwt=<token>
+@message_channel_bp.route("/stream")
+@jwt_required(locations=["headers", "query_string"])
+@current_member_check("channel_id")
+def stream_channel_messages(channel_id):
+    # Get last event seen by reconnecting client
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    try:
+        last_seq = int(last_event_id) if last_event_id else None
+    except ValueError:
+        return {"error": f"invalid last event id {last_event_id}"}, 400
+    # Subscribe before replaying so no event falls between the two
+    subscription = message_events.subscribe(channel_id)
+    # Return response
+    return Response(_stream_events(subscription, channel_id, last_seq), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 # Send direct message - POST - route: /user/message/send/<int:user_id>
 @message_user_bp.route("/send/<int:user_id>", methods=["POST"])
 @jwt_required()
@@ -62,7 +222,7 @@ def send_direct_message(user_id):
         # Get data from body of request
         body_data = message_schema.load(request.get_json())
         # Fetch user from database
-        user = User.query.get(user_id)
+        user = active_user(user_id)
         # If user does not exist
         if not user:
             # Return response
@@ -71,19 +231,41 @@ def send_direct_message(user_id):
             # Create instance of Message model
             new_message = Message(
                 content = body_data.get("content"),
-                timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                 sender_user_id = get_jwt_identity(),
                 receiver_user_id = user_id
             )
         # Add and commit to database
-        db.session.add(new_message)
-        db.session.commit()
+        new_message = group_committer.save(new_message)
         # Return response
         return message_schema.dump(new_message), 201
     except IntegrityError as err:
         if err.orig.pgcode == errorcodes.NOT_NULL_VIOLATION:
             return {"error": f"{err.orig.diag.column_name} is required"}, 409
 
+# Mark direct messages read - POST - route: /user/message/read/<int:user_id>
+# Body may give {"message_id": <id>} to read up to, otherwise all messages from user are read
+@message_user_bp.route("/read/<int:user_id>", methods=["POST"])
+@jwt_required()
+def read_direct_messages(user_id):
+    # Get message to read up to from body of request
+    up_to, error = _read_up_to()
+    if error:
+        return error
+    # Fetch user from database
+    user = active_user(user_id)
+    # If user does not exist
+    if not user:
+        # Return response
+        return {"error": f"user with id {user_id} not found"}, 404
+    # Move marker forward and commit to database
+    receiver_user_id = int(get_jwt_identity())
+    marker = _read_marker(user_id=receiver_user_id, peer_user_id=user_id)
+    scope = and_(Message.receiver_user_id == receiver_user_id, Message.sender_user_id == user_id,
+                 Message.channel_id.is_(None))
+    marker = mark_read(marker, scope, up_to)
+    # Return response
+    return read_marker_schema.dump(marker)
+
 # Post channel message - POST - route: /channel/<int:channel_id>/message/post
 @message_channel_bp.route("/post", methods=["POST"])
 @jwt_required()
@@ -96,19 +278,81 @@ def add_channel_message(channel_id):
         new_message = Message(
             title = body_data.get("title"),
             content = body_data.get("content"),
-            timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             channel_id = channel_id,
             sender_user_id = get_jwt_identity()
         )
         # Add and commit to database
-        db.session.add(new_message)
-        db.session.commit()
+        new_message = group_committer.save(new_message)
+        # Push new message to channel streams
+        message_data = message_schema.dump(new_message)
+        message_events.publish(channel_id, "created", message_data)
         # Return response
-        return message_schema.dump(new_message), 201
+        return message_data, 201
     except IntegrityError as err:
         if err.orig.pgcode == errorcodes.NOT_NULL_VIOLATION:
             return {"error": f"{err.orig.diag.column_name} is required"}, 409
 
+# Post many channel messages - POST - route: /channel/<int:channel_id>/message/bulk
+# Body is a json array of messages, all valid ones are inserted in one transaction
+@message_channel_bp.route("/bulk", methods=["POST"])
+@jwt_required()
+@current_member_check("channel_id")
+def add_channel_messages(channel_id):
+    # If body length is not given, it could not be checked before reading
+    if request.content_length is None:
+        # Return response
+        return {"error": "Content-Length header is required"}, 411
+    # If body is too large
+    if request.content_length > MAX_BULK_BYTES:
+        # Return response
+        return {"error": f"request body must be at most {MAX_BULK_BYTES} bytes"}, 413
+    # Get data from body of request
+    items = request.get_json()
+    # If body is not a list of messages
+    if not isinstance(items, list) or not items or len(items) > MAX_BULK_MESSAGES:
+        # Return response
+        return {"error": f"body must be an array of 1 to {MAX_BULK_MESSAGES} messages"}, 400
+    # Validate every message, errors are keyed by position in array
+    bulk_schema = MessageSchema(many=True)
+    errors = bulk_schema.validate(items)
+    for index, item in enumerate(items):
+        if index not in errors and not (isinstance(item, dict) and item.get("content")):
+            errors[index] = {"content": ["Missing data for required field."]}
+    valid_indexes = [index for index in range(len(items)) if index not in errors]
+    loaded = bulk_schema.load([items[index] for index in valid_indexes])
+    # Insert valid messages with one statement and commit once
+    rows = [
+        {
+            "title": body_data.get("title"),
+            "content": body_data.get("content"),
+            "channel_id": channel_id,
+            "sender_user_id": get_jwt_identity()
+        }
+        for body_data in loaded
+    ]
+    new_messages = []
+    if rows:
+        new_messages = db.session.scalars(insert(Message).returning(Message, sort_by_parameter_order=True), rows).all()
+        # Bulk insert skips the flush events, so bump channel version, unread counts and counters here
+        bump_session_versions(db.session, channel_ids=[channel_id])
+        posts = [(message.message_id, channel_id, message.sender_user_id, None) for message in new_messages]
+        read_markers.record_posts(db.session.connection(), posts)
+        counters.record_posts(db.session.connection(), posts)
+        db.session.commit()
+    # Push new messages to channel streams
+    created = dict(zip(valid_indexes, messages_schema.dump(new_messages)))
+    for message_data in created.values():
+        message_events.publish(channel_id, "created", message_data)
+    # Build result for every item in request order
+    results = []
+    for index in range(len(items)):
+        if index in created:
+            results.append({"index": index, "status": 201, "message": created[index]})
+        else:
+            results.append({"index": index, "status": 400, "error": errors[index]})
+    # Return response, 207 if only some messages were posted
+    return {"results": results}, 201 if not errors else 207
+
 # Update message - PUT, PATCH - route: /message/update/<int:message_id>
 @message_bp.route("/update/<int:message_id>", methods=["PUT", "PATCH"])
 @jwt_required()
@@ -116,19 +360,21 @@ def add_channel_message(channel_id):
 def update_message(message_id):
     # Get data from body of request
     body_data = message_schema.load(request.get_json())
-    # Fetch message from database
-    message = Message.query.get(message_id)
+    # Get message checked by decorator
+    message = auth_context().message
     # Update message fields
     message.content = body_data.get("content") or message.content
-    message.timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    # If channel message
-    if message.channel != None:
+    # If channel message, direct messages have no channel and no stream
+    if message.channel_id is not None:
         # Update message fields
         message.title = body_data.get("title") or message.title
         # Commit to database
         db.session.commit()
+        # Push edited message to channel streams
+        message_data = message_schema.dump(message)
+        message_events.publish(message.channel_id, "updated", message_data)
         # Return response
-        return message_schema.dump(message)
+        return message_data
     else:
         # Commit to database
         db.session.commit()
@@ -140,11 +386,15 @@ def update_message(message_id):
 @jwt_required()
 @message_exist("message_id")
 def delete_message(message_id):
-    # Fetch message from database
-    message = Message.query.get(message_id)
+    # Get message checked by decorator
+    message = auth_context().message
+    channel_id = message.channel_id
     # Delete and commit to database
     db.session.delete(message)
     db.session.commit()
+    # If channel message, push deletion to channel streams
+    if channel_id is not None:
+        message_events.publish(channel_id, "deleted", {"message_id": str(message_id)})
     # Return response
     return {"message": f"message with id {message_id} has been deleted"}
 
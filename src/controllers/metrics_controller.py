@@ -0,0 +1,73 @@
+from flask import Blueprint, Response
+from sqlalchemy import text
+
+from main import db
+from db_pool import pool_metrics
+from group_commit import group_committer
+from instrumentation import endpoint_metrics
+from membership_cache import membership_cache
+from password_hasher import password_hasher
+from response_cache import response_cache
+
+metrics_bp = Blueprint("metrics", __name__, url_prefix="/metrics")
+health_bp = Blueprint("health", __name__, url_prefix="/health")
+
+# View all metrics in Prometheus text format - GET - route: /metrics
+@metrics_bp.route("")
+def view_metrics():
+    lines = [endpoint_metrics.render(), pool_metrics.render()]
+    # Add cache and password hashing counters
+    for name, value in membership_cache.stats().items():
+        lines.append(f"membership_cache_{name} {value}\n")
+    for name, value in response_cache.stats().items():
+        lines.append(f"response_cache_{name} {int(value)}\n")
+    hasher_stats = password_hasher.stats()
+    for name in ("queue_depth", "queue_limit", "rejected", "hash_count", "hash_seconds_total"):
+        lines.append(f"password_hasher_{name} {hasher_stats[name]}\n")
+    # Return response
+    return Response("".join(lines), mimetype="text/plain; version=0.0.4")
+
+# View connection pool counters - GET - route: /metrics/db-pool
+@metrics_bp.route("/db-pool")
+def view_db_pool_metrics():
+    # Return response
+    return pool_metrics.stats()
+
+# View membership cache counters - GET - route: /metrics/membership-cache
+@metrics_bp.route("/membership-cache")
+def view_membership_cache_metrics():
+    # Return response
+    return membership_cache.stats()
+
+# View response cache counters - GET - route: /metrics/response-cache
+@metrics_bp.route("/response-cache")
+def view_response_cache_metrics():
+    # Return response
+    return response_cache.stats()
+
+# View password hashing queue and latency - GET - route: /metrics/password-hasher
+@metrics_bp.route("/password-hasher")
+def view_password_hasher_metrics():
+    # Return response
+    return password_hasher.stats()
+
+# View group commit batching - GET - route: /metrics/group-commit
+@metrics_bp.route("/group-commit")
+def view_group_commit_metrics():
+    # Return response
+    return group_committer.stats()
+
+# Check database is reachable - GET - route: /health
+# Returns 503 when no connection can be checked out or the database does not answer
+@health_bp.route("")
+def view_health():
+    try:
+        db.session.execute(text("SELECT 1"))
+        database = "ok"
+    except Exception as err:
+        database = f"error: {type(err).__name__}"
+    finally:
+        db.session.rollback()
+    status = 200 if database == "ok" else 503
+    # Return response
+    return {"status": "ok" if status == 200 else "unavailable", "database": database, "pool": pool_metrics.stats()}, status
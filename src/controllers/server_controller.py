@@ -6,9 +6,16 @@ from sqlalchemy.exc import IntegrityError
 from psycopg2 import errorcodes
 
 from main import db
-from models.user import User
+from eager_loading import eager_load
+from sparse_fields import select_fields
+from conditional_get import conditional, server_version
+from response_cache import response_cache
+from serializer import stream_response, varies_by_accept, wants_stream
+from deletions import deleter
+from utils import active_server, active_user
 from models.server import Server, server_schema, servers_schema
 from models.server_member import ServerMember
+from models.deletion_job import deletion_job_schema
 from controllers.server_member_controller import member_bp
 from controllers.channel_controller import channel_bp
 
@@ -16,37 +23,53 @@ server_bp = Blueprint("server", __name__, url_prefix="/server")
 server_bp.register_blueprint(member_bp)
 server_bp.register_blueprint(channel_bp)
 
-# View all servers - GET - route: /server/all/user/<int:user_id>
+# View all servers - GET - route: /server/all/user/<int:user_id>?fields=<names>&expand=<names>&stream=1
 @server_bp.route("/all/user/<int:user_id>")
 @jwt_required()
+@varies_by_accept
+@response_cache.cached("user", "user_id")
 def view_all_servers(user_id):
     # Fetch user from database
-    user = User.query.get(user_id)
+    user = active_user(user_id)
     # If user does not exist
     if not user:
         # Return response
         return {"error": f"user with id {user_id} not found"}, 404
+    # Get schema narrowed by ?fields= and ?expand=
+    schema, options = select_fields(servers_schema, Server)
+    query = Server.query.options(*options).filter_by(creator_user_id=user_id, deleted_at=None)
+    # Stream servers as they are read when asked to with ?stream=1 or Accept: application/x-ndjson
+    if wants_stream():
+        response = stream_response(schema, query)
+        # If servers exist
+        if response is not None:
+            # Return response
+            return response
     # Fetch servers from database
-    servers = Server.query.filter_by(creator_user_id=user_id).all()
+    servers = query.all()
     # If no servers exist
     if not servers:
         # Return response
         return {"message": f"no servers created by {user.username}"}, 200
     else:
         # Return response if servers exist
-        return servers_schema.dump(servers)
+        return schema.dump(servers)
 
-# View one server - GET - route: /server/<int:server_id>
+# View one server - GET - route: /server/<int:server_id>?fields=<names>&expand=<names>
 @server_bp.route("/<int:server_id>")
 @jwt_required()
+@conditional(server_version, "server_id")
+@response_cache.cached("server", "server_id")
 def view_one_server(server_id):
-    # Fetch server from database
-    server = Server.query.get(server_id)
+    # Get schema narrowed by ?fields= and ?expand=
+    schema, options = select_fields(server_schema, Server)
+    # Fetch server with requested members and channels from database
+    server = Server.query.options(*options).filter_by(server_id=server_id, deleted_at=None).first()
     # If server does not exist
     if not server:
         # Return response
         return {"error": f"server with id {server_id} not found"}, 404
-    return server_schema.dump(server)
+    return schema.dump(server)
 
 # Add server - POST - route: /server/create
 @server_bp.route("/create", methods=["POST"])
@@ -58,6 +81,7 @@ def create_server():
         # Create instance of Server model
         new_server = Server(
             server_name = body_data.get("server_name"),
+            message_retention_days = body_data.get("message_retention_days"),
             created_on = date.today(),
             creator_user_id = get_jwt_identity()
         )
@@ -75,6 +99,9 @@ def create_server():
         # Add and commit to database
         db.session.add(new_member)
         db.session.commit()
+        # Fetch server again with its creator, members and channels loaded for the response
+        new_server = (Server.query.options(*eager_load(server_schema, Server))
+                      .filter_by(server_id=new_server.server_id).one())
         # Return response
         return server_schema.dump(new_server), 201
     except IntegrityError as err:
@@ -88,7 +115,7 @@ def update_server(server_id):
     # Get data from body of request
     body_data = server_schema.load(request.get_json())
     # Fetch server from database
-    server = Server.query.get(server_id)
+    server = active_server(server_id)
     # If server does not exist
     if not server:
         # Return response
@@ -101,8 +128,13 @@ def update_server(server_id):
             return {"error": "user not authorised to perform this action"}, 403
         # Update server fields
         server.server_name = body_data.get("server_name") or server.server_name
+        # Retention can be cleared with null to fall back to the default
+        if "message_retention_days" in body_data:
+            server.message_retention_days = body_data["message_retention_days"]
         # Commit to database
         db.session.commit()
+        # Fetch server again with its creator, members and channels loaded for the response
+        server = Server.query.options(*eager_load(server_schema, Server)).filter_by(server_id=server_id).one()
         # Return response
         return server_schema.dump(server)
 
@@ -111,7 +143,7 @@ def update_server(server_id):
 @jwt_required()
 def delete_server(server_id):
     # Fetch server from database
-    server = Server.query.get(server_id)
+    server = active_server(server_id)
     # If server does not exist
     if not server:
         return {"error": f"server with id {server_id} not found"}, 404
@@ -121,8 +153,13 @@ def delete_server(server_id):
         if str(server.creator_user_id) != get_jwt_identity():
             # Return response
             return {"error": "user not authorised to perform action"}, 403
-        # Delete and commit to database
-        db.session.delete(server)
-        db.session.commit()
-        # Return response
-        return {"message": f"server {server.server_name} has been deleted"}
\ No newline at end of file
+        # Hide server and delete it with its members, channels and messages
+        # Cached memberships are left to expire, routes treat a hidden server as not found
+        server_name = server.server_name
+        job = deleter.delete_server(server, int(get_jwt_identity()))
+        # If server was small enough to delete during the request
+        if job.status == "done":
+            # Return response
+            return {"message": f"server {server_name} has been deleted"}
+        # Return response, deletion carries on in the background
+        return {"message": f"server {server_name} is being deleted", "job": deletion_job_schema.dump(job)}, 202
\ No newline at end of file
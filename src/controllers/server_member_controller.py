@@ -2,49 +2,70 @@ from datetime import date
 
 from flask import Blueprint, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from sqlalchemy.exc import IntegrityError
+from psycopg2 import errorcodes
 
 from main import db
-from utils import current_member, auth_as_admin, member_exist
-from models.server import Server
-from models.user import User
+from sparse_fields import select_fields
+from conditional_get import conditional, server_version
+from response_cache import response_cache
+from serializer import stream_response, varies_by_accept, wants_stream
+from membership_cache import membership_cache
+from utils import active_server, active_user, auth_context, current_member, auth_as_admin, member_exist
 from models.server_member import ServerMember, server_member_schema, server_members_schema
 
 member_bp = Blueprint("member", __name__, url_prefix="/<int:server_id>/member")
 
-# View all members - GET - route: /server/<int:server_id>/member/all
+# View all members - GET - route: /server/<int:server_id>/member/all?fields=<names>&expand=<names>&stream=1
 @member_bp.route("/all")
 @jwt_required()
+@varies_by_accept
 @current_member("server_id")
+@conditional(server_version, "server_id")
+@response_cache.cached("server", "server_id")
 def view_all_members(server_id):
+    # Get schema narrowed by ?fields= and ?expand=
+    schema, options = select_fields(server_members_schema, ServerMember)
+    query = ServerMember.query.options(*options).filter_by(server_id=server_id)
+    # Stream members as they are read when asked to with ?stream=1 or Accept: application/x-ndjson
+    if wants_stream():
+        response = stream_response(schema, query)
+        # If members exist
+        if response is not None:
+            # Return response
+            return response
     # Fetch server members from database
-    server_members = ServerMember.query.filter_by(server_id=server_id).all()
+    server_members = query.all()
     # Return response
-    return server_members_schema.dump(server_members)
+    return schema.dump(server_members)
 
-# View one member - GET - route: /server/<int:server_id>/member/<int:member_id>
+# View one member - GET - route: /server/<int:server_id>/member/<int:member_id>?fields=<names>&expand=<names>
 @member_bp.route("/<int:member_id>")
 @jwt_required()
 @current_member("server_id")
 @member_exist("server_id", "member_id")
+@response_cache.cached("server", "server_id")
 def view_one_member(server_id, member_id):
-    # Fetch server member from database
-    server_member = ServerMember.query.filter_by(server_id=server_id, member_id=member_id).first()
+    # Get server member checked by decorator
+    server_member = auth_context().target_member
+    # Get schema narrowed by ?fields= and ?expand=, unrequested relationships are never loaded
+    schema, _ = select_fields(server_member_schema, ServerMember)
     # Return response
-    return server_member_schema.dump(server_member)
+    return schema.dump(server_member)
 
 # Join as member - POST - route: /server/<int:server_id>/member/join
 @member_bp.route("/join", methods=["POST"])
 @jwt_required()
 def join_server(server_id):
     # Fetch server from database
-    server = Server.query.get(server_id)
+    server = active_server(server_id)
     # If server does not exist
     if not server:
         # Return response
         return {"error": f"server with id {server_id} not found"}, 404
     # If server exists
     else:
-        existing_member = ServerMember.query.filter_by(server=server, user_id=get_jwt_identity()).first(), 201
+        existing_member = ServerMember.query.filter_by(server=server, user_id=get_jwt_identity()).first()
         # If user is already a member
         if existing_member:
             # Return response if user already a server member
@@ -57,7 +78,16 @@ def join_server(server_id):
         )
         # Add and commit to database
         db.session.add(new_member)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError as err:
+            db.session.rollback()
+            # If user joined at the same time from another request
+            if err.orig.pgcode == errorcodes.UNIQUE_VIOLATION:
+                return {"error": f"user is already a member of server {server.server_name}"}, 400
+            raise
+        # Clear cached membership of user
+        membership_cache.invalidate(get_jwt_identity(), server_id)
         # Return response
         return server_member_schema.dump(new_member), 201
 
@@ -68,14 +98,14 @@ def join_server(server_id):
 @auth_as_admin("server_id")
 def add_member(server_id, user_id):
     # Fetch user from database
-    user = User.query.get(user_id)
-    # Fetch server from database
-    server = Server.query.get(server_id)
+    user = active_user(user_id)
+    # Get server checked by decorator
+    server = auth_context().server
     # If user does not exist
     if not user:
         # Return response
         return {"error": f"user with id {user_id} not found"}, 404
-    existing_member = ServerMember.query.filter_by(server=server, user_id=user_id).first(), 201
+    existing_member = ServerMember.query.filter_by(server=server, user_id=user_id).first()
     # If user is already a member
     if existing_member:
         # Return response
@@ -89,7 +119,16 @@ def add_member(server_id, user_id):
         )
         # Add and commit to database
         db.session.add(new_member)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError as err:
+            db.session.rollback()
+            # If user was added at the same time by another request
+            if err.orig.pgcode == errorcodes.UNIQUE_VIOLATION:
+                return {"error": f"user {user.username} is already a member of server {server.server_name}"}, 400
+            raise
+        # Clear cached membership of user
+        membership_cache.invalidate(user_id, server_id)
         # Return response
         return server_member_schema.dump(new_member), 201
 
@@ -102,17 +141,21 @@ def add_member(server_id, user_id):
 def update_member(server_id, member_id):
     # Get data from body of request
     body_data = request.get_json()
-    # Fetch server member from database
-    server_member = ServerMember.query.get(member_id)
+    # Get server and server member checked by decorator
+    context = auth_context()
+    server_member = context.target_member
     # If server member is server creator
-    if server_member.user_id == server_member.server.creator_user_id:
+    if server_member.user_id == context.server.creator_user_id:
         # Return response
         return {"error": f"user {server_member.user.username} cannot be updated or deleted"}, 400
     else:
         # Update server member fields
         server_member.is_admin = body_data.get("is_admin") or server_member.is_admin
+        member_user_id = server_member.user_id
         # Commit to database
         db.session.commit()
+        # Clear cached membership of user
+        membership_cache.invalidate(member_user_id, server_id)
         # Return response
         return server_member_schema.dump(server_member)
 
@@ -123,15 +166,19 @@ def update_member(server_id, member_id):
 @current_member("server_id")
 @auth_as_admin("server_id")
 def delete_member(server_id, member_id):
-    # Fetch server member from database
-    server_member = ServerMember.query.filter_by(member_id=member_id).first()
+    # Get server and server member checked by decorator
+    context = auth_context()
+    server_member = context.target_member
     # If server member is server creator
-    if server_member.user_id == server_member.server.creator_user_id:
+    if server_member.user_id == context.server.creator_user_id:
         # Return response
         return {"error": f"user {server_member.user.username} cannot be updated or deleted"}, 400
     else:
         # Delete and commit to database
+        member_user_id = server_member.user_id
         db.session.delete(server_member)
         db.session.commit()
+        # Clear cached membership of user
+        membership_cache.invalidate(member_user_id, server_id)
         # Return response
-        return {"message": f"member has been deleted from server {server_member.server.server_name}"}
\ No newline at end of file
+        return {"message": f"member has been deleted from server {context.server.server_name}"}
\ No newline at end of file
@@ -3,12 +3,17 @@ from flask_jwt_extended import get_jwt_identity, jwt_required
 from sqlalchemy.exc import IntegrityError
 from psycopg2 import errorcodes
 
-from main import db, bcrypt
+from main import db
+from password_hasher import password_hasher
+from sparse_fields import select_fields
+from utils import active_user
+from deletions import deleter
 from models.user import User, UserSchema, user_schema
+from models.deletion_job import deletion_job_schema
 
 user_bp = Blueprint("user", __name__, url_prefix="/user")
 
-# Update account - PUT, PATCH - route: /user/updateaccount
+# Update account - PUT, PATCH - route: /user/updateaccount?fields=<names>&expand=<names>
 @user_bp.route("/updateaccount", methods=["PUT", "PATCH"])
 @jwt_required()
 def update_account():
@@ -16,8 +21,10 @@ def update_account():
         # Get data from body of request
         body_data = UserSchema().load(request.get_json(), partial=True)
         password = body_data.get("password")
+        # Get schema narrowed by ?fields= and ?expand= and the loader options for it
+        schema, options = select_fields(user_schema, User)
         # Fetch user from database
-        user = User.query.get(get_jwt_identity())
+        user = active_user(get_jwt_identity())
         # If user exists, update fields
         if user:
             user.name = body_data.get("name") or user.name
@@ -25,11 +32,13 @@ def update_account():
             user.status = body_data.get("status") or user.status
             # If password exists, hash password
             if password:
-                user.password = bcrypt.generate_password_hash(password).decode("utf-8")
+                user.password = password_hasher.hash_password(password)
             # Commit to database
             db.session.commit()
+            # Fetch user again with only the requested fields and relationships loaded
+            user = User.query.options(*options).filter_by(user_id=user.user_id).one()
             # Return response
-            return user_schema.dump(user)
+            return schema.dump(user)
         else:
             # Return response if user does not exist
             return {"error": "user not found"}, 404
@@ -49,13 +58,18 @@ def update_account():
 @jwt_required()
 def delete_user():
     # Fetch user from database
-    user = User.query.get(get_jwt_identity())
-    # If user exist, delete and commit to database
+    user = active_user(get_jwt_identity())
+    # If user exist, hide and delete with everything they created
     if user:
-        db.session.delete(user)
-        db.session.commit()
-        # Return response
-        return {"message": f"user {user.username} has been deleted"}
+        username = user.username
+        # Cached memberships are cleared as each membership is removed
+        job = deleter.delete_user(user)
+        # If user was small enough to delete during the request
+        if job.status == "done":
+            # Return response
+            return {"message": f"user {username} has been deleted"}
+        # Return response, deletion carries on in the background
+        return {"message": f"user {username} is being deleted", "job": deletion_job_schema.dump(job)}, 202
     else:
         # Return response if user does not exist
         return {"error": "user not found"}, 404
\ No newline at end of file
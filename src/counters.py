@@ -0,0 +1,154 @@
+from collections import Counter
+
+from sqlalchemy import case, event, func, or_, select, update
+from sqlalchemy.orm import Session
+
+from snowflake import id_time
+from models.server import Server
+from models.server_member import ServerMember
+from models.channel import Channel
+from models.message import Message
+
+servers = Server.__table__
+channels = Channel.__table__
+members = ServerMember.__table__
+messages = Message.__table__
+
+# Newest remaining message time of the channel being updated
+def _latest_message_at(channel_id_column):
+    return (select(messages.c.timestamp).where(messages.c.channel_id == channel_id_column)
+            .order_by(messages.c.message_id.desc()).limit(1).scalar_subquery())
+
+# Add members to member_count, changes is a Counter of server_id to members added (negative when removed)
+def record_members(connection, changes):
+    for server_id, count in sorted(changes.items()):
+        if count:
+            connection.execute(update(servers).where(servers.c.server_id == server_id)
+                               .values(member_count=servers.c.member_count + count))
+
+# Add new messages to their channel's message_count and last_message_at
+# messages are (message_id, channel_id, sender_user_id, receiver_user_id) as for read_markers.record_posts
+def record_posts(connection, posts):
+    counts, latest = Counter(), {}
+    for message_id, channel_id, _, _ in posts:
+        if channel_id is not None:
+            counts[channel_id] += 1
+            latest[channel_id] = max(latest.get(channel_id, 0), message_id)
+    for channel_id, count in sorted(counts.items()):
+        posted_at = id_time(latest[channel_id])
+        connection.execute(update(channels).where(channels.c.channel_id == channel_id).values(
+            message_count=channels.c.message_count + count,
+            last_message_at=case((or_(channels.c.last_message_at.is_(None),
+                                      channels.c.last_message_at < posted_at), posted_at),
+                                 else_=channels.c.last_message_at)
+        ))
+
+# Take deleted messages off their channel's message_count, last_message_at falls back to the newest one left
+def record_deletes(connection, deletes):
+    counts = Counter(channel_id for _, channel_id, _, _ in deletes if channel_id is not None)
+    for channel_id, count in sorted(counts.items()):
+        connection.execute(update(channels).where(channels.c.channel_id == channel_id).values(
+            message_count=channels.c.message_count - count,
+            last_message_at=_latest_message_at(channels.c.channel_id)
+        ))
+
+# Reset member_count of servers from server_members, returns how many were wrong
+def recount_servers(connection, server_ids):
+    actual = (select(func.count()).select_from(members)
+              .where(members.c.server_id == servers.c.server_id).scalar_subquery())
+    result = connection.execute(update(servers)
+                                .where(servers.c.server_id.in_(sorted(server_ids)), servers.c.member_count != actual)
+                                .values(member_count=actual))
+    return result.rowcount
+
+# Reset member_count of the next batch of servers after after_id from server_members
+# Returns the last server_id looked at (None when there are no more) and how many were wrong
+def reconcile_servers(connection, after_id, batch_size):
+    server_ids = connection.execute(select(servers.c.server_id).where(servers.c.server_id > after_id)
+                                    .order_by(servers.c.server_id).limit(batch_size)).scalars().all()
+    if not server_ids:
+        return None, 0
+    return server_ids[-1], recount_servers(connection, server_ids)
+
+# Reset message_count and last_message_at of channels from messages, returns how many were wrong
+# Used after messages are added or removed in bulk, where counting them one by one would cost more
+def recount_channels(connection, channel_ids):
+    actual_count = (select(func.count()).select_from(messages)
+                    .where(messages.c.channel_id == channels.c.channel_id).scalar_subquery())
+    actual_latest = _latest_message_at(channels.c.channel_id)
+    result = connection.execute(update(channels)
+                                .where(channels.c.channel_id.in_(sorted(channel_ids)),
+                                       or_(channels.c.message_count != actual_count,
+                                           channels.c.last_message_at.is_distinct_from(actual_latest)))
+                                .values(message_count=actual_count, last_message_at=actual_latest))
+    return result.rowcount
+
+# Reset message_count and last_message_at of the next batch of channels after after_id from messages
+def reconcile_channels(connection, after_id, batch_size):
+    channel_ids = connection.execute(select(channels.c.channel_id).where(channels.c.channel_id > after_id)
+                                     .order_by(channels.c.channel_id).limit(batch_size)).scalars().all()
+    if not channel_ids:
+        return None, 0
+    return channel_ids[-1], recount_channels(connection, channel_ids)
+
+# Reconcile every server and channel, committing after each batch so locks are held briefly
+# Returns how many servers and channels had wrong counters
+def reconcile_all(session, batch_size):
+    fixed = []
+    for reconcile in (reconcile_servers, reconcile_channels):
+        after_id, total = 0, 0
+        while after_id is not None:
+            after_id, count = reconcile(session.connection(), after_id, batch_size)
+            session.commit()
+            total += count
+        fixed.append(total)
+    return tuple(fixed)
+
+# Note rows that change counters, message ids and new members' server ids are only certain after the flush
+# Rows deleted along with their channel or server are skipped, the counter row goes too
+def _before_flush(session, flush_context, instances):
+    pending = session.info.setdefault("counter_changes", {"new": [], "deleted": []})
+    for obj in session.new:
+        if isinstance(obj, (Message, ServerMember)):
+            pending["new"].append(obj)
+    deleted_channels = {obj.channel_id for obj in session.deleted if isinstance(obj, Channel)}
+    deleted_servers = {obj.server_id for obj in session.deleted if isinstance(obj, Server)}
+    for obj in session.deleted:
+        if isinstance(obj, Message) and obj.channel_id not in deleted_channels:
+            pending["deleted"].append(obj)
+        elif isinstance(obj, ServerMember) and obj.server_id not in deleted_servers:
+            pending["deleted"].append(obj)
+
+def _after_flush(session, flush_context):
+    pending = session.info.pop("counter_changes", None)
+    if not pending:
+        return
+    connection = session.connection()
+    member_changes = Counter()
+    posts, deletes = [], []
+    for obj in pending["new"]:
+        if isinstance(obj, Message):
+            posts.append((obj.message_id, obj.channel_id, obj.sender_user_id, obj.receiver_user_id))
+        else:
+            member_changes[obj.server_id] += 1
+    for obj in pending["deleted"]:
+        if isinstance(obj, Message):
+            deletes.append((obj.message_id, obj.channel_id, obj.sender_user_id, obj.receiver_user_id))
+        else:
+            member_changes[obj.server_id] -= 1
+    record_members(connection, member_changes)
+    if posts:
+        record_posts(connection, posts)
+    if deletes:
+        record_deletes(connection, deletes)
+
+def _after_rollback(session, previous_transaction):
+    session.info.pop("counter_changes", None)
+
+# Register session events that keep counters current in the same transaction as ORM writes
+# Writes that bypass the unit of work (bulk inserts, group commit) call record_posts themselves
+def init_app(app):
+    if not event.contains(Session, "before_flush", _before_flush):
+        event.listen(Session, "before_flush", _before_flush)
+        event.listen(Session, "after_flush", _after_flush)
+        event.listen(Session, "after_soft_rollback", _after_rollback)
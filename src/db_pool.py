@@ -0,0 +1,147 @@
+import os
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from instrumentation import Histogram, SECONDS_BUCKETS
+from request_timing import add_timing
+
+# Queue pool that times how long each checkout waits for a connection
+# _do_get is where QueuePool blocks when every connection is in use
+class TimedQueuePool(QueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            pool_metrics.observe_timeout(time.perf_counter() - start)
+            raise
+        pool_metrics.observe_wait(time.perf_counter() - start)
+        return connection
+
+# Read an environment variable with convert, None when unset or empty
+def _env(name, convert=int):
+    value = os.environ.get(name)
+    return convert(value) if value else None
+
+# Engine options from environment variables, anything unset keeps the SQLAlchemy default
+# DB_POOLER_MODE=transaction is for PgBouncer style transaction pooling, where each transaction
+# may run on a different server connection, so nothing can rely on per-connection state
+def engine_options(database_uri):
+    if not database_uri:
+        return {}
+    url = make_url(database_uri)
+    options = {}
+    if _env("DB_POOL_PRE_PING", lambda value: value == "1"):
+        options["pool_pre_ping"] = True
+    recycle = _env("DB_POOL_RECYCLE")
+    if recycle is not None:
+        options["pool_recycle"] = recycle
+    # SQLite picks its own pool, which does not take the queue settings
+    if url.get_backend_name() != "sqlite":
+        options["poolclass"] = TimedQueuePool
+        for name, option in (("DB_POOL_SIZE", "pool_size"), ("DB_MAX_OVERFLOW", "max_overflow"),
+                             ("DB_POOL_TIMEOUT", "pool_timeout")):
+            value = _env(name, float if option == "pool_timeout" else int)
+            if value is not None:
+                options[option] = value
+    if os.environ.get("DB_POOLER_MODE", "session") == "transaction":
+        # psycopg 3 prepares statements it sees often, prepared statements live on one server
+        # connection and break when the pooler moves the client. psycopg2 never prepares
+        if url.get_driver_name() == "psycopg":
+            options["connect_args"] = {"prepare_threshold": None}
+        # Prepared statement caches in the driver are per server connection as well
+        elif url.get_driver_name() == "asyncpg":
+            options["connect_args"] = {"prepared_statement_cache_size": 0}
+    return options
+
+# Checkout wait times, timeouts and connection counts of the app's pools
+class PoolMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.wait = Histogram(SECONDS_BUCKETS)
+        self.timeouts = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.pools = []
+
+    def observe_wait(self, seconds):
+        with self._lock:
+            self.wait.observe(seconds)
+        # Show up in the Server-Timing header of the request that waited
+        add_timing("pool", seconds)
+
+    def observe_timeout(self, seconds):
+        with self._lock:
+            self.timeouts += 1
+        add_timing("pool", seconds)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    # Connections dropped after a failed pre-ping or a disconnect error
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+
+    # Watch the pool of every engine of the app
+    def init_app(self, app, db):
+        with app.app_context():
+            for engine in db.engines.values():
+                if not event.contains(engine.pool, "connect", self._on_connect):
+                    event.listen(engine.pool, "connect", self._on_connect)
+                    event.listen(engine.pool, "invalidate", self._on_invalidate)
+                if engine.pool not in self.pools:
+                    self.pools.append(engine.pool)
+        app.extensions["pool_metrics"] = self
+
+    # Sum a count over pools that keep it, only queue pools know their size and idle connections
+    def _pool_total(self, name):
+        return sum(getattr(pool, name)() for pool in self.pools if hasattr(pool, name))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self._pool_total("size"),
+                "in_use": self._pool_total("checkedout"),
+                "idle": self._pool_total("checkedin"),
+                "overflow": sum(max(pool.overflow(), 0) for pool in self.pools if hasattr(pool, "overflow")),
+                "checkouts": self.wait.count,
+                "wait_seconds_total": round(self.wait.sum, 6),
+                "timeouts": self.timeouts,
+                "connects": self.connects,
+                "invalidations": self.invalidations
+            }
+
+    # Render counts and the wait histogram in Prometheus text exposition format
+    def render(self):
+        lines = [f"db_pool_{name} {value}" for name, value in self.stats().items()]
+        with self._lock:
+            lines.append("# TYPE db_pool_wait_seconds histogram")
+            for bound, count in zip(self.wait.buckets, self.wait.counts):
+                lines.append(f'db_pool_wait_seconds_bucket{{le="{bound}"}} {count}')
+            lines.append(f'db_pool_wait_seconds_bucket{{le="+Inf"}} {self.wait.count}')
+            lines.append(f"db_pool_wait_seconds_sum {self.wait.sum:.6f}")
+            lines.append(f"db_pool_wait_seconds_count {self.wait.count}")
+        return "\n".join(lines) + "\n"
+
+pool_metrics = PoolMetrics()
+
+# SQLite only enforces foreign keys, ON DELETE CASCADE included, on connections that turn them on
+def _sqlite_foreign_keys(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+# Set up every engine of the app and watch its pool
+def init_app(app, db):
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == "sqlite" and not event.contains(engine, "connect", _sqlite_foreign_keys):
+                event.listen(engine, "connect", _sqlite_foreign_keys)
+    pool_metrics.init_app(app, db)
@@ -0,0 +1,261 @@
+import logging
+import os
+import threading
+from collections import Counter, namedtuple
+from datetime import timedelta
+
+from sqlalchemy import and_, delete, func, or_, select, update
+
+import counters
+import read_markers
+from membership_cache import membership_cache
+from versioning import bump_versions, notify_committed, utcnow
+from models.user import User
+from models.server import Server
+from models.server_member import ServerMember
+from models.channel import Channel
+from models.message import Message
+from models.read_marker import ReadMarker
+from models.deletion_job import DeletionJob
+
+logger = logging.getLogger(__name__)
+
+users = User.__table__
+servers = Server.__table__
+members = ServerMember.__table__
+channels = Channel.__table__
+messages = Message.__table__
+markers = ReadMarker.__table__
+jobs = DeletionJob.__table__
+
+# A running job not heard from for this long is taken over by another worker
+STALE_AFTER = timedelta(minutes=5)
+
+# What one batch did: rows deleted, scopes whose responses changed, whether the target is gone,
+# and servers whose cached membership of the user needs clearing
+Batch = namedtuple("Batch", ["rows", "scopes", "done", "left_server_ids"], defaults=[frozenset(), False, ()])
+
+# Delete up to limit rows of table matching condition and return the returning columns of each
+def _delete_some(connection, table, condition, limit, *returning):
+    key = list(table.primary_key.columns)[0]
+    stmt = delete(table).where(key.in_(select(key).where(condition).limit(limit)))
+    return connection.execute(stmt.returning(*(returning or (key,)))).all()
+
+# Count rows of a query, stopping at limit + 1 when a limit is given
+def _count(connection, stmt, limit=None):
+    if limit is not None:
+        stmt = stmt.limit(limit + 1)
+    return connection.scalar(select(func.count()).select_from(stmt.subquery()))
+
+# Rows a server deletion removes, from the counters so nothing is counted
+def server_estimate(connection, server_ids):
+    server_ids = list(server_ids)
+    if not server_ids:
+        return 0
+    member_total = connection.scalar(select(func.coalesce(func.sum(servers.c.member_count), 0))
+                                     .where(servers.c.server_id.in_(server_ids)))
+    channel_total = connection.scalar(select(func.coalesce(func.sum(channels.c.message_count + 1), 0))
+                                      .where(channels.c.server_id.in_(server_ids)))
+    return len(server_ids) + member_total + channel_total
+
+# Rows a user deletion removes, or None once it is past limit
+def user_estimate(connection, user_id, limit=None):
+    created = connection.execute(select(servers.c.server_id).where(servers.c.creator_user_id == user_id)).scalars()
+    total = 1 + server_estimate(connection, created)
+    for stmt in (
+        select(members.c.member_id).where(members.c.user_id == user_id),
+        select(messages.c.message_id).where(messages.c.sender_user_id == user_id),
+        select(messages.c.message_id).where(messages.c.receiver_user_id == user_id),
+        select(markers.c.marker_id).where(markers.c.user_id == user_id)
+    ):
+        if limit is not None and total > limit:
+            return None
+        total += _count(connection, stmt, None if limit is None else limit - total)
+    return None if limit is not None and total > limit else total
+
+# One batch of a server deletion, deepest rows first so each batch only removes rows nothing points at
+# Messages go before their channels, which go before the server
+def _server_batch(connection, server_id, limit):
+    channel_ids = select(channels.c.channel_id).where(channels.c.server_id == server_id)
+    for table, condition in (
+        (messages, messages.c.channel_id.in_(channel_ids)),
+        (markers, markers.c.channel_id.in_(channel_ids)),
+        (channels, channels.c.server_id == server_id),
+        (members, members.c.server_id == server_id)
+    ):
+        rows = _delete_some(connection, table, condition, limit)
+        if rows:
+            return Batch(len(rows))
+    connection.execute(delete(servers).where(servers.c.server_id == server_id))
+    return Batch(1, done=True)
+
+# One batch of a user deletion
+# Rows in servers the user does not own are taken off counters, unread counts and versions as they go
+def _user_batch(connection, user_id, limit):
+    # Servers the user created, one at a time, already hidden
+    server_id = connection.scalar(select(servers.c.server_id).where(servers.c.creator_user_id == user_id)
+                                  .order_by(servers.c.server_id).limit(1))
+    if server_id is not None:
+        return _server_batch(connection, server_id, limit)._replace(done=False)
+    # Channels the user created in other servers, with their messages and markers
+    channel_id = connection.scalar(select(channels.c.channel_id).where(channels.c.creator_user_id == user_id)
+                                   .order_by(channels.c.channel_id).limit(1))
+    if channel_id is not None:
+        for table, condition in ((messages, messages.c.channel_id == channel_id),
+                                 (markers, markers.c.channel_id == channel_id)):
+            rows = _delete_some(connection, table, condition, limit)
+            if rows:
+                return Batch(len(rows), bump_versions(connection, channel_ids=[channel_id]))
+        channel_server_id = connection.scalar(delete(channels).where(channels.c.channel_id == channel_id)
+                                              .returning(channels.c.server_id))
+        return Batch(1, bump_versions(connection, server_ids=[channel_server_id]))
+    # Messages the user sent
+    rows = _delete_some(connection, messages, messages.c.sender_user_id == user_id, limit,
+                        messages.c.message_id, messages.c.channel_id, messages.c.sender_user_id,
+                        messages.c.receiver_user_id)
+    if rows:
+        counters.record_deletes(connection, rows)
+        read_markers.record_deletes(connection, rows)
+        return Batch(len(rows), bump_versions(connection, channel_ids={row.channel_id for row in rows}))
+    # Direct messages the user received, and read markers of or about the user
+    for table, condition in ((messages, messages.c.receiver_user_id == user_id),
+                             (markers, or_(markers.c.user_id == user_id, markers.c.peer_user_id == user_id))):
+        rows = _delete_some(connection, table, condition, limit)
+        if rows:
+            return Batch(len(rows))
+    # Memberships of other servers
+    rows = _delete_some(connection, members, members.c.user_id == user_id, limit, members.c.server_id)
+    if rows:
+        server_ids = [row.server_id for row in rows]
+        counters.record_members(connection, Counter({server_id: -1 for server_id in server_ids}))
+        return Batch(len(rows), bump_versions(connection, server_ids=server_ids), left_server_ids=server_ids)
+    connection.execute(delete(users).where(users.c.user_id == user_id))
+    return Batch(1, done=True)
+
+_BATCHES = {"server": _server_batch, "user": _user_batch}
+
+# Deletes servers and users in bounded batches, each its own short transaction
+# Jobs live in deletion_jobs, so any worker (or flask db run-deletions) can pick them up after a restart
+class Deleter:
+    def __init__(self):
+        self.batch_size = 1000
+        self.inline_rows = 5000
+        self.poll_seconds = 5
+        self._app = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    # Configure deletion from environment variables
+    def init_app(self, app):
+        self.batch_size = int(os.environ.get("DELETE_BATCH_SIZE", 1000))
+        self.inline_rows = int(os.environ.get("DELETE_INLINE_ROWS", 5000))
+        self.poll_seconds = float(os.environ.get("DELETE_POLL_SECONDS", 5))
+        self._app = app
+        app.extensions["deleter"] = self
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run_pending, name="deleter", daemon=True)
+                    self._thread.start()
+        self._wake.set()
+
+    # Hide server at once and delete it, during the request when small and in the background otherwise
+    def delete_server(self, server, requested_by_user_id):
+        from main import db
+        server.deleted_at = utcnow()
+        estimate = server_estimate(db.session.connection(), [server.server_id])
+        return self._start(db, "server", server.server_id, requested_by_user_id, estimate)
+
+    # Hide user and the servers they created at once, then delete them like delete_server
+    def delete_user(self, user):
+        from main import db
+        now = utcnow()
+        user.deleted_at = now
+        for server in Server.query.filter_by(creator_user_id=user.user_id, deleted_at=None):
+            server.deleted_at = now
+        estimate = user_estimate(db.session.connection(), user.user_id, limit=self.inline_rows)
+        return self._start(db, "user", user.user_id, user.user_id, estimate)
+
+    def _start(self, db, kind, target_id, requested_by_user_id, estimate):
+        inline = estimate is not None and estimate <= self.inline_rows
+        # Jobs run here start as running, so no background worker picks them up as well
+        job = DeletionJob(kind=kind, target_id=target_id, requested_by_user_id=requested_by_user_id,
+                          estimated_rows=estimate, status="running" if inline else "pending",
+                          heartbeat_at=utcnow() if inline else None)
+        db.session.add(job)
+        db.session.commit()
+        if inline:
+            self.run(db.engine, job.job_id)
+            db.session.refresh(job)
+        else:
+            self._ensure_thread()
+        return job
+
+    # Take the oldest pending job, or a running one whose worker stopped reporting
+    def claim(self, engine, retry_failed=False):
+        statuses = ["pending", "failed"] if retry_failed else ["pending"]
+        with engine.begin() as connection:
+            job_id = connection.scalar(
+                select(jobs.c.job_id)
+                .where(or_(jobs.c.status.in_(statuses),
+                           and_(jobs.c.status == "running", jobs.c.heartbeat_at < utcnow() - STALE_AFTER)))
+                .order_by(jobs.c.job_id).limit(1).with_for_update(skip_locked=True)
+            )
+            if job_id is not None:
+                connection.execute(update(jobs).where(jobs.c.job_id == job_id)
+                                   .values(status="running", heartbeat_at=utcnow(), error=None))
+        return job_id
+
+    # Run a claimed job to the end, a batch that fails marks the job failed and leaves the rest in place
+    def run(self, engine, job_id):
+        with engine.connect() as connection:
+            job = connection.execute(select(jobs).where(jobs.c.job_id == job_id)).one()
+        batch = _BATCHES[job.kind]
+        if job.estimated_rows is None:
+            with engine.begin() as connection:
+                connection.execute(update(jobs).where(jobs.c.job_id == job_id)
+                                   .values(estimated_rows=user_estimate(connection, job.target_id)))
+        done = False
+        while not done:
+            try:
+                with engine.begin() as connection:
+                    result = batch(connection, job.target_id, self.batch_size)
+                    now = utcnow()
+                    connection.execute(update(jobs).where(jobs.c.job_id == job_id).values(
+                        deleted_rows=jobs.c.deleted_rows + result.rows,
+                        heartbeat_at=now,
+                        status="done" if result.done else "running",
+                        finished_at=now if result.done else None
+                    ))
+            except Exception as err:
+                logger.exception("deletion job %s failed", job_id)
+                with engine.begin() as connection:
+                    connection.execute(update(jobs).where(jobs.c.job_id == job_id)
+                                       .values(status="failed", error=str(err)[:500]))
+                return False
+            notify_committed(result.scopes)
+            for server_id in result.left_server_ids:
+                membership_cache.invalidate(job.target_id, server_id)
+            done = result.done
+        return True
+
+    def _run_pending(self):
+        from main import db
+        with self._app.app_context():
+            engine = db.engine
+        while True:
+            try:
+                job_id = self.claim(engine)
+            except Exception:
+                logger.exception("could not claim deletion job")
+                job_id = None
+            if job_id is None:
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+                continue
+            self.run(engine, job_id)
+
+deleter = Deleter()
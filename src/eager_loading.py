@@ -0,0 +1,45 @@
+from marshmallow import fields
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, selectinload
+
+# Stop following nested schemas past this depth in case schemas refer back to each other
+MAX_DEPTH = 4
+
+_options_cache = {}
+
+# Get nested schema behind a Nested or List(Nested) field
+def nested_schema(field):
+    if isinstance(field, fields.List):
+        field = field.inner
+    if isinstance(field, fields.Nested):
+        return field.schema
+    return None
+
+# Build loader options that match what a schema will walk when it dumps the model
+# Many-to-one relationships are joined into the same SELECT, collections are
+# fetched with one extra SELECT ... IN per relationship, so the number of
+# queries stays the same however many rows are dumped
+def _build_options(schema, model, depth):
+    options = []
+    if depth >= MAX_DEPTH:
+        return options
+    relationships = inspect(model).relationships
+    for name, field in schema.fields.items():
+        child_schema = nested_schema(field)
+        relationship = relationships.get(name)
+        if child_schema is None or relationship is None:
+            continue
+        attribute = getattr(model, name)
+        loader = selectinload(attribute) if relationship.uselist else joinedload(attribute)
+        child_options = _build_options(child_schema, relationship.mapper.class_, depth + 1)
+        if child_options:
+            loader = loader.options(*child_options)
+        options.append(loader)
+    return options
+
+# Get eager loading options for dumping model instances with schema
+def eager_load(schema, model):
+    key = (schema, model)
+    if key not in _options_cache:
+        _options_cache[key] = _build_options(schema, model, 0)
+    return _options_cache[key]
@@ -0,0 +1,252 @@
+import csv
+import gzip
+import io
+import itertools
+import json
+from datetime import date
+
+from sqlalchemy import insert, select, union, update
+
+import counters
+import read_markers
+from partitions import ensure_partitions, json_default
+from snowflake import MAX_WORKER_ID, SEQUENCE_BITS, id_time, ids_for_times
+from versioning import utcnow
+from models.user import User
+from models.server import Server
+from models.server_member import ServerMember
+from models.channel import Channel
+from models.message import Message
+from models.deletion_job import DeletionJob
+
+users = User.__table__
+servers = Server.__table__
+members = ServerMember.__table__
+channels = Channel.__table__
+messages = Message.__table__
+
+# Bumped when the file layout changes, import refuses files of other versions
+FORMAT_VERSION = 1
+
+# Columns written for each kind of record, ids are only used to link records on import and are replaced
+# Counters, versions and read markers are not exported, import works them out again
+EXPORT_COLUMNS = {
+    "user": (users.c.user_id, users.c.username, users.c.email, users.c.password, users.c.name, users.c.status),
+    "server": (servers.c.server_id, servers.c.server_name, servers.c.created_on, servers.c.message_retention_days,
+               servers.c.creator_user_id),
+    "member": (members.c.user_id, members.c.joined_on, members.c.is_admin),
+    "channel": (channels.c.channel_id, channels.c.channel_name, channels.c.created_on, channels.c.creator_user_id),
+    "message": (messages.c.message_id, messages.c.title, messages.c.content, messages.c.sender_user_id,
+                messages.c.channel_id)
+}
+
+# Record fields stored as ISO 8601 dates
+DATE_FIELDS = ("created_on", "joined_on")
+
+# Rows fetched from the database at a time while exporting
+EXPORT_BATCH = 1000
+
+# Columns COPY fills for imported messages, the rest take their server defaults
+COPY_COLUMNS = ("message_id", "title", "content", "timestamp", "channel_id", "sender_user_id", "updated_at")
+
+def _write(archive, kind, values):
+    archive.write(json.dumps({"type": kind, **values}, default=json_default) + "\n")
+
+# Stream query with a server-side cursor, yielding lists of up to EXPORT_BATCH rows
+def _batches(connection, stmt):
+    return connection.execute(stmt.execution_options(yield_per=EXPORT_BATCH)).partitions()
+
+# Write a server's users, members, channels and channel messages to a gzipped NDJSON file
+# One read-only transaction gives a consistent snapshot, and rows are streamed so memory use stays flat
+# Users who only appear as message senders are written just before the first of their messages
+# Returns how many records of each kind were written
+def export_server(engine, server_id, path):
+    counts = dict.fromkeys(EXPORT_COLUMNS, 0)
+    connection = engine.connect()
+    if engine.dialect.name == "postgresql":
+        connection = connection.execution_options(isolation_level="REPEATABLE READ")
+    with connection, connection.begin(), gzip.open(path, "wt", encoding="utf-8") as archive:
+        server = connection.execute(select(*EXPORT_COLUMNS["server"])
+                                    .where(servers.c.server_id == server_id, servers.c.deleted_at.is_(None))).first()
+        if server is None:
+            raise LookupError(f"server with id {server_id} not found")
+        _write(archive, "export", {"version": FORMAT_VERSION, "server_id": server_id, "exported_at": utcnow()})
+        channel_ids = select(channels.c.channel_id).where(channels.c.server_id == server_id)
+        seen_user_ids = set()
+
+        def write_users(user_ids):
+            for batch in _batches(connection, select(*EXPORT_COLUMNS["user"]).where(users.c.user_id.in_(user_ids))
+                                  .order_by(users.c.user_id)):
+                for row in batch:
+                    seen_user_ids.add(row.user_id)
+                    _write(archive, "user", row._asdict())
+                counts["user"] += len(batch)
+
+        write_users(union(
+            select(servers.c.creator_user_id).where(servers.c.server_id == server_id),
+            select(members.c.user_id).where(members.c.server_id == server_id),
+            select(channels.c.creator_user_id).where(channels.c.server_id == server_id)
+        ))
+        _write(archive, "server", server._asdict())
+        counts["server"] = 1
+        for kind, condition, order in (("member", members.c.server_id == server_id, members.c.member_id),
+                                       ("channel", channels.c.server_id == server_id, channels.c.channel_id)):
+            for batch in _batches(connection, select(*EXPORT_COLUMNS[kind]).where(condition).order_by(order)):
+                for row in batch:
+                    _write(archive, kind, row._asdict())
+                counts[kind] += len(batch)
+        for batch in _batches(connection, select(*EXPORT_COLUMNS["message"])
+                              .where(messages.c.channel_id.in_(channel_ids)).order_by(messages.c.message_id)):
+            senders = {row.sender_user_id for row in batch} - seen_user_ids
+            if senders:
+                write_users(sorted(senders))
+            for row in batch:
+                _write(archive, "message", row._asdict())
+            counts["message"] += len(batch)
+    return counts
+
+# Loads an export file as a new server, keeping only id maps for users and channels in memory
+# Users are matched to existing ones by email, anyone else is added. A new user whose username is
+# taken gets their old id appended to it. Messages get new time ordered ids made from their old ones
+class ServerImport:
+    def __init__(self, engine, batch_size, worker_id):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.worker_id = worker_id
+        self.server_id = None
+        self.user_ids = {}
+        self.channel_ids = {}
+        self.last_message_id = None
+        self.counts = dict.fromkeys(EXPORT_COLUMNS, 0)
+
+    def _users(self, connection, records):
+        existing = dict(connection.execute(select(users.c.email, users.c.user_id)
+                                           .where(users.c.email.in_([record["email"] for record in records]))).all())
+        new = [record for record in records if record["email"] not in existing]
+        taken = set(connection.execute(select(users.c.username)
+                                       .where(users.c.username.in_([record["username"] for record in new]))).scalars())
+        rows = [{
+            "username": f"{record['username']}_{record['user_id']}" if record["username"] in taken else record["username"],
+            "email": record["email"], "password": record["password"], "name": record["name"], "status": record["status"]
+        } for record in new]
+        new_ids = connection.execute(insert(users).returning(users.c.user_id, sort_by_parameter_order=True),
+                                     rows).scalars().all() if rows else []
+        for record in records:
+            self.user_ids[record["user_id"]] = existing.get(record["email"])
+        for record, new_id in zip(new, new_ids):
+            self.user_ids[record["user_id"]] = new_id
+        self.counts["user"] += len(new)
+
+    # The server stays hidden, like one being deleted, until the import has finished
+    def _server(self, connection, records):
+        record = records[0]
+        self.server_id = connection.scalar(insert(servers).returning(servers.c.server_id).values(
+            server_name=record["server_name"], created_on=record["created_on"],
+            message_retention_days=record["message_retention_days"],
+            creator_user_id=self.user_ids[record["creator_user_id"]], deleted_at=utcnow()
+        ))
+        self.counts["server"] = 1
+
+    def _members(self, connection, records):
+        connection.execute(insert(members), [{
+            "server_id": self.server_id, "user_id": self.user_ids[record["user_id"]],
+            "joined_on": record["joined_on"], "is_admin": record["is_admin"]
+        } for record in records])
+        self.counts["member"] += len(records)
+
+    def _channels(self, connection, records):
+        new_ids = connection.execute(insert(channels).returning(channels.c.channel_id, sort_by_parameter_order=True), [{
+            "server_id": self.server_id, "channel_name": record["channel_name"], "created_on": record["created_on"],
+            "creator_user_id": self.user_ids[record["creator_user_id"]]
+        } for record in records]).scalars().all()
+        for record, new_id in zip(records, new_ids):
+            self.channel_ids[record["channel_id"]] = new_id
+        self.counts["channel"] += len(records)
+
+    # Ids this import's worker id already has between first_id and last_id, from an earlier import
+    def _taken_ids(self, connection, first_id, last_id):
+        worker = messages.c.message_id.op(">>")(SEQUENCE_BITS).op("&")(MAX_WORKER_ID)
+        return set(connection.execute(select(messages.c.message_id).where(
+            messages.c.message_id.between(first_id, last_id), worker == self.worker_id
+        )).scalars())
+
+    # Messages are exported in id order, so their times never go backwards and new ids keep that order
+    # Importing a file again makes the same ids, so ids already in the table are skipped until none clash
+    def _messages(self, connection, records):
+        now = utcnow()
+        times = [id_time(record["message_id"]) for record in records]
+        taken = set()
+        while True:
+            new_ids = list(ids_for_times(times, worker_id=self.worker_id, after=self.last_message_id, taken=taken))
+            clashes = self._taken_ids(connection, new_ids[0], new_ids[-1]) - taken
+            if not clashes:
+                break
+            taken |= clashes
+        self.last_message_id = new_ids[-1]
+        rows = [{
+            "message_id": new_id, "title": record["title"], "content": record["content"], "timestamp": id_time(new_id),
+            "channel_id": self.channel_ids[record["channel_id"]], "sender_user_id": self.user_ids[record["sender_user_id"]],
+            "updated_at": now
+        } for record, new_id in zip(records, new_ids)]
+        if connection.dialect.name == "postgresql":
+            # csv quotes every string, None included, so FORCE_NULL turns a missing title back into NULL
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+            for row in rows:
+                writer.writerow([row[column] for column in COPY_COLUMNS])
+            buffer.seek(0)
+            cursor = connection.connection.dbapi_connection.cursor()
+            cursor.copy_expert(f"COPY messages ({', '.join(COPY_COLUMNS)}) FROM STDIN "
+                                "WITH (FORMAT csv, FORCE_NULL (title))", buffer)
+        else:
+            connection.execute(insert(messages), rows)
+        self.counts["message"] += len(records)
+
+    # Fill in what export leaves out, then show the server
+    def _finish(self):
+        with self.engine.begin() as connection:
+            counters.recount_servers(connection, [self.server_id])
+            counters.recount_channels(connection, self.channel_ids.values())
+            read_markers.add_server_markers(connection, self.server_id)
+            connection.execute(update(servers).where(servers.c.server_id == self.server_id).values(deleted_at=None))
+        ensure_partitions(self.engine)
+
+    # Read path and load it in batches of batch_size records, each batch its own transaction
+    # If the import fails part way, the partly loaded server is queued for deletion and the error raised
+    def run(self, path):
+        handlers = {"user": self._users, "server": self._server, "member": self._members,
+                    "channel": self._channels, "message": self._messages}
+        with gzip.open(path, "rt", encoding="utf-8") as archive:
+            records = (json.loads(line) for line in archive)
+            header = next(records, None)
+            if header is None or header.get("type") != "export" or header.get("version") != FORMAT_VERSION:
+                raise ValueError(f"{path} is not a version {FORMAT_VERSION} server export")
+            try:
+                # Records of one kind come in runs, and every record comes after those it refers to
+                for kind, run in itertools.groupby(records, key=lambda record: record["type"]):
+                    while True:
+                        batch = list(itertools.islice(run, self.batch_size))
+                        if not batch:
+                            break
+                        for record in batch:
+                            for field in DATE_FIELDS:
+                                if record.get(field):
+                                    record[field] = date.fromisoformat(record[field])
+                        with self.engine.begin() as connection:
+                            handlers[kind](connection, batch)
+                self._finish()
+            except Exception:
+                # Queued by nobody, run-deletions or any worker picks it up
+                if self.server_id is not None:
+                    with self.engine.begin() as connection:
+                        connection.execute(insert(DeletionJob.__table__).values(
+                            kind="server", target_id=self.server_id, requested_by_user_id=0, status="pending",
+                            deleted_rows=0, created_at=utcnow()
+                        ))
+                raise
+        return self.counts
+
+def import_server(engine, path, batch_size, worker_id):
+    server_import = ServerImport(engine, batch_size, worker_id)
+    counts = server_import.run(path)
+    return server_import.server_id, counts
@@ -0,0 +1,150 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from sqlalchemy import insert
+
+from versioning import bump_versions, notify_committed
+
+# Raised when a queued message was not written within GROUP_COMMIT_TIMEOUT, the post can be retried
+class GroupCommitBusyError(Exception):
+    pass
+
+# Post as record_posts takes it, from a queued row and its new message_id
+def _post(row, message_id):
+    return message_id, row.get("channel_id"), row.get("sender_user_id"), row.get("receiver_user_id")
+
+# Message inserts from concurrent requests in this worker, committed together in one transaction
+# Each request waits until the transaction holding its row has committed, so a
+# returned message_id is as durable as with a commit per request
+class GroupCommitter:
+    def __init__(self):
+        self.enabled = False
+        self.window = 0.003
+        self.max_rows = 100
+        self.timeout = 10
+        self._app = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.rows = 0
+
+    # Configure from environment variables, off unless GROUP_COMMIT_ENABLED=1
+    def init_app(self, app):
+        self.enabled = os.environ.get("GROUP_COMMIT_ENABLED", "0") == "1"
+        self.window = float(os.environ.get("GROUP_COMMIT_WINDOW_MS", 3)) / 1000
+        self.max_rows = int(os.environ.get("GROUP_COMMIT_MAX_ROWS", 100))
+        self.timeout = float(os.environ.get("GROUP_COMMIT_TIMEOUT", 10))
+        self._app = app
+        app.extensions["group_commit"] = self
+
+    # Flusher thread is started on first use so it runs inside each worker process
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                    self._thread.start()
+
+    # Add and commit a new message, batched with concurrent posts when group commit is on
+    def save(self, message):
+        from main import db
+        from models.message import Message
+        if not self.enabled:
+            db.session.add(message)
+            db.session.commit()
+            return message
+        # Unset columns that have defaults are left out so the insert fills them in
+        row = {}
+        for column in Message.__table__.columns:
+            value = getattr(message, column.key)
+            if not column.primary_key and (value is not None or column.default is None):
+                row[column.key] = value
+        # End the request's read transaction first, so its pooled connection is free for the
+        # flusher rather than held while waiting on it
+        db.session.commit()
+        return db.session.get(Message, self.insert_message(row))
+
+    # Queue a messages row and wait for its message_id once it is committed
+    # A row not yet taken by the flusher when the wait times out is dropped and GroupCommitBusyError
+    # raised, one already being written is waited for so the caller never retries a committed post
+    def insert_message(self, row):
+        self._ensure_thread()
+        future = Future()
+        self._queue.put((row, future))
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            if future.cancel():
+                raise GroupCommitBusyError("message queue busy, please try again shortly")
+            return future.result()
+
+    # Wait for the first row, then gather more until the window closes or the batch is full
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_rows:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        from main import db
+        from models.message import Message
+        import counters
+        import read_markers
+        with self._app.app_context():
+            engine = db.engine
+        stmt = insert(Message.__table__).returning(Message.__table__.c.message_id, sort_by_parameter_order=True)
+        while True:
+            # Rows whose requests timed out and cancelled are left out
+            batch = [(row, future) for row, future in self._next_batch() if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            # Any error has to reach the waiting requests, otherwise they hang until timeout
+            try:
+                with engine.begin() as connection:
+                    message_ids = connection.execute(stmt, [row for row, _ in batch]).scalars().all()
+                    scopes = bump_versions(connection, channel_ids=[row["channel_id"] for row, _ in batch])
+                    posts = [_post(row, message_id) for (row, _), message_id in zip(batch, message_ids)]
+                    read_markers.record_posts(connection, posts)
+                    counters.record_posts(connection, posts)
+            except Exception:
+                # One bad row must not fail the others, so retry them one at a time
+                for row, future in batch:
+                    try:
+                        with engine.begin() as connection:
+                            message_id = connection.execute(stmt, [row]).scalar_one()
+                            scopes = bump_versions(connection, channel_ids=[row["channel_id"]])
+                            read_markers.record_posts(connection, [_post(row, message_id)])
+                            counters.record_posts(connection, [_post(row, message_id)])
+                        notify_committed(scopes)
+                        future.set_result(message_id)
+                    except Exception as err:
+                        future.set_exception(err)
+                continue
+            notify_committed(scopes)
+            self.batches += 1
+            self.rows += len(batch)
+            for (_, future), message_id in zip(batch, message_ids):
+                future.set_result(message_id)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "window_ms": self.window * 1000,
+            "max_rows": self.max_rows,
+            "queued": self._queue.qsize(),
+            "batches": self.batches,
+            "rows": self.rows
+        }
+
+group_committer = GroupCommitter()
@@ -0,0 +1,128 @@
+import logging
+import os
+import threading
+import time
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+
+from request_timing import add_timing, request_timings
+
+# Histogram bucket upper bounds for request and database time (seconds) and statements per request
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+slow_query_logger = logging.getLogger("slow_query")
+
+# Cumulative histogram in the Prometheus sense, one per endpoint and metric
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+# Per endpoint histograms of request duration, database time and statement count
+class EndpointMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+
+    def observe(self, endpoint, duration, db_seconds, queries):
+        with self._lock:
+            for name, buckets, value in (
+                ("http_request_duration_seconds", SECONDS_BUCKETS, duration),
+                ("db_time_seconds", SECONDS_BUCKETS, db_seconds),
+                ("db_queries", QUERY_BUCKETS, queries)
+            ):
+                key = (name, endpoint)
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(buckets)
+                self.histograms[key].observe(value)
+
+    # Render every histogram in Prometheus text exposition format
+    def render(self):
+        lines = []
+        with self._lock:
+            names = sorted({name for name, _ in self.histograms})
+            for name in names:
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, endpoint), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    label = f'endpoint="{endpoint}"'
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{name}_bucket{{{label},le="{bound}"}} {count}')
+                    lines.append(f'{name}_bucket{{{label},le="+Inf"}} {histogram.count}')
+                    lines.append(f"{name}_sum{{{label}}} {histogram.sum:.6f}")
+                    lines.append(f"{name}_count{{{label}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+endpoint_metrics = EndpointMetrics()
+
+# Describe parameters without logging their values
+def _parameter_shape(parameters):
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            return f"{len(parameters)} x {_parameter_shape(parameters[0])}"
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+# Count and time every statement, and log slow ones with the route that issued them
+def _instrument_engine(engine, slow_query_seconds):
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        add_timing("db", elapsed)
+        if slow_query_seconds is not None and elapsed >= slow_query_seconds:
+            route = request.endpoint if has_request_context() else None
+            slow_query_logger.warning("slow query %.1f ms route=%s statement=%s parameters=%s",
+                                      elapsed * 1000, route, " ".join(statement.split()),
+                                      _parameter_shape(parameters))
+
+# Build Server-Timing header value from the timings recorded for this request
+def _server_timing(timings, total):
+    entries = []
+    db_seconds, queries = timings.get("db", (0.0, 0))
+    entries.append(f'db;dur={db_seconds * 1000:.3f};desc="{queries} queries"')
+    for name in ("pool", "serialize", "bcrypt"):
+        if name in timings:
+            entries.append(f"{name};dur={timings[name][0] * 1000:.3f}")
+    entries.append(f"total;dur={total * 1000:.3f}")
+    return ", ".join(entries)
+
+# Hook SQLAlchemy engine events and request timing into the app
+def init_app(app, db):
+    slow_query_ms = os.environ.get("SLOW_QUERY_MS")
+    slow_query_seconds = float(slow_query_ms) / 1000 if slow_query_ms else None
+    with app.app_context():
+        for engine in db.engines.values():
+            _instrument_engine(engine, slow_query_seconds)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def add_server_timing(response):
+        if "request_start" not in g:
+            return response
+        total = time.perf_counter() - g.request_start
+        timings = request_timings()
+        response.headers["Server-Timing"] = _server_timing(timings, total)
+        db_seconds, queries = timings.get("db", (0.0, 0))
+        endpoint_metrics.observe(request.endpoint or "unmatched", total, db_seconds, queries)
+        return response
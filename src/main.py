@@ -6,6 +6,17 @@ from flask_marshmallow import Marshmallow
 from flask_bcrypt import Bcrypt
 from flask_jwt_extended import JWTManager
 from marshmallow.exceptions import ValidationError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from membership_cache import membership_cache
+from response_cache import response_cache
+from password_hasher import password_hasher, HasherBusyError
+from message_events import message_events
+from group_commit import group_committer, GroupCommitBusyError
+from snowflake import snowflake
+from request_timing import TimedJSONProvider
+import db_pool
+from db_pool import engine_options
 
 # Initialise libraries
 db = SQLAlchemy()
@@ -14,31 +25,77 @@ bcrypt = Bcrypt()
 jwt = JWTManager()
 
 # create, configure and initialise flask app
-def create_app():
+# config overrides the .env settings, e.g. to point benchmarks at their own database
+def create_app(config=None):
     app = Flask(__name__)
 
+    # Time json encoding of responses
+    app.json = TimedJSONProvider(app)
+
     # Displays json output as listed in model
     app.json.sort_keys = False
 
     # Retrieve relevant details from .env file
     app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
     app.config["JWT_SECRET_KEY"] = os.environ.get("JWT_SECRET_KEY")
+    app.config["SNOWFLAKE_WORKER_ID"] = os.environ.get("SNOWFLAKE_WORKER_ID")
+    app.config.update(config or {})
+
+    # Connection pool settings from .env file, config can still set its own
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(app.config["SQLALCHEMY_DATABASE_URI"]))
 
     # Initialise libraries in app
+    password_hasher.init_app(app)
     db.init_app(app)
     ma.init_app(app)
     bcrypt.init_app(app)
     jwt.init_app(app)
+    membership_cache.init_app(app)
+    response_cache.init_app(app)
+    message_events.init_app(app)
+    group_committer.init_app(app)
+    snowflake.init_app(app)
+
+    # Count and time SQL statements per request
+    import instrumentation
+    instrumentation.init_app(app, db)
+
+    # Turn on SQLite foreign keys, time connection checkouts and count pool connections
+    db_pool.init_app(app, db)
 
     # Error handling route for validation error
     @app.errorhandler(ValidationError)
     def validation_error(err):
         return {"error": err.messages}, 400
 
+    # Error handling route for saturated password hashing pool
+    @app.errorhandler(HasherBusyError)
+    def hasher_busy_error(err):
+        return {"error": str(err)}, 503, {"Retry-After": "1"}
+
+    # Error handling route for no database connection free within DB_POOL_TIMEOUT
+    @app.errorhandler(PoolTimeoutError)
+    def pool_timeout_error(err):
+        return {"error": "database busy, try again shortly"}, 503, {"Retry-After": "1"}
+
+    # Error handling route for group commit queue not written within GROUP_COMMIT_TIMEOUT
+    @app.errorhandler(GroupCommitBusyError)
+    def group_commit_busy_error(err):
+        return {"error": str(err)}, 503, {"Retry-After": "1"}
+
+    # Error handling route for invalid pagination cursor or limit
+    from pagination import PaginationError
+    @app.errorhandler(PaginationError)
+    def pagination_error(err):
+        return {"error": str(err)}, 400
+
     # Import and register controller blueprints
     from controllers.cli_controller import db_commands
     app.register_blueprint(db_commands)
 
+    from controllers.bench_controller import bench_commands
+    app.register_blueprint(bench_commands)
+
     from controllers.auth_controller import auth_bp
     app.register_blueprint(auth_bp)
 
@@ -54,9 +111,37 @@ def create_app():
     from controllers.channel_controller import channel_bp
     app.register_blueprint(channel_bp)
 
-    from controllers.message_controller import message_bp, message_user_bp, message_channel_bp
+    from controllers.message_controller import message_bp, message_user_bp, message_channel_bp, message_server_bp
     app.register_blueprint(message_bp)
     app.register_blueprint(message_user_bp)
     app.register_blueprint(message_channel_bp)
+    app.register_blueprint(message_server_bp)
+
+    from controllers.deletion_controller import deletion_bp
+    app.register_blueprint(deletion_bp)
+
+    from controllers.metrics_controller import metrics_bp, health_bp
+    app.register_blueprint(metrics_bp)
+    app.register_blueprint(health_bp)
+
+    # Compile list serializers once models are loaded
+    import serializer
+    serializer.init_app(app)
+
+    # Keep version columns current for conditional GETs
+    import versioning
+    versioning.init_app(app)
+
+    # Keep unread counts on read markers current
+    import read_markers
+    read_markers.init_app(app)
+
+    # Keep member and message counters current
+    import counters
+    counters.init_app(app)
+
+    # Delete large servers and users in the background
+    from deletions import deleter
+    deleter.init_app(app)
 
     return app
\ No newline at end of file
@@ -0,0 +1,163 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# Cached view of a ServerMember row, enough for membership and admin checks
+CachedMember = namedtuple("CachedMember", ["member_id", "is_admin"])
+
+# Returned by backends when a key is not cached (None means "not a member")
+MISSING = object()
+
+# In-process LRU cache where every entry also expires after ttl seconds
+class LocalBackend:
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+# Cache shared between workers, stored in any client with redis style get/set/delete
+class SharedBackend:
+    def __init__(self, client, ttl=60, prefix="membership"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        # Evictions happen inside the shared store and are not visible here
+        self.evictions = 0
+
+    def _key(self, key):
+        return f"{self.prefix}:{key[0]}:{key[1]}"
+
+    def get(self, key):
+        raw = self.client.get(self._key(key))
+        if raw is None:
+            return MISSING
+        member = json.loads(raw)
+        return CachedMember(*member) if member else None
+
+    def set(self, key, value):
+        self.client.set(self._key(key), json.dumps(list(value) if value else None), ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def __len__(self):
+        return 0
+
+# Local stand-in for a shared store such as redis, used for development and tests
+class LocalSharedClient:
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            entry = self._values.get(name)
+            if entry is None or (entry[1] is not None and entry[1] < time.monotonic()):
+                self._values.pop(name, None)
+                return None
+            return entry[0]
+
+    def set(self, name, value, ex=None):
+        with self._lock:
+            self._values[name] = (value, time.monotonic() + ex if ex else None)
+
+    def delete(self, name):
+        with self._lock:
+            self._values.pop(name, None)
+
+    def incr(self, name):
+        with self._lock:
+            value, expires_at = self._values.get(name, (0, None))
+            self._values[name] = (int(value) + 1, expires_at)
+            return int(value) + 1
+
+# Membership and role cache keyed by (user_id, server_id)
+class MembershipCache:
+    def __init__(self, backend=None):
+        self.backend = backend or LocalBackend()
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+
+    # Configure cache from environment variables when the app is created
+    def init_app(self, app):
+        self.enabled = os.environ.get("MEMBERSHIP_CACHE_ENABLED", "1") != "0"
+        size = int(os.environ.get("MEMBERSHIP_CACHE_SIZE", 10000))
+        ttl = int(os.environ.get("MEMBERSHIP_CACHE_TTL", 60))
+        backend = os.environ.get("MEMBERSHIP_CACHE_BACKEND", "local")
+        if backend == "local":
+            self.backend = LocalBackend(maxsize=size, ttl=ttl)
+        elif backend == "shared-local":
+            self.backend = SharedBackend(LocalSharedClient(), ttl=ttl)
+        else:
+            # Any other value is treated as a redis url, redis is only needed when used
+            import redis
+            self.backend = SharedBackend(redis.Redis.from_url(backend), ttl=ttl)
+        app.extensions["membership_cache"] = self
+
+    @staticmethod
+    def _key(user_id, server_id):
+        return (int(user_id), int(server_id))
+
+    # Return cached membership, None for a cached non-member, or MISSING
+    def get(self, user_id, server_id):
+        if not self.enabled:
+            return MISSING
+        value = self.backend.get(self._key(user_id, server_id))
+        if value is MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    # Store membership row (or None when user is not a member)
+    def set(self, user_id, server_id, server_member):
+        if not self.enabled:
+            return
+        value = CachedMember(server_member.member_id, bool(server_member.is_admin)) if server_member else None
+        self.backend.set(self._key(user_id, server_id), value)
+
+    # Drop cached membership after it changes in the database
+    def invalidate(self, user_id, server_id):
+        self.backend.delete(self._key(user_id, server_id))
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.backend.evictions,
+            "size": len(self.backend)
+        }
+
+membership_cache = MembershipCache()
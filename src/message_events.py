@@ -0,0 +1,167 @@
+import itertools
+import json
+import os
+import queue
+import threading
+from collections import deque
+
+# Number of recent events kept per channel so reconnecting clients can catch up
+HISTORY_SIZE = 500
+
+# Events waiting for one slow subscriber before it is told to reload
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+# A published change to a channel, seq orders events within the channel
+class MessageEvent:
+    def __init__(self, seq, kind, data):
+        self.seq = seq
+        self.kind = kind
+        self.data = data
+
+    def to_json(self):
+        return json.dumps({"seq": self.seq, "kind": self.kind, "data": self.data})
+
+    @classmethod
+    def from_json(cls, raw):
+        values = json.loads(raw)
+        return cls(values["seq"], values["kind"], values["data"])
+
+# Events in history after last_seq, or None when history has a gap before them
+# (events already dropped, or last_seq came from before the history was reset)
+def _events_after(history, last_seq):
+    latest = history[-1].seq if history else 0
+    if last_seq > latest or (history and history[0].seq > last_seq + 1):
+        return None
+    return [event for event in history if event.seq > last_seq]
+
+# Events for one channel delivered to one stream
+class LocalSubscription:
+    def __init__(self, broker, channel_id):
+        self.broker = broker
+        self.channel_id = channel_id
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    # Return next event, or None when nothing arrived within timeout seconds
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+# In-process pub/sub, enough for a single worker and the stand-in for a shared broker in development
+class LocalBroker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+        self._history = {}
+        self._sequence = {}
+
+    def publish(self, channel_id, kind, data):
+        with self._lock:
+            counter = self._sequence.setdefault(channel_id, itertools.count(1))
+            event = MessageEvent(next(counter), kind, data)
+            self._history.setdefault(channel_id, deque(maxlen=HISTORY_SIZE)).append(event)
+            subscriptions = list(self._subscriptions.get(channel_id, ()))
+        for subscription in subscriptions:
+            subscription.put(event)
+        return event
+
+    def subscribe(self, channel_id):
+        subscription = LocalSubscription(self, channel_id)
+        with self._lock:
+            self._subscriptions.setdefault(channel_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.get(subscription.channel_id, set()).discard(subscription)
+
+    # Events after last_seq, or None when history no longer reaches back that far
+    def replay(self, channel_id, last_seq):
+        with self._lock:
+            history = list(self._history.get(channel_id, ()))
+        return _events_after(history, last_seq)
+
+# Events for one channel read from redis pub/sub
+class RedisSubscription:
+    def __init__(self, broker, channel_id):
+        self.broker = broker
+        self.channel_id = channel_id
+        self.overflowed = False
+        self.pubsub = broker.client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(broker.key(channel_id, "events"))
+
+    def get(self, timeout):
+        message = self.pubsub.get_message(timeout=timeout)
+        if message is None:
+            return None
+        return MessageEvent.from_json(message["data"])
+
+    def close(self):
+        self.pubsub.close()
+
+# Shared broker so every worker sees events committed by the others
+class RedisBroker:
+    def __init__(self, client, prefix="channel"):
+        self.client = client
+        self.prefix = prefix
+
+    def key(self, channel_id, name):
+        return f"{self.prefix}:{channel_id}:{name}"
+
+    def publish(self, channel_id, kind, data):
+        seq = self.client.incr(self.key(channel_id, "seq"))
+        event = MessageEvent(seq, kind, data)
+        raw = event.to_json()
+        pipeline = self.client.pipeline()
+        pipeline.rpush(self.key(channel_id, "history"), raw)
+        pipeline.ltrim(self.key(channel_id, "history"), -HISTORY_SIZE, -1)
+        pipeline.publish(self.key(channel_id, "events"), raw)
+        pipeline.execute()
+        return event
+
+    def subscribe(self, channel_id):
+        return RedisSubscription(self, channel_id)
+
+    def replay(self, channel_id, last_seq):
+        history = [MessageEvent.from_json(raw) for raw in self.client.lrange(self.key(channel_id, "history"), 0, -1)]
+        return _events_after(history, last_seq)
+
+# Broker chosen by MESSAGE_BROKER, "local" or a redis url
+class MessageEvents:
+    def __init__(self):
+        self.broker = LocalBroker()
+
+    def init_app(self, app):
+        backend = os.environ.get("MESSAGE_BROKER", "local")
+        if backend == "local":
+            self.broker = LocalBroker()
+        else:
+            # redis is only needed when a shared broker is configured
+            import redis
+            self.broker = RedisBroker(redis.Redis.from_url(backend, decode_responses=True))
+        app.extensions["message_events"] = self
+
+    # Publish a created, updated or deleted channel message after it is committed
+    def publish(self, channel_id, kind, data):
+        if channel_id is None:
+            return None
+        return self.broker.publish(channel_id, kind, data)
+
+    def subscribe(self, channel_id):
+        return self.broker.subscribe(channel_id)
+
+    def replay(self, channel_id, last_seq):
+        return self.broker.replay(channel_id, last_seq)
+
+message_events = MessageEvents()
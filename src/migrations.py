@@ -0,0 +1,313 @@
+from datetime import timedelta
+
+from sqlalchemy import bindparam, func, inspect, select, text, update
+
+from main import db
+from snowflake import EPOCH, LEGACY_ID_LIMIT, id_time, ids_for_times
+from versioning import utcnow
+
+# One row per migration applied to this database
+schema_migrations = db.Table(
+    "schema_migrations",
+    db.Column("version", db.Integer, primary_key=True),
+    db.Column("name", db.String, nullable=False),
+    db.Column("applied_at", db.DateTime, nullable=False)
+)
+
+# Raised when a migration cannot go ahead, with what to fix first
+class MigrationError(Exception):
+    pass
+
+# (version, name, function) in the order they are applied
+MIGRATIONS = []
+
+# Register a schema change, run by flask db upgrade on databases that have not had it yet
+# Each function gets the engine and must be safe to run again, since a run stopped part
+# way through is retried from the start of that migration
+def migration(version, name):
+    def decorator(fn):
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return decorator
+
+# Indexes the hot queries in the controllers rely on, checked by flask db index-report
+# (table, leading columns, what uses it)
+QUERY_INDEXES = (
+    ("server_members", ("server_id", "user_id"), "membership check on every server, channel and message route"),
+    ("server_members", ("user_id",), "servers of a user when their profile changes"),
+    ("servers", ("creator_user_id",), "view all servers"),
+    ("channels", ("server_id",), "view all channels"),
+    ("messages", ("channel_id", "message_id"), "channel message pages and unread recounts"),
+    ("messages", ("receiver_user_id", "message_id"), "direct message pages and unread recounts"),
+    ("messages", ("sender_user_id", "message_id"), "direct message search and deleting a user's messages"),
+    ("read_markers", ("user_id",), "unread counts of a user"),
+    ("read_markers", ("channel_id", "user_id"), "marking a channel read"),
+)
+
+# Build an index without blocking writes, using names an index method other than btree (Postgres only)
+# Postgres builds it CONCURRENTLY outside a transaction. A failed concurrent build leaves an
+# invalid index behind that IF NOT EXISTS would keep, so it is dropped and built again
+def create_index(engine, name, table, columns, unique=False, using=None):
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    column_list = ", ".join(columns)
+    if engine.dialect.name != "postgresql":
+        with engine.begin() as connection:
+            connection.execute(text(f"CREATE {kind} IF NOT EXISTS {name} ON {table} ({column_list})"))
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        invalid = connection.scalar(text("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+                                    {"name": name})
+        if invalid:
+            connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        method = f"USING {using} " if using else ""
+        connection.execute(text(f"CREATE {kind} CONCURRENTLY IF NOT EXISTS {name} ON {table} {method}({column_list})"))
+
+# Turn a unique index into a constraint of the same name, Postgres only needs a brief lock for this
+# SQLite cannot add constraints to a table, the unique index enforces the same rule
+def add_unique_constraint(engine, name, table, columns):
+    create_index(engine, name, table, columns, unique=True)
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as connection:
+        exists = connection.scalar(text("SELECT 1 FROM pg_constraint WHERE conname = :name"), {"name": name})
+        if not exists:
+            connection.execute(text(f"ALTER TABLE {table} ADD CONSTRAINT {name} UNIQUE USING INDEX {name}"))
+
+@migration(1, "query indexes and unique membership")
+def _query_indexes(engine):
+    members = db.metadata.tables["server_members"]
+    with engine.connect() as connection:
+        duplicates = connection.scalar(select(func.count()).select_from(
+            select(members.c.server_id, members.c.user_id)
+            .group_by(members.c.server_id, members.c.user_id)
+            .having(func.count() > 1).subquery()
+        ))
+    if duplicates:
+        raise MigrationError(f"{duplicates} users are members of the same server more than once, "
+                             "remove the extra server_members rows and run upgrade again")
+    add_unique_constraint(engine, "uq_server_members_server_id_user_id", "server_members", ("server_id", "user_id"))
+    create_index(engine, "ix_server_members_user_id", "server_members", ("user_id",))
+    create_index(engine, "ix_servers_creator_user_id", "servers", ("creator_user_id",))
+    create_index(engine, "ix_channels_server_id", "channels", ("server_id",))
+    create_index(engine, "ix_messages_channel_id_message_id", "messages", ("channel_id", "message_id"))
+    create_index(engine, "ix_messages_receiver_user_id_message_id", "messages", ("receiver_user_id", "message_id"))
+    create_index(engine, "ix_messages_sender_user_id_message_id", "messages", ("sender_user_id", "message_id"))
+
+# Tables and columns added to the models since the first release
+# New columns either allow NULL or have a constant default, which Postgres adds without rewriting the table
+@migration(2, "tables and columns added since first release")
+def _model_columns(engine):
+    db.metadata.create_all(engine, checkfirst=True)
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                definition = f"{column.name} {column.type.compile(dialect=engine.dialect)}"
+                if column.server_default is not None:
+                    definition += f" DEFAULT {column.server_default.arg}"
+                    if not column.nullable:
+                        definition += " NOT NULL"
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {definition}"))
+
+# Foreign keys that delete their rows with the row they point at, so a server or user delete
+# no longer needs the ORM to load and delete every child
+# Each constraint is swapped in a short transaction as NOT VALID, then validated without blocking writes
+# SQLite cannot change constraints, the deleter removes children itself there
+@migration(3, "deletion jobs and cascading foreign keys")
+def _cascading_foreign_keys(engine):
+    _model_columns(engine)
+    if engine.dialect.name != "postgresql":
+        return
+    inspector = inspect(engine)
+    for table in db.metadata.sorted_tables:
+        existing = inspector.get_foreign_keys(table.name)
+        for foreign_key in table.foreign_keys:
+            if foreign_key.ondelete != "CASCADE":
+                continue
+            column = foreign_key.parent.name
+            current = next((constraint for constraint in existing if constraint["constrained_columns"] == [column]), None)
+            if current and (current.get("options") or {}).get("ondelete", "").upper() == "CASCADE":
+                continue
+            name = current["name"] if current else f"{table.name}_{column}_fkey"
+            target = foreign_key.column
+            with engine.begin() as connection:
+                # Give up rather than queue behind a long transaction and block everything after it
+                connection.execute(text("SET LOCAL lock_timeout = '5s'"))
+                if current:
+                    connection.execute(text(f"ALTER TABLE {table.name} DROP CONSTRAINT {name}"))
+                connection.execute(text(
+                    f"ALTER TABLE {table.name} ADD CONSTRAINT {name} FOREIGN KEY ({column}) "
+                    f"REFERENCES {target.table.name} ({target.name}) ON DELETE CASCADE NOT VALID"
+                ))
+            with engine.begin() as connection:
+                connection.execute(text(f"ALTER TABLE {table.name} VALIDATE CONSTRAINT {name}"))
+
+# Move existing messages to time ordered ids made from their timestamps, in their existing order
+# Postgres widens message_id to BIGINT, which rewrites the table under an exclusive lock, so run it
+# with the app stopped. Everything happens in one transaction, so a failed run changes nothing and
+# running it again only picks up rows that still have ids from the old sequence
+# Returns how many messages were given new ids
+def time_ordered_message_ids(engine, batch_size=10000):
+    messages = db.metadata.tables["messages"]
+    with engine.begin() as connection:
+        if engine.dialect.name == "postgresql":
+            id_type = connection.scalar(text("SELECT data_type FROM information_schema.columns "
+                                             "WHERE table_name = 'messages' AND column_name = 'message_id'"))
+            if id_type != "bigint":
+                # Ids are made by the app now and no longer fit in 32 bits
+                connection.execute(text("ALTER TABLE messages ALTER COLUMN message_id DROP DEFAULT, "
+                                        "ALTER COLUMN message_id TYPE BIGINT"))
+                connection.execute(text("DROP SEQUENCE IF EXISTS messages_message_id_seq"))
+        # History is paged on message_id alone, replace the indexes that included timestamp
+        for name in ("ix_messages_channel_id_timestamp", "ix_messages_receiver_user_id_timestamp"):
+            connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        for index in messages.indexes:
+            index.create(connection, checkfirst=True)
+        # Old sequence ids are far below any time ordered id, which starts above 2^31 one second after EPOCH
+        floor = EPOCH + timedelta(seconds=1)
+        rows = connection.execute(
+            select(messages.c.message_id, messages.c.timestamp)
+            .where(messages.c.message_id < LEGACY_ID_LIMIT)
+            .order_by(messages.c.timestamp, messages.c.message_id)
+        ).all()
+        # Old timestamps are naive local times and are treated as UTC
+        new_ids = ids_for_times(max(timestamp or floor, floor) for _, timestamp in rows)
+        stmt = (update(messages).where(messages.c.message_id == bindparam("old_id"))
+                .values(message_id=bindparam("new_id"), timestamp=bindparam("new_timestamp")))
+        batch = []
+        for (old_id, _), new_id in zip(rows, new_ids):
+            batch.append({"old_id": old_id, "new_id": new_id, "new_timestamp": id_time(new_id)})
+            if len(batch) == batch_size:
+                connection.execute(stmt, batch)
+                batch = []
+        if batch:
+            connection.execute(stmt, batch)
+    return len(rows)
+
+# Comes before the partition migration, which needs message_id to be BIGINT like the new parent table
+@migration(4, "time ordered 64-bit message ids")
+def _message_ids(engine):
+    time_ordered_message_ids(engine)
+
+# Full text search objects the models create along with the messages table (see models/message.py)
+# Postgres adds the generated search_vector column, which rewrites the table, then builds its GIN index
+# without blocking writes. SQLite adds the FTS5 table and its triggers and fills it from messages
+@migration(5, "message search index")
+def _message_search(engine):
+    from models.message import FTS_DDL, SEARCH_VECTOR_DDL
+    inspector = inspect(engine)
+    if engine.dialect.name == "postgresql":
+        if "search_vector" not in {column["name"] for column in inspector.get_columns("messages")}:
+            with engine.begin() as connection:
+                connection.execute(text("SET LOCAL lock_timeout = '5s'"))
+                connection.execute(text(SEARCH_VECTOR_DDL))
+        create_index(engine, "ix_messages_search_vector", "messages", ("search_vector",), using="GIN")
+    elif engine.dialect.name == "sqlite" and "messages_fts" not in inspector.get_table_names():
+        with engine.begin() as connection:
+            for statement in FTS_DDL:
+                connection.execute(text(statement))
+            connection.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+
+# Split messages into monthly partitions, and add message_retention_days to servers
+# The existing table becomes one partition holding everything up to the month after next, so nothing is
+# copied. Its bounds are checked first while writes carry on, then the swap itself only needs a brief lock
+# Runs after the id and search migrations, since ATTACH needs the same columns as the new parent table
+@migration(6, "monthly message partitions and message retention")
+def _partitioned_messages(engine):
+    from partitions import add_months, ensure_partitions, is_partitioned, month_of, month_partition
+    _model_columns(engine)
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.connect() as connection:
+        partitioned = is_partitioned(connection)
+    if not partitioned:
+        high = month_partition(add_months(month_of(utcnow()), 2)).low
+        with engine.begin() as connection:
+            connection.execute(text("SET LOCAL lock_timeout = '5s'"))
+            connection.execute(text("ALTER TABLE messages DROP CONSTRAINT IF EXISTS messages_legacy_bounds"))
+            connection.execute(text(f"ALTER TABLE messages ADD CONSTRAINT messages_legacy_bounds "
+                                    f"CHECK (message_id < {high}) NOT VALID"))
+        with engine.begin() as connection:
+            connection.execute(text("ALTER TABLE messages VALIDATE CONSTRAINT messages_legacy_bounds"))
+        with engine.begin() as connection:
+            connection.execute(text("SET LOCAL lock_timeout = '5s'"))
+            connection.execute(text("ALTER TABLE messages RENAME TO messages_legacy"))
+            # Index names are shared across tables, the new parent table takes the current ones
+            index_names = connection.execute(text(
+                "SELECT indexname FROM pg_indexes WHERE tablename = 'messages_legacy'"
+            )).scalars().all()
+            for index_name in index_names:
+                connection.execute(text(f"ALTER INDEX {index_name} "
+                                        f"RENAME TO {index_name.replace('messages', 'messages_legacy', 1)}"))
+            db.metadata.tables["messages"].create(connection)
+            # Matching indexes and foreign keys of the old table are attached as they are, not built again
+            connection.execute(text(f"ALTER TABLE messages ATTACH PARTITION messages_legacy "
+                                    f"FOR VALUES FROM (MINVALUE) TO ({high})"))
+            connection.execute(text("ALTER TABLE messages_legacy DROP CONSTRAINT messages_legacy_bounds"))
+    ensure_partitions(engine)
+
+# Add the channel list version to servers, conditional channel lists read it instead of every channel
+@migration(7, "channel list versions")
+def _channel_list_versions(engine):
+    _model_columns(engine)
+
+# Versions already applied to the database
+def applied_versions(engine):
+    schema_migrations.create(engine, checkfirst=True)
+    with engine.connect() as connection:
+        return set(connection.execute(select(schema_migrations.c.version)).scalars())
+
+def _record(engine, version, name):
+    with engine.begin() as connection:
+        connection.execute(schema_migrations.insert().values(version=version, name=name, applied_at=utcnow()))
+
+# Apply every migration the database has not had yet, in order, returning the names applied
+def upgrade(engine):
+    done = applied_versions(engine)
+    applied = []
+    for version, name, fn in sorted(MIGRATIONS):
+        if version in done:
+            continue
+        fn(engine)
+        _record(engine, version, name)
+        applied.append(name)
+    return applied
+
+# Record every migration as applied, for databases built from the current models by flask db create
+def stamp(engine):
+    done = applied_versions(engine)
+    for version, name, _ in sorted(MIGRATIONS):
+        if version not in done:
+            _record(engine, version, name)
+
+# Leading columns of every index, unique constraint and primary key on table
+def _indexed_columns(inspector, table):
+    indexed = [tuple(index["column_names"]) for index in inspector.get_indexes(table)]
+    indexed += [tuple(constraint["column_names"]) for constraint in inspector.get_unique_constraints(table)]
+    indexed.append(tuple(inspector.get_pk_constraint(table)["constrained_columns"]))
+    return indexed
+
+# Compare the database against QUERY_INDEXES
+# Returns the missing (table, columns, used by) entries, and on Postgres the
+# (index, table, scans, size) of non-unique indexes with no scans since statistics were reset
+def index_report(engine):
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table, columns, used_by in QUERY_INDEXES:
+        indexed = _indexed_columns(inspector, table) if table in tables else []
+        if not any(existing[:len(columns)] == columns for existing in indexed):
+            missing.append((table, columns, used_by))
+    unused = []
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as connection:
+            unused = connection.execute(text(
+                "SELECT s.indexrelname, s.relname, s.idx_scan, pg_size_pretty(pg_relation_size(s.indexrelid)) "
+                "FROM pg_stat_user_indexes s JOIN pg_index i ON i.indexrelid = s.indexrelid "
+                "WHERE s.idx_scan = 0 AND NOT i.indisunique AND NOT i.indisprimary "
+                "ORDER BY pg_relation_size(s.indexrelid) DESC"
+            )).all()
+    return missing, unused
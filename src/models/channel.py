@@ -1,7 +1,9 @@
 from marshmallow import fields
 from marshmallow.validate import Length
 
-from main import db, ma
+from main import db
+from request_timing import TimedSchema
+from versioning import utcnow
 
 # Create Channel model in database
 class Channel(db.Model):
@@ -13,18 +15,26 @@ class Channel(db.Model):
     channel_id = db.Column(db.Integer, primary_key=True)
     channel_name = db.Column(db.String, nullable=False)
     created_on = db.Column(db.Date)
+    # Kept current on post and delete (see counters.py)
+    message_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    last_message_at = db.Column(db.DateTime)
+
+    # Bumped on every change to channel and its messages (see versioning.py)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    updated_at = db.Column(db.DateTime, default=utcnow)
 
     # Define foreign keys and relationships
-    creator_user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), nullable=False)
+    creator_user_id = db.Column(db.Integer, db.ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False)
     user = db.relationship("User", back_populates ="channels")
 
-    server_id = db.Column(db.Integer, db.ForeignKey("servers.server_id"), nullable=False)
+    server_id = db.Column(db.Integer, db.ForeignKey("servers.server_id", ondelete="CASCADE"), nullable=False, index=True)
     server = db.relationship("Server", back_populates="channels")
 
-    messages = db.relationship("Message", back_populates="channel", cascade="all, delete")
+    messages = db.relationship("Message", back_populates="channel", cascade="all, delete", passive_deletes=True)
+    read_markers = db.relationship("ReadMarker", back_populates="channel", cascade="all, delete", passive_deletes=True)
 
 # Schema for Channel model
-class ChannelSchema(ma.Schema):
+class ChannelSchema(TimedSchema):
 
     # Define nested fields
     user = fields.Nested("UserSchema", only=["user_id", "username"])
@@ -35,7 +45,9 @@ class ChannelSchema(ma.Schema):
     channel_name = fields.String(validate=Length(min=5, error="must be at least 5 characters long"))
 
     class Meta:
-        fields = ("channel_id", "channel_name", "created_on", "user", "server", "messages")
+        fields = ("channel_id", "channel_name", "created_on", "message_count", "last_message_at",
+                  "user", "server", "messages")
+        dump_only = ("message_count", "last_message_at")
 
 # To handle single channel object
 channel_schema = ChannelSchema()
@@ -0,0 +1,42 @@
+from main import db
+from request_timing import TimedSchema
+from versioning import utcnow
+
+# Create DeletionJob model in database
+# One row per server or user being deleted in batches (see deletions.py)
+class DeletionJob(db.Model):
+
+    # Define table name
+    __tablename__ = "deletion_jobs"
+
+    # Define column name and attributes
+    job_id = db.Column(db.Integer, primary_key=True)
+    # "server" or "user"
+    kind = db.Column(db.String, nullable=False)
+    # Not a foreign key, the row it points at is gone once the job is done
+    target_id = db.Column(db.Integer, nullable=False)
+    requested_by_user_id = db.Column(db.Integer, nullable=False)
+    # "pending", "running", "done" or "failed"
+    status = db.Column(db.String, nullable=False, default="pending")
+    estimated_rows = db.Column(db.Integer)
+    deleted_rows = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String)
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+    # Refreshed after every batch, a running job not heard from in a while is picked up again
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    # Define index used to find the next job to run
+    __table_args__ = (
+        db.Index("ix_deletion_jobs_status_job_id", "status", "job_id"),
+    )
+
+# Schema for DeletionJob model
+class DeletionJobSchema(TimedSchema):
+
+    class Meta:
+        fields = ("job_id", "kind", "target_id", "status", "estimated_rows", "deleted_rows", "error",
+                  "created_at", "finished_at")
+
+# To handle single deletion job object
+deletion_job_schema = DeletionJobSchema()
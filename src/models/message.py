@@ -1,6 +1,14 @@
 from marshmallow import fields
+from sqlalchemy import DDL, event
 
-from main import db, ma
+from main import db
+from request_timing import TimedSchema
+from versioning import utcnow
+from snowflake import id_time, next_id
+
+# Column default for timestamp, message_id is filled in first
+def _timestamp_from_id(context):
+    return id_time(context.get_current_parameters()["message_id"])
 
 # Create Message model in database
 class Message(db.Model):
@@ -9,27 +17,85 @@ class Message(db.Model):
     __tablename__ = "messages"
 
     # Define column name and attributes
-    message_id = db.Column(db.Integer, primary_key=True)
+    # Time ordered 64-bit ids made by the app (see snowflake.py), history is ordered by id alone
+    # SQLite keeps INTEGER so the id stays the rowid
+    message_id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True,
+                           autoincrement=False, default=next_id)
     title = db.Column(db.String, nullable=True)
     content = db.Column(db.String, nullable=False)
-    timestamp = db.Column(db.DateTime)
+    # Time the message was created, read from its id
+    timestamp = db.Column(db.DateTime, default=_timestamp_from_id)
+
+    # Bumped on every change to message (see versioning.py)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    updated_at = db.Column(db.DateTime, default=utcnow)
     
     # Define foreign keys and relationships
-    channel_id = db.Column(db.Integer, db.ForeignKey("channels.channel_id"), nullable=True)
+    channel_id = db.Column(db.Integer, db.ForeignKey("channels.channel_id", ondelete="CASCADE"), nullable=True)
     channel = db.relationship("Channel", back_populates="messages")
 
-    sender_user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), nullable=False)
+    sender_user_id = db.Column(db.Integer, db.ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False)
     sender_user = db.relationship("User",
                                   foreign_keys=[sender_user_id],
                                   back_populates="messages_sender")
 
-    receiver_user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), nullable=True)
+    receiver_user_id = db.Column(db.Integer, db.ForeignKey("users.user_id", ondelete="CASCADE"), nullable=True)
     receiver_user = db.relationship("User",
                                     foreign_keys=[receiver_user_id],
                                     back_populates="messages_receiver")
 
+    # Define composite indexes used to page through message history
+    # Postgres splits the table into monthly partitions by message_id, which is ordered by time (see partitions.py)
+    __table_args__ = (
+        db.Index("ix_messages_channel_id_message_id", "channel_id", "message_id"),
+        db.Index("ix_messages_receiver_user_id_message_id", "receiver_user_id", "message_id"),
+        db.Index("ix_messages_sender_user_id_message_id", "sender_user_id", "message_id"),
+        {"postgresql_partition_by": "RANGE (message_id)"}
+    )
+
+# Text search configuration used to build and query the Postgres search vector
+SEARCH_CONFIG = "english"
+
+# Full text search index, kept up to date by the database on insert, update and delete
+# Also added to existing databases by a migration (see migrations.py)
+# Postgres: generated tsvector column with a GIN index
+SEARCH_VECTOR_DDL = ("ALTER TABLE messages ADD COLUMN search_vector tsvector GENERATED ALWAYS AS "
+                     f"(to_tsvector('{SEARCH_CONFIG}', coalesce(title, '') || ' ' || content)) STORED")
+event.listen(Message.__table__, "after_create", DDL(SEARCH_VECTOR_DDL).execute_if(dialect="postgresql"))
+event.listen(Message.__table__, "after_create", DDL(
+    "CREATE INDEX ix_messages_search_vector ON messages USING GIN (search_vector)"
+).execute_if(dialect="postgresql"))
+
+# Partition for messages outside every monthly partition, so inserts never fail for want of one
+# Monthly partitions are added ahead of time and take their rows out of it (see partitions.py)
+event.listen(Message.__table__, "after_create", DDL(
+    "CREATE TABLE messages_default PARTITION OF messages DEFAULT"
+).execute_if(dialect="postgresql"))
+
+# SQLite: FTS5 table over messages, synced by triggers
+FTS_DDL = (
+    "CREATE VIRTUAL TABLE messages_fts USING fts5(title, content, content='messages', content_rowid='message_id')",
+    "CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts(rowid, title, content) VALUES (new.message_id, new.title, new.content); END",
+    "CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, title, content) "
+    "VALUES ('delete', old.message_id, old.title, old.content); END",
+    "CREATE TRIGGER messages_fts_update AFTER UPDATE ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, title, content) "
+    "VALUES ('delete', old.message_id, old.title, old.content); "
+    "INSERT INTO messages_fts(rowid, title, content) VALUES (new.message_id, new.title, new.content); END"
+)
+for statement in FTS_DDL:
+    event.listen(Message.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+event.listen(Message.__table__, "before_drop", DDL(
+    "DROP TABLE IF EXISTS messages_fts"
+).execute_if(dialect="sqlite"))
+
 # Schema for Message model
-class MessageSchema(ma.Schema):
+class MessageSchema(TimedSchema):
+
+    # Ids go past 2^53, where JavaScript numbers lose precision, so they are sent as strings
+    message_id = fields.Integer(as_string=True)
 
     # Define nested fields
     channel = fields.Nested("ChannelSchema", only=["channel_id", "channel_name"])
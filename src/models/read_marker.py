@@ -0,0 +1,55 @@
+from marshmallow import fields
+
+from main import db
+from request_timing import TimedSchema
+
+# Create ReadMarker model in database
+# One row per user per channel in their servers, and per user they have direct messages from
+class ReadMarker(db.Model):
+
+    # Define table name
+    __tablename__ = "read_markers"
+
+    # Define column name and attributes
+    marker_id = db.Column(db.Integer, primary_key=True)
+    # Messages up to and including this id have been read
+    last_read_message_id = db.Column(db.BigInteger, nullable=False, default=0)
+    # Messages after last_read_message_id not sent by user, kept up to date on post and delete
+    unread_count = db.Column(db.Integer, nullable=False, default=0)
+
+    # Define foreign keys and relationships
+    user_id = db.Column(db.Integer, db.ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False, index=True)
+    user = db.relationship("User", foreign_keys=[user_id], back_populates="read_markers")
+
+    # Set for a channel marker
+    channel_id = db.Column(db.Integer, db.ForeignKey("channels.channel_id", ondelete="CASCADE"), nullable=True)
+    channel = db.relationship("Channel", back_populates="read_markers")
+
+    # Set for a direct message marker, the user whose messages are counted
+    peer_user_id = db.Column(db.Integer, db.ForeignKey("users.user_id", ondelete="CASCADE"), nullable=True)
+    peer_user = db.relationship("User", foreign_keys=[peer_user_id], back_populates="peer_read_markers")
+
+    # Define unique constraints, also used to find the marker to update
+    __table_args__ = (
+        db.UniqueConstraint("channel_id", "user_id", name="uq_read_markers_channel_id_user_id"),
+        db.UniqueConstraint("user_id", "peer_user_id", name="uq_read_markers_user_id_peer_user_id"),
+    )
+
+# Schema for ReadMarker model
+class ReadMarkerSchema(TimedSchema):
+
+    # Message ids are sent as strings, as in MessageSchema
+    last_read_message_id = fields.Integer(as_string=True)
+
+    # Define nested fields
+    channel = fields.Nested("ChannelSchema", only=["channel_id", "channel_name", "server"])
+    peer_user = fields.Nested("UserSchema", only=["user_id", "username"])
+
+    class Meta:
+        fields = ("last_read_message_id", "unread_count", "channel", "peer_user")
+
+# To handle single read marker object
+read_marker_schema = ReadMarkerSchema()
+
+# To handle list of read marker objects
+read_markers_schema = ReadMarkerSchema(many=True)
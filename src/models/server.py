@@ -1,7 +1,9 @@
 from marshmallow import fields
-from marshmallow.validate import Length
+from marshmallow.validate import Length, Range
 
-from main import db, ma
+from main import db
+from request_timing import TimedSchema
+from versioning import utcnow
 
 # Create Server model in database
 class Server(db.Model):
@@ -13,27 +15,46 @@ class Server(db.Model):
     server_id = db.Column(db.Integer, primary_key=True)
     server_name = db.Column(db.String, nullable=False)
     created_on = db.Column(db.Date)
+    # Kept current on join and leave (see counters.py)
+    member_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    # Set when deletion starts, the server is treated as gone from then on (see deletions.py)
+    deleted_at = db.Column(db.DateTime)
+    # Days channel messages are kept before being archived, MESSAGE_RETENTION_DAYS when not set (see partitions.py)
+    message_retention_days = db.Column(db.Integer)
+
+    # Bumped on every change to server, its channels and its members (see versioning.py)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    updated_at = db.Column(db.DateTime, default=utcnow)
+    # Bumped with the version of any of its channels, so the channel list is checked from this row alone
+    channels_version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    channels_updated_at = db.Column(db.DateTime, default=utcnow)
 
     # Define foreign keys and relationships
-    creator_user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), nullable=False)
+    creator_user_id = db.Column(db.Integer, db.ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False, index=True)
     user = db.relationship("User", back_populates="servers")
 
-    server_members = db.relationship("ServerMember", back_populates="server", cascade="all, delete")
-    channels = db.relationship("Channel", back_populates="server", cascade="all, delete")
+    server_members = db.relationship("ServerMember", back_populates="server", cascade="all, delete", passive_deletes=True)
+    channels = db.relationship("Channel", back_populates="server", cascade="all, delete", passive_deletes=True)
 
 # Schema for Server model
-class ServerSchema(ma.Schema):
+class ServerSchema(TimedSchema):
 
     # Define nested fields
     user = fields.Nested("UserSchema", only=["user_id", "username"])
     server_members = fields.List(fields.Nested("ServerMemberSchema", exclude=["server"]))
-    channels = fields.List(fields.Nested("ChannelSchema", exclude=["server", "user", "messages"]))
+    # Message counters change with every post without bumping the server's version, so they are only
+    # shown in channel responses, whose versions do change with them
+    channels = fields.List(fields.Nested("ChannelSchema", exclude=["server", "user", "messages", "message_count",
+                                                                   "last_message_at"]))
 
     # Define field validations
     server_name = fields.String(validate=Length(min=5, error="must be at least 5 characters long"))
+    message_retention_days = fields.Integer(allow_none=True, validate=Range(min=1, error="must be at least 1 day"))
 
     class Meta:
-        fields = ("server_id", "server_name", "created_on", "user", "server_members", "channels")
+        fields = ("server_id", "server_name", "created_on", "member_count", "message_retention_days", "user",
+                  "server_members", "channels")
+        dump_only = ("member_count",)
 
 # To handle single server object
 server_schema = ServerSchema()
@@ -1,6 +1,8 @@
 from marshmallow import fields
 
-from main import db, ma
+from main import db
+from request_timing import TimedSchema
+from versioning import utcnow
 
 # Create ServerMember model in database
 class ServerMember(db.Model):
@@ -12,16 +14,25 @@ class ServerMember(db.Model):
     member_id = db.Column(db.Integer, primary_key=True)
     joined_on = db.Column(db.Date)
     is_admin = db.Column(db.Boolean, default=False)
+
+    # Bumped on every change to member (see versioning.py)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    updated_at = db.Column(db.DateTime, default=utcnow)
     
     # Define foreign keys and relationships
-    server_id = db.Column(db.Integer, db.ForeignKey("servers.server_id"), nullable=False)
+    server_id = db.Column(db.Integer, db.ForeignKey("servers.server_id", ondelete="CASCADE"), nullable=False)
     server = db.relationship("Server", back_populates="server_members")
 
-    user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False, index=True)
     user = db.relationship("User", back_populates="server_members")
 
+    # A user can only be a member of a server once, also used for the membership check of every route
+    __table_args__ = (
+        db.UniqueConstraint("server_id", "user_id", name="uq_server_members_server_id_user_id"),
+    )
+
 # Schema for ServerMember model
-class ServerMemberSchema(ma.Schema):
+class ServerMemberSchema(TimedSchema):
 
     # Define nested fields
     server = fields.Nested("ServerSchema", only=["server_id", "server_name"])
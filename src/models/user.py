@@ -1,7 +1,8 @@
 from marshmallow import fields, ValidationError
 from marshmallow.validate import Regexp
 
-from main import db, ma
+from main import db
+from request_timing import TimedSchema
     
 # Create User model in database
 class User(db.Model):
@@ -16,20 +17,36 @@ class User(db.Model):
     password = db.Column(db.String, nullable=False)
     name = db.Column(db.String)
     status = db.Column(db.String, default="offline")
+    # Set when deletion starts, the user is treated as gone from then on (see deletions.py)
+    deleted_at = db.Column(db.DateTime)
 
     # Define foreign key relationships
-    servers = db.relationship("Server", back_populates="user", cascade="all, delete")
-    server_members = db.relationship("ServerMember", back_populates="user", cascade="all, delete")
-    channels = db.relationship("Channel", back_populates="user", cascade="all, delete")
+    # Children are removed by ON DELETE CASCADE in the database, passive_deletes stops the ORM loading them first
+    servers = db.relationship("Server", back_populates="user", cascade="all, delete", passive_deletes=True)
+    server_members = db.relationship("ServerMember", back_populates="user", cascade="all, delete", passive_deletes=True)
+    channels = db.relationship("Channel", back_populates="user", cascade="all, delete", passive_deletes=True)
     
     messages_sender = db.relationship("Message",
                                       foreign_keys="[Message.sender_user_id]",
                                       back_populates="sender_user",
-                                      cascade="all, delete")
+                                      cascade="all, delete",
+                                      passive_deletes=True)
     messages_receiver = db.relationship("Message",
                                         foreign_keys="[Message.receiver_user_id]",
                                         back_populates="receiver_user",
-                                        cascade="all, delete")
+                                        cascade="all, delete",
+                                        passive_deletes=True)
+
+    read_markers = db.relationship("ReadMarker",
+                                   foreign_keys="[ReadMarker.user_id]",
+                                   back_populates="user",
+                                   cascade="all, delete",
+                                   passive_deletes=True)
+    peer_read_markers = db.relationship("ReadMarker",
+                                        foreign_keys="[ReadMarker.peer_user_id]",
+                                        back_populates="peer_user",
+                                        cascade="all, delete",
+                                        passive_deletes=True)
 
 VALID_STATUSES = ("online", "offline", "away")
 
@@ -38,7 +55,7 @@ def validate_status(status):
         raise ValidationError(f"must be one of: online, offline, away")
 
 # Schema for User model
-class UserSchema(ma.Schema):
+class UserSchema(TimedSchema):
 
     # Define nested fields
     servers = fields.List(fields.Nested("ServerSchema", exclude=["user"]))
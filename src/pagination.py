@@ -0,0 +1,78 @@
+import base64
+import binascii
+import json
+
+from flask import request
+
+from models.message import Message
+
+DEFAULT_PAGE_LIMIT = 50
+MAX_PAGE_LIMIT = 100
+
+# Raised when a cursor or limit in the query string cannot be used
+class PaginationError(Exception):
+    pass
+
+# Pack a list of json values into an opaque url safe cursor
+def encode_values(values):
+    raw = json.dumps(values).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+# Unpack a cursor made by encode_values
+def decode_values(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded))
+    except (binascii.Error, ValueError):
+        raise PaginationError(f"invalid cursor {cursor}")
+
+# Build an opaque cursor from the message_id of a message
+# The id is kept as a string, like in responses, so clients that decode it do not lose precision
+def encode_cursor(message):
+    return encode_values([str(message.message_id)])
+
+# Turn an opaque cursor back into a message_id, held as a string or (in older cursors) a number
+def decode_cursor(cursor):
+    try:
+        message_id, = decode_values(cursor)
+        return int(message_id)
+    except (ValueError, TypeError):
+        raise PaginationError(f"invalid cursor {cursor}")
+
+# Read ?before=, ?after= and ?limit= from the query string
+def page_args():
+    before = request.args.get("before")
+    after = request.args.get("after")
+    if before and after:
+        raise PaginationError("before and after cannot be used together")
+    try:
+        limit = int(request.args.get("limit", DEFAULT_PAGE_LIMIT))
+    except ValueError:
+        raise PaginationError("limit must be a number")
+    if limit < 1 or limit > MAX_PAGE_LIMIT:
+        raise PaginationError(f"limit must be between 1 and {MAX_PAGE_LIMIT}")
+    return before, after, limit
+
+# Fetch one page of messages, newest first, using message_id as the keyset
+# Ids are time ordered, so the query only ever touches limit + 1 rows of the
+# matching composite index and the cost of a page does not depend on how deep it is
+def paginate_messages(query, before=None, after=None, limit=DEFAULT_PAGE_LIMIT):
+    if after:
+        # Newer messages are read oldest first so the page sits right after the cursor
+        query = query.filter(Message.message_id > decode_cursor(after))
+        query = query.order_by(Message.message_id.asc())
+    else:
+        if before:
+            query = query.filter(Message.message_id < decode_cursor(before))
+        query = query.order_by(Message.message_id.desc())
+
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after:
+        rows.reverse()
+
+    # Cursors to keep walking back in time or to fetch anything newer
+    older_cursor = encode_cursor(rows[-1]) if rows and (has_more or after) else None
+    newer_cursor = encode_cursor(rows[0]) if rows else after
+    return rows, older_cursor, newer_cursor
@@ -0,0 +1,316 @@
+import gzip
+import json
+import os
+import re
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import and_, column, delete, exists, func, insert, not_, or_, select, table, text
+
+import counters
+import read_markers
+from snowflake import first_id_at, id_time
+from versioning import bump_versions, notify_committed, utcnow
+from models.server import Server
+from models.channel import Channel
+from models.message import Message
+
+messages = Message.__table__
+channels = Channel.__table__
+servers = Server.__table__
+
+# Columns copied when rows move between partitions, the search vector is generated from them
+COLUMNS = [message_column.name for message_column in messages.columns]
+
+DEFAULT_PARTITION = "messages_default"
+
+# Monthly partitions made ahead of the current month, so new messages never land in the default partition
+MONTHS_AHEAD = 3
+
+# A partition or month of messages, low and high are the message ids it covers (high not included)
+# low is None for the partition that holds everything from before partitioning
+Partition = namedtuple("Partition", ["name", "low", "high"])
+
+# What archiving one partition did
+Archived = namedtuple("Archived", ["name", "rows", "path", "dropped"])
+
+_BOUNDS = re.compile(r"FROM \((?:MINVALUE|'?(-?\d+)'?)\) TO \((?:MAXVALUE|'?(-?\d+)'?)\)")
+
+# First day of the month moment is in
+def month_of(moment):
+    return date(moment.year, moment.month, 1)
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+# Message ids made during month, from the first id at its start to the first id at the next month's start
+def month_partition(month):
+    following = add_months(month, 1)
+    return Partition(f"messages_y{month.year}m{month.month:02}",
+                     first_id_at(datetime(month.year, month.month, 1)),
+                     first_id_at(datetime(following.year, following.month, 1)))
+
+# Whether messages is a partitioned table, only ever on Postgres
+def is_partitioned(connection):
+    if connection.dialect.name != "postgresql":
+        return False
+    return bool(connection.scalar(text(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('messages')"
+    )))
+
+# Partitions of messages other than the default one, oldest first
+def list_partitions(connection):
+    rows = connection.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass('messages')"
+    ))
+    partitions = []
+    for name, bounds in rows:
+        match = _BOUNDS.search(bounds)
+        if match:
+            low, high = (int(bound) if bound is not None else None for bound in match.groups())
+            partitions.append(Partition(name, low, high))
+    return sorted(partitions, key=lambda partition: (partition.low is not None, partition.low or 0))
+
+def _overlaps(partition, other):
+    return ((other.low is None or other.low < partition.high) and
+            (other.high is None or partition.low < other.high))
+
+def _bound(value):
+    return "MINVALUE" if value is None else str(value)
+
+# Rows of messages with ids in partition's range, Postgres only reads that partition
+def _in_range(partition):
+    condition = messages.c.message_id < partition.high
+    if partition.low is not None:
+        condition = and_(messages.c.message_id >= partition.low, condition)
+    return condition
+
+# Make an empty table with the columns, indexes and foreign keys of messages, ready to become a partition
+# Foreign keys are checked here, where only the new table is locked, so ATTACH can reuse them as they are
+def _like_messages(connection, name):
+    connection.execute(text(f"CREATE TABLE {name} (LIKE messages INCLUDING ALL)"))
+    for foreign_key in sorted(messages.foreign_keys, key=lambda foreign_key: foreign_key.parent.name):
+        target = foreign_key.column
+        constraint = f"{name}_{foreign_key.parent.name}_fkey"
+        connection.execute(text(
+            f"ALTER TABLE {name} ADD CONSTRAINT {constraint} FOREIGN KEY ({foreign_key.parent.name}) "
+            f"REFERENCES {target.table.name} ({target.name}) ON DELETE {foreign_key.ondelete} NOT VALID"
+        ))
+        connection.execute(text(f"ALTER TABLE {name} VALIDATE CONSTRAINT {constraint}"))
+
+# Add and validate a CHECK constraint matching partition's bounds to table name, returning its name
+# With it in place ATTACH skips scanning the rows, so do this before taking any lock on messages
+def _add_bounds(connection, name, partition):
+    constraint = f"{name}_bounds"
+    connection.execute(text(
+        f"ALTER TABLE {name} ADD CONSTRAINT {constraint} CHECK (message_id < {partition.high}"
+        + (f" AND message_id >= {partition.low}) NOT VALID" if partition.low is not None else ") NOT VALID")
+    ))
+    connection.execute(text(f"ALTER TABLE {name} VALIDATE CONSTRAINT {constraint}"))
+    return constraint
+
+# Attach a table made by _like_messages as partition, then drop the bounds constraint it no longer needs
+def _attach(connection, name, partition, bounds):
+    connection.execute(text(f"ALTER TABLE messages ATTACH PARTITION {name} "
+                            f"FOR VALUES FROM ({_bound(partition.low)}) TO ({partition.high})"))
+    connection.execute(text(f"ALTER TABLE {name} DROP CONSTRAINT {bounds}"))
+
+# Make the partition for a month, moving in any of its rows the default partition took meanwhile
+def _create_partition(connection, partition):
+    column_list = ", ".join(COLUMNS)
+    _like_messages(connection, partition.name)
+    connection.execute(text(
+        f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+        f"WHERE message_id >= {partition.low} AND message_id < {partition.high} RETURNING {column_list}) "
+        f"INSERT INTO {partition.name} ({column_list}) SELECT {column_list} FROM moved"
+    ))
+    bounds = _add_bounds(connection, partition.name, partition)
+    _attach(connection, partition.name, partition, bounds)
+
+# Make monthly partitions up to months_ahead months after the current one, and for any month the
+# default partition holds rows of. Each partition is its own short transaction
+# Returns the names of partitions made, nothing happens unless messages is partitioned
+def ensure_partitions(engine, months_ahead=None):
+    if months_ahead is None:
+        months_ahead = int(os.environ.get("MESSAGE_PARTITIONS_AHEAD", MONTHS_AHEAD))
+    with engine.connect() as connection:
+        if not is_partitioned(connection):
+            return []
+        existing = list_partitions(connection)
+        oldest = connection.scalar(text(f"SELECT min(message_id) FROM {DEFAULT_PARTITION}"))
+        current = month_of(utcnow())
+        month = min(current, month_of(id_time(oldest))) if oldest is not None else current
+        wanted = []
+        while month <= add_months(current, months_ahead):
+            partition = month_partition(month)
+            if not any(_overlaps(partition, other) for other in existing):
+                # Past months only get a partition when the default partition has their rows
+                if month >= current or connection.scalar(text(
+                    f"SELECT 1 FROM {DEFAULT_PARTITION} "
+                    f"WHERE message_id >= {partition.low} AND message_id < {partition.high} LIMIT 1"
+                )):
+                    wanted.append(partition)
+            month = add_months(month, 1)
+    for partition in wanted:
+        with engine.begin() as connection:
+            connection.execute(text("SET LOCAL lock_timeout = '5s'"))
+            _create_partition(connection, partition)
+    return [partition.name for partition in wanted]
+
+# Messages past their retention for a range that ended age_days ago
+# Channel messages follow their server's message_retention_days, direct messages default_days
+# Never NULL, so not_() of it picks out exactly the rows that stay
+def _expired(age_days, default_days):
+    retention = servers.c.message_retention_days
+    if default_days is not None:
+        retention = func.coalesce(retention, default_days)
+    expired_channel_ids = (select(channels.c.channel_id)
+                           .join(servers, servers.c.server_id == channels.c.server_id)
+                           .where(retention <= age_days))
+    condition = and_(messages.c.channel_id.is_not(None), messages.c.channel_id.in_(expired_channel_ids))
+    if default_days is not None and default_days <= age_days:
+        condition = or_(condition, messages.c.channel_id.is_(None))
+    return condition
+
+# Server of each archived channel message, so one server's history can be restored on its own
+_server_id = (select(channels.c.server_id).where(channels.c.channel_id == messages.c.channel_id)
+              .correlate(messages).scalar_subquery().label("server_id"))
+
+# JSON for values json cannot write itself, dates as ISO 8601
+def json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"cannot archive {type(value).__name__}")
+
+# Write rows to a gzipped NDJSON file, one message per line
+# The file only appears under its final name once it is complete and on disk
+# Returns the path, how many rows, and the channels and (receiver, sender) conversations they came from
+def _write_archive(rows, archive_dir, name, now):
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}-{now:%Y%m%dT%H%M%S}.ndjson.gz")
+    count, channel_ids, direct_pairs = 0, set(), set()
+    with open(f"{path}.tmp", "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as archive:
+            for row in rows:
+                row = dict(row._mapping)
+                archive.write((json.dumps(row, default=json_default) + "\n").encode("utf-8"))
+                count += 1
+                if row["channel_id"] is not None:
+                    channel_ids.add(row["channel_id"])
+                elif row["receiver_user_id"] is not None:
+                    direct_pairs.add((row["receiver_user_id"], row["sender_user_id"]))
+        raw.flush()
+        os.fsync(raw.fileno())
+    if count:
+        os.replace(f"{path}.tmp", path)
+    else:
+        os.remove(f"{path}.tmp")
+    return path, count, channel_ids, direct_pairs
+
+# Swap partition for a copy holding only the rows that stay
+# Copying what is kept replaces deleting what expired, and the old table is dropped whole
+# The copy is made and its bounds checked before the swap, so the lock on messages is only held for a moment
+def _rewrite_partition(connection, partition, keep):
+    name = f"{partition.name}_keep"
+    _like_messages(connection, name)
+    connection.execute(insert(table(name, *(column(column_name) for column_name in COLUMNS))).from_select(
+        COLUMNS, select(*(messages.c[column_name] for column_name in COLUMNS)).where(_in_range(partition), keep)
+    ))
+    bounds = _add_bounds(connection, name, partition)
+    connection.execute(text(f"ALTER TABLE messages DETACH PARTITION {partition.name}"))
+    connection.execute(text(f"DROP TABLE {partition.name}"))
+    connection.execute(text(f"ALTER TABLE {name} RENAME TO {partition.name}"))
+    _attach(connection, partition.name, partition, bounds)
+
+# Archive the expired messages of one partition (or month, when messages is not partitioned) and remove them
+# Partitions whose rows have all expired are detached and dropped. Otherwise Postgres keeps a copy of the
+# rest, and unpartitioned tables delete the month's expired rows in one statement
+# Counters, unread counts and versions are fixed in a second transaction, so messages is not locked meanwhile
+def _archive_partition(engine, partition, partitioned, default_days, archive_dir, now):
+    age_days = (now - id_time(partition.high)).days
+    expired = and_(_in_range(partition), _expired(age_days, default_days))
+    archived_columns = [messages.c[column_name] for column_name in COLUMNS] + [_server_id]
+    dropped = False
+    with engine.begin() as connection:
+        if partitioned:
+            # Edits to messages of this month wait until it is archived, new messages go to the current month
+            connection.execute(text("SET LOCAL lock_timeout = '5s'"))
+            connection.execute(text(f"LOCK TABLE {partition.name} IN SHARE MODE"))
+            rows = connection.execute(select(*archived_columns).where(expired)
+                                      .order_by(messages.c.message_id).execution_options(yield_per=1000))
+        else:
+            rows = connection.execute(delete(messages).where(expired).returning(*archived_columns))
+        path, count, channel_ids, direct_pairs = _write_archive(rows, archive_dir, partition.name, now)
+        if not count:
+            return None
+        if partitioned:
+            if connection.scalar(select(exists().where(_in_range(partition), not_(expired)))):
+                _rewrite_partition(connection, partition, not_(expired))
+            else:
+                connection.execute(text(f"ALTER TABLE messages DETACH PARTITION {partition.name}"))
+                connection.execute(text(f"DROP TABLE {partition.name}"))
+                dropped = True
+    with engine.begin() as connection:
+        counters.recount_channels(connection, channel_ids)
+        read_markers.recount(connection, channel_ids, direct_pairs, before_id=partition.high)
+        scopes = bump_versions(connection, channel_ids=channel_ids)
+    notify_committed(scopes)
+    return Archived(partition.name, count, path, dropped)
+
+# Partitions, or months of an unpartitioned table, old enough that some of their messages may have expired
+def _candidates(connection, partitioned, shortest_days, now):
+    cutoff = first_id_at(now - timedelta(days=shortest_days))
+    if partitioned:
+        return [partition for partition in list_partitions(connection) if partition.high <= cutoff]
+    oldest = connection.scalar(select(func.min(messages.c.message_id)))
+    if oldest is None:
+        return []
+    month, candidates = month_of(id_time(oldest)), []
+    while month_partition(month).high <= cutoff:
+        candidates.append(month_partition(month))
+        month = add_months(month, 1)
+    return candidates
+
+# Retention in days of every server that sets one, and default_days for the rest and direct messages
+# Returns the shortest, None when every message is kept forever
+def _shortest_retention(connection, default_days):
+    retentions = connection.execute(select(servers.c.message_retention_days).distinct()
+                                    .where(servers.c.message_retention_days.is_not(None))).scalars().all()
+    return min([*retentions, *([default_days] if default_days is not None else [])], default=None)
+
+# Messages of each candidate partition that would be archived and kept, without changing anything
+def plan_archive(engine, default_days, now=None):
+    now = now or utcnow()
+    with engine.connect() as connection:
+        shortest = _shortest_retention(connection, default_days)
+        if shortest is None:
+            return []
+        partitioned = is_partitioned(connection)
+        plan = []
+        for partition in _candidates(connection, partitioned, shortest, now):
+            expired = _expired((now - id_time(partition.high)).days, default_days)
+            counts = connection.execute(select(
+                func.count().filter(expired), func.count().filter(not_(expired))
+            ).where(_in_range(partition))).one()
+            plan.append((partition.name, counts[0], counts[1]))
+        return plan
+
+# Archive and remove every message past its retention, oldest partition first, one transaction per partition
+# New monthly partitions are made first, so rows in the default partition are archived with their month
+def archive_expired(engine, default_days, archive_dir, now=None):
+    now = now or utcnow()
+    ensure_partitions(engine)
+    with engine.connect() as connection:
+        shortest = _shortest_retention(connection, default_days)
+        if shortest is None:
+            return []
+        partitioned = is_partitioned(connection)
+        candidates = _candidates(connection, partitioned, shortest, now)
+    archived = []
+    for partition in candidates:
+        result = _archive_partition(engine, partition, partitioned, default_days, archive_dir, now)
+        if result:
+            archived.append(result)
+    return archived
@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+import bcrypt
+
+from request_timing import add_timing
+
+# Upper bounds (in milliseconds) of the hash latency histogram buckets
+LATENCY_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000)
+
+# Raised when too many hashes are already waiting for the pool
+class HasherBusyError(Exception):
+    pass
+
+# Run in pool worker processes, so they only use the bcrypt library
+def _hash_password(password, rounds):
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+
+def _check_password(pw_hash, password):
+    return bcrypt.checkpw(password.encode("utf-8"), pw_hash.encode("utf-8"))
+
+# Hash and check passwords on a bounded process pool so bcrypt does not tie up request workers
+class PasswordHasher:
+    def __init__(self):
+        self.rounds = 12
+        self.pool_size = os.cpu_count() or 1
+        self.queue_limit = self.pool_size * 4
+        self.timeout = 10
+        self._pool = None
+        self._lock = threading.Lock()
+        self.queue_depth = 0
+        self.rejected = 0
+        self.hash_count = 0
+        self.hash_seconds = 0.0
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+
+    # Configure work factor, pool size and queue limit from environment variables
+    def init_app(self, app):
+        self.rounds = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))
+        self.pool_size = int(os.environ.get("BCRYPT_POOL_SIZE", os.cpu_count() or 1))
+        self.queue_limit = int(os.environ.get("BCRYPT_QUEUE_LIMIT", max(self.pool_size, 1) * 4))
+        self.timeout = float(os.environ.get("BCRYPT_TIMEOUT", 10))
+        # Keep Flask-Bcrypt (used by the cli seed command) on the same work factor
+        app.config["BCRYPT_LOG_ROUNDS"] = self.rounds
+        app.extensions["password_hasher"] = self
+
+    # Pool is started on first use so it is created inside each worker process
+    def _get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(max_workers=self.pool_size)
+        return self._pool
+
+    def _record_latency(self, seconds):
+        with self._lock:
+            self.hash_count += 1
+            self.hash_seconds += seconds
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds * 1000 <= bound:
+                    self.latency_buckets[index] += 1
+                    break
+
+    def _release(self, future=None):
+        with self._lock:
+            self.queue_depth -= 1
+
+    # Run fn on the pool, or inline when the pool is disabled with BCRYPT_POOL_SIZE=0
+    # A hash still counts towards queue_depth until the pool finishes or cancels it, even once
+    # its request has timed out, so timed out work cannot pile up past queue_limit
+    def _run(self, fn, *args):
+        with self._lock:
+            if self.queue_depth >= self.queue_limit:
+                self.rejected += 1
+                raise HasherBusyError("server busy hashing passwords, please try again shortly")
+            self.queue_depth += 1
+        start = time.perf_counter()
+        try:
+            if self.pool_size == 0:
+                try:
+                    return fn(*args)
+                finally:
+                    self._release()
+            try:
+                future = self._get_pool().submit(fn, *args)
+            except Exception:
+                self._release()
+                raise
+            future.add_done_callback(self._release)
+            try:
+                return future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                # Drop the hash if the pool has not started it yet
+                future.cancel()
+                with self._lock:
+                    self.rejected += 1
+                raise HasherBusyError("password hashing timed out, please try again shortly")
+        finally:
+            elapsed = time.perf_counter() - start
+            self._record_latency(elapsed)
+            add_timing("bcrypt", elapsed)
+
+    def hash_password(self, password):
+        return self._run(_hash_password, password, self.rounds)
+
+    def check_password(self, pw_hash, password):
+        return self._run(_check_password, pw_hash, password)
+
+    # Check if a stored hash was made with a lower work factor than the current one
+    def needs_rehash(self, pw_hash):
+        try:
+            return int(pw_hash.split("$")[2]) < self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def stats(self):
+        return {
+            "rounds": self.rounds,
+            "pool_size": self.pool_size,
+            "queue_limit": self.queue_limit,
+            "queue_depth": self.queue_depth,
+            "rejected": self.rejected,
+            "hash_count": self.hash_count,
+            "hash_seconds_total": round(self.hash_seconds, 6),
+            "latency_ms_buckets": dict(zip(LATENCY_BUCKETS, self.latency_buckets))
+        }
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,228 @@
+from collections import Counter
+
+from sqlalchemy import and_, event, func, insert, literal, null, or_, select, tuple_, update, delete
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from snowflake import snowflake
+from models.server_member import ServerMember
+from models.channel import Channel
+from models.message import Message
+from models.read_marker import ReadMarker
+
+markers = ReadMarker.__table__
+
+# Channel has no marker for user yet, a channel and a member added together would otherwise get two
+def _no_marker(channel_id, user_id):
+    return ~select(markers.c.marker_id).where(markers.c.channel_id == channel_id,
+                                              markers.c.user_id == user_id).exists()
+
+# Channel markers for a new member, read up to now so they start with nothing unread
+def add_member_markers(connection, server_id, user_id):
+    connection.execute(insert(markers).from_select(
+        ["user_id", "channel_id", "last_read_message_id", "unread_count"],
+        select(literal(user_id), Channel.channel_id, literal(snowflake.next_id()), literal(0))
+        .where(Channel.server_id == server_id, _no_marker(Channel.channel_id, user_id))
+    ))
+
+# Markers for every member of a server on a new channel
+def add_channel_markers(connection, channel_id, server_id):
+    connection.execute(insert(markers).from_select(
+        ["user_id", "channel_id", "last_read_message_id", "unread_count"],
+        select(ServerMember.user_id, literal(channel_id), literal(0), literal(0))
+        .where(ServerMember.server_id == server_id, _no_marker(channel_id, ServerMember.user_id))
+    ))
+
+# Channel markers for every member of a server, read up to now, for servers loaded outside the app
+def add_server_markers(connection, server_id):
+    connection.execute(insert(markers).from_select(
+        ["user_id", "channel_id", "last_read_message_id", "unread_count"],
+        select(ServerMember.user_id, Channel.channel_id, literal(snowflake.next_id()), literal(0))
+        .join(Channel, Channel.server_id == ServerMember.server_id)
+        .where(ServerMember.server_id == server_id, _no_marker(Channel.channel_id, ServerMember.user_id))
+    ))
+
+# Drop a former member's markers for the channels of a server
+def remove_member_markers(connection, server_id, user_id):
+    connection.execute(delete(markers).where(
+        markers.c.user_id == user_id,
+        markers.c.channel_id.in_(select(Channel.channel_id).where(Channel.server_id == server_id))
+    ))
+
+# Markers for memberships and direct message conversations that have none, read up to now
+# Used once when read markers are added to an existing database, returns the rows added of each kind
+def add_missing_markers(connection):
+    columns = ["user_id", "channel_id", "peer_user_id", "last_read_message_id", "unread_count"]
+    channel_result = connection.execute(insert(markers).from_select(columns,
+        select(ServerMember.user_id, Channel.channel_id, null(), literal(snowflake.next_id()), literal(0))
+        .join(Channel, Channel.server_id == ServerMember.server_id)
+        .where(_no_marker(Channel.channel_id, ServerMember.user_id))
+    ))
+    peer_markers = markers.alias("peer_markers")
+    direct_result = connection.execute(insert(markers).from_select(columns,
+        select(Message.receiver_user_id, null(), Message.sender_user_id,
+               func.max(Message.message_id), literal(0))
+        .where(Message.channel_id.is_(None), Message.receiver_user_id.is_not(None),
+               ~select(peer_markers.c.marker_id).where(peer_markers.c.user_id == Message.receiver_user_id,
+                                                      peer_markers.c.peer_user_id == Message.sender_user_id).exists())
+        .group_by(Message.receiver_user_id, Message.sender_user_id)
+    ))
+    return channel_result.rowcount, direct_result.rowcount
+
+# Insert or add to the direct message marker of receiver for messages from sender
+def _add_direct_unread(connection, receiver_user_id, sender_user_id, count):
+    dialect = postgresql if connection.dialect.name == "postgresql" else sqlite
+    stmt = dialect.insert(markers).values(user_id=receiver_user_id, peer_user_id=sender_user_id,
+                                          last_read_message_id=0, unread_count=count)
+    connection.execute(stmt.on_conflict_do_update(
+        index_elements=[markers.c.user_id, markers.c.peer_user_id],
+        set_={"unread_count": markers.c.unread_count + count}
+    ))
+
+# Count new messages as unread for everyone but their sender
+# messages are (message_id, channel_id, sender_user_id, receiver_user_id), one statement per channel and sender
+def record_posts(connection, messages):
+    channel_posts = Counter((channel_id, sender) for _, channel_id, sender, _ in messages if channel_id is not None)
+    for (channel_id, sender), count in sorted(channel_posts.items()):
+        connection.execute(update(markers)
+                           .where(markers.c.channel_id == channel_id, markers.c.user_id != sender)
+                           .values(unread_count=markers.c.unread_count + count))
+    direct_posts = Counter((receiver, sender) for _, channel_id, sender, receiver in messages
+                           if channel_id is None and receiver is not None)
+    for (receiver, sender), count in sorted(direct_posts.items()):
+        _add_direct_unread(connection, receiver, sender, count)
+
+# Take deleted messages off the counts of users who had not read them yet
+def record_deletes(connection, messages):
+    for message_id, channel_id, sender, receiver in messages:
+        if channel_id is not None:
+            condition = and_(markers.c.channel_id == channel_id, markers.c.user_id != sender)
+        elif receiver is not None:
+            condition = and_(markers.c.user_id == receiver, markers.c.peer_user_id == sender)
+        else:
+            continue
+        connection.execute(update(markers)
+                           .where(condition, markers.c.last_read_message_id < message_id,
+                                  markers.c.unread_count > 0)
+                           .values(unread_count=markers.c.unread_count - 1))
+
+# Messages after the marker being updated that its user did not send
+def _unread():
+    return (select(func.count()).select_from(Message.__table__)
+            .where(Message.message_id > markers.c.last_read_message_id,
+                   Message.sender_user_id != markers.c.user_id,
+                   or_(and_(markers.c.channel_id.is_not(None), Message.channel_id == markers.c.channel_id),
+                       and_(markers.c.channel_id.is_(None), Message.channel_id.is_(None),
+                            Message.receiver_user_id == markers.c.user_id,
+                            Message.sender_user_id == markers.c.peer_user_id)))
+            .scalar_subquery())
+
+# Recount unread messages on markers of the given channels and (receiver, sender) conversations
+# Only markers read to before before_id can have counted messages below it, the rest are left alone
+# Used after messages are removed in bulk, where record_deletes would go one message at a time
+def recount(connection, channel_ids=(), direct_pairs=(), before_id=None):
+    unread = _unread()
+    scopes = []
+    if channel_ids:
+        scopes.append(markers.c.channel_id.in_(sorted(channel_ids)))
+    if direct_pairs:
+        scopes.append(tuple_(markers.c.user_id, markers.c.peer_user_id).in_(sorted(direct_pairs)))
+    if not scopes:
+        return 0
+    stmt = update(markers).where(or_(*scopes)).values(unread_count=unread)
+    if before_id is not None:
+        stmt = stmt.where(markers.c.last_read_message_id < before_id)
+    return connection.execute(stmt).rowcount
+
+# Reset unread_count of the next batch of markers after after_id from messages
+# The markers are locked before counting, so a post adding to one waits and adds after the recount
+# Returns the last marker_id looked at (None when there are no more) and how many were wrong
+def reconcile_markers(connection, after_id, batch_size):
+    marker_ids = connection.execute(select(markers.c.marker_id).where(markers.c.marker_id > after_id)
+                                    .order_by(markers.c.marker_id).limit(batch_size).with_for_update()).scalars().all()
+    if not marker_ids:
+        return None, 0
+    unread = _unread()
+    result = connection.execute(update(markers)
+                                .where(markers.c.marker_id.in_(marker_ids), markers.c.unread_count != unread)
+                                .values(unread_count=unread))
+    return marker_ids[-1], result.rowcount
+
+# Reconcile every marker, committing after each batch so locks are held briefly
+# Returns how many markers had wrong unread counts
+def reconcile_all_markers(session, batch_size):
+    after_id, total = 0, 0
+    while after_id is not None:
+        after_id, count = reconcile_markers(session.connection(), after_id, batch_size)
+        session.commit()
+        total += count
+    return total
+
+# Move marker forward to up_to (the newest message when None) and recount what is left unread
+# Only messages after the marker are counted, which the history indexes cover
+# An existing marker is locked first, so a post adding to its count waits for this recount
+# rather than having its addition overwritten
+def mark_read(marker, scope, up_to=None):
+    from main import db
+    if marker.marker_id is not None:
+        db.session.refresh(marker, with_for_update=True)
+    latest = db.session.scalar(select(func.max(Message.message_id)).where(scope)) or 0
+    up_to = latest if up_to is None else min(up_to, latest)
+    marker.last_read_message_id = max(marker.last_read_message_id or 0, up_to)
+    marker.unread_count = db.session.scalar(
+        select(func.count()).select_from(Message)
+        .where(scope, Message.message_id > marker.last_read_message_id,
+               Message.sender_user_id != marker.user_id)
+    )
+    db.session.commit()
+    return marker
+
+# Note rows that change unread counts, their ids are only known once the flush is done
+# Rows deleted along with their channel or server are skipped, their markers go too
+def _before_flush(session, flush_context, instances):
+    from models.server import Server
+    pending = session.info.setdefault("read_marker_changes", {"new": [], "deleted": []})
+    for obj in session.new:
+        if isinstance(obj, (Message, ServerMember, Channel)):
+            pending["new"].append(obj)
+    deleted_channels = {obj.channel_id for obj in session.deleted if isinstance(obj, Channel)}
+    deleted_servers = {obj.server_id for obj in session.deleted if isinstance(obj, Server)}
+    for obj in session.deleted:
+        if isinstance(obj, Message) and obj.channel_id not in deleted_channels:
+            pending["deleted"].append(obj)
+        elif isinstance(obj, ServerMember) and obj.server_id not in deleted_servers:
+            pending["deleted"].append(obj)
+
+def _after_flush(session, flush_context):
+    pending = session.info.pop("read_marker_changes", None)
+    if not pending:
+        return
+    connection = session.connection()
+    posts, deletes = [], []
+    for obj in pending["new"]:
+        if isinstance(obj, Message):
+            posts.append((obj.message_id, obj.channel_id, obj.sender_user_id, obj.receiver_user_id))
+        elif isinstance(obj, ServerMember):
+            add_member_markers(connection, obj.server_id, obj.user_id)
+        else:
+            add_channel_markers(connection, obj.channel_id, obj.server_id)
+    for obj in pending["deleted"]:
+        if isinstance(obj, Message):
+            deletes.append((obj.message_id, obj.channel_id, obj.sender_user_id, obj.receiver_user_id))
+        else:
+            remove_member_markers(connection, obj.server_id, obj.user_id)
+    if posts:
+        record_posts(connection, posts)
+    if deletes:
+        record_deletes(connection, deletes)
+
+def _after_rollback(session, previous_transaction):
+    session.info.pop("read_marker_changes", None)
+
+# Register session events that keep unread counts current for ORM writes
+# Writes that bypass the unit of work (bulk inserts, group commit) call record_posts themselves
+def init_app(app):
+    if not event.contains(Session, "before_flush", _before_flush):
+        event.listen(Session, "before_flush", _before_flush)
+        event.listen(Session, "after_flush", _after_flush)
+        event.listen(Session, "after_soft_rollback", _after_rollback)
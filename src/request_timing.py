@@ -0,0 +1,48 @@
+import time
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+from flask.json.provider import DefaultJSONProvider
+from flask_marshmallow import Schema
+
+# Add time spent on one kind of work (db, serialize, bcrypt) to the current request
+def add_timing(name, seconds, count=1):
+    if not has_app_context():
+        return
+    timings = g.setdefault("timings", {})
+    total, calls = timings.get(name, (0.0, 0))
+    timings[name] = (total + seconds, calls + count)
+
+# Time the body of a with block under name
+@contextmanager
+def timed(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(name, time.perf_counter() - start)
+
+# Get {name: (seconds, calls)} recorded for the current request
+def request_timings():
+    if not has_app_context():
+        return {}
+    return g.get("timings", {})
+
+# Schema base class that records how long dumping takes
+# Nested schemas dump through the same method, so only the outermost dump is timed
+class TimedSchema(Schema):
+    def dump(self, obj, *, many=None):
+        if not has_app_context() or g.get("dumping"):
+            return super().dump(obj, many=many)
+        g.dumping = True
+        try:
+            with timed("serialize"):
+                return super().dump(obj, many=many)
+        finally:
+            g.dumping = False
+
+# JSON provider that records how long encoding a response takes
+class TimedJSONProvider(DefaultJSONProvider):
+    def response(self, *args, **kwargs):
+        with timed("serialize"):
+            return super().response(*args, **kwargs)
@@ -0,0 +1,158 @@
+import functools
+import json
+import os
+import threading
+
+from flask import current_app, g, make_response, request
+
+from membership_cache import MISSING, LocalBackend, LocalSharedClient
+from serializer import wants_ndjson
+from versioning import on_commit
+
+# Cached responses and scope generations kept in this process
+class LocalResponseBackend:
+    def __init__(self, maxsize=10000, ttl=300):
+        self.entries = LocalBackend(maxsize=maxsize, ttl=ttl)
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    @property
+    def evictions(self):
+        return self.entries.evictions
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, value):
+        self.entries.set(key, value)
+
+    def generation(self, scope):
+        return self._generations.get(scope, 0)
+
+    def bump(self, scope):
+        with self._lock:
+            self._generations[scope] = self._generations.get(scope, 0) + 1
+
+    def __len__(self):
+        return len(self.entries)
+
+# Cached responses and scope generations shared between workers, in any client with
+# redis style get/set/incr, so a write in one worker is seen by every other
+class SharedResponseBackend:
+    def __init__(self, client, ttl=300, prefix="response"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        # Evictions happen inside the shared store and are not visible here
+        self.evictions = 0
+
+    def get(self, key):
+        raw = self.client.get(f"{self.prefix}:{key}")
+        if raw is None:
+            return MISSING
+        status, body, mimetype = json.loads(raw)
+        return status, body.encode("utf-8"), mimetype
+
+    def set(self, key, value):
+        status, body, mimetype = value
+        self.client.set(f"{self.prefix}:{key}", json.dumps([status, body.decode("utf-8"), mimetype]), ex=self.ttl)
+
+    # Generations never expire, an expired one would start again at 0 and revive old entries
+    def generation(self, scope):
+        return int(self.client.get(f"{self.prefix}:generation:{scope}") or 0)
+
+    def bump(self, scope):
+        self.client.incr(f"{self.prefix}:generation:{scope}")
+
+    def __len__(self):
+        return 0
+
+# Read-through cache for GET responses
+# Entries are keyed by route, path and query values, the caller's role and the generation
+# of the scope the response depends on ("server:<id>" or "user:<id>"). Committed model
+# changes bump the generation (see versioning.py), so later reads miss and refill at once
+class ResponseCache:
+    def __init__(self, backend=None):
+        self.backend = backend or LocalResponseBackend()
+        self.enabled = False
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    # Configure cache from environment variables, off unless RESPONSE_CACHE_ENABLED=1
+    def init_app(self, app):
+        self.enabled = os.environ.get("RESPONSE_CACHE_ENABLED", "0") == "1"
+        size = int(os.environ.get("RESPONSE_CACHE_SIZE", 10000))
+        ttl = int(os.environ.get("RESPONSE_CACHE_TTL", 300))
+        backend = os.environ.get("RESPONSE_CACHE_BACKEND", "local")
+        if backend == "local":
+            self.backend = LocalResponseBackend(maxsize=size, ttl=ttl)
+        elif backend == "shared-local":
+            self.backend = SharedResponseBackend(LocalSharedClient(), ttl=ttl)
+        else:
+            # Any other value is treated as a redis url, redis is only needed when used
+            import redis
+            self.backend = SharedResponseBackend(redis.Redis.from_url(backend), ttl=ttl)
+        on_commit(self.invalidate)
+        app.extensions["response_cache"] = self
+
+    # Drop every cached response that depends on the given scopes
+    def invalidate(self, scopes):
+        if not self.enabled:
+            return
+        for scope in scopes:
+            self.backend.bump(scope)
+            self.invalidations += 1
+
+    # Role checked by the route's decorators, responses are only shared within one role
+    @staticmethod
+    def _role():
+        context = g.get("auth_context")
+        if context is None or context.member is None:
+            return "any"
+        return "admin" if context.member.is_admin else "member"
+
+    def _key(self, scope):
+        return "|".join((
+            request.endpoint,
+            ",".join(f"{name}={value}" for name, value in sorted(request.view_args.items())),
+            ",".join(f"{name}={value}" for name, value in sorted(request.args.items(multi=True))),
+            self._role(),
+            # Lists are NDJSON for clients that prefer it, never serve one format to the other
+            "ndjson" if wants_ndjson() else "json",
+            str(self.backend.generation(scope))
+        ))
+
+    # Cache successful responses of a view, scope is "server" or "user" and id_arg names its id
+    # Goes below the authorisation decorators so cached responses are only served after their checks
+    def cached(self, scope, id_arg):
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                key = self._key(f"{scope}:{kwargs[id_arg]}")
+                entry = self.backend.get(key)
+                if entry is not MISSING:
+                    self.hits += 1
+                    status, body, mimetype = entry
+                    return current_app.response_class(body, status=status, mimetype=mimetype)
+                self.misses += 1
+                response = make_response(fn(*args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed:
+                    self.backend.set(key, (response.status_code, response.get_data(), response.mimetype))
+                return response
+            return wrapper
+        return decorator
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "evictions": self.backend.evictions,
+            "size": len(self.backend)
+        }
+
+response_cache = ResponseCache()
@@ -0,0 +1,81 @@
+from flask import request
+from sqlalchemy import Float, and_, cast, column, func, literal_column, or_, select, table, tuple_
+
+from main import db
+from eager_loading import eager_load
+from pagination import PaginationError, decode_values, encode_values, page_args
+from models.server_member import ServerMember
+from models.channel import Channel
+from models.message import Message, SEARCH_CONFIG, messages_schema
+
+# Quote every word so user input is never read as FTS5 query syntax
+def _fts5_query(text):
+    return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+# Rank expression, match condition and extra join for the database in use
+# Postgres matches the generated tsvector column, SQLite the FTS5 table
+def _text_match(text):
+    if db.session.get_bind().dialect.name == "postgresql":
+        vector = literal_column("messages.search_vector")
+        ts_query = func.websearch_to_tsquery(SEARCH_CONFIG, text)
+        rank = cast(func.ts_rank_cd(vector, ts_query), Float)
+        return rank, vector.op("@@")(ts_query), None
+    messages_fts = table("messages_fts", column("rowid"))
+    # bm25 scores better matches lower, so negate it to rank highest first like Postgres
+    rank = -func.bm25(literal_column("messages_fts"))
+    condition = literal_column("messages_fts").op("MATCH")(_fts5_query(text))
+    return rank, condition, (messages_fts, messages_fts.c.rowid == Message.message_id)
+
+# Read ?q= from the query string
+def search_text():
+    text = (request.args.get("q") or "").strip()
+    if not text:
+        raise PaginationError("search query q is required")
+    return text
+
+# Run a ranked search over messages scoped by the given statement filter,
+# paged on (rank, message_id) so later pages never re-rank earlier results
+def search_messages(text, scope, before=None, limit=50, joins=()):
+    rank, condition, text_join = _text_match(text)
+    stmt = select(Message, rank.label("rank")).options(*eager_load(messages_schema, Message))
+    if text_join is not None:
+        stmt = stmt.join(*text_join)
+    for join in joins:
+        stmt = stmt.join(*join)
+    stmt = stmt.where(condition, scope)
+    if before:
+        try:
+            last_rank, last_id = decode_values(before)
+            stmt = stmt.where(tuple_(rank, Message.message_id) < tuple_(float(last_rank), int(last_id)))
+        except (TypeError, ValueError):
+            raise PaginationError(f"invalid cursor {before}")
+    stmt = stmt.order_by(rank.desc(), Message.message_id.desc()).limit(limit + 1)
+
+    rows = db.session.execute(stmt).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_values([rows[-1].rank, str(rows[-1].Message.message_id)]) if has_more else None
+    return [row.Message for row in rows], next_cursor
+
+# Search one channel, only if user is a member of the channel's server
+def search_channel(text, channel_id, user_id):
+    before, _, limit = page_args()
+    return search_messages(text, Message.channel_id == channel_id, before, limit, joins=(
+        (Channel, Channel.channel_id == Message.channel_id),
+        (ServerMember, and_(ServerMember.server_id == Channel.server_id, ServerMember.user_id == user_id))
+    ))
+
+# Search every channel in a server, only if user is a member of it
+def search_server(text, server_id, user_id):
+    before, _, limit = page_args()
+    return search_messages(text, Channel.server_id == server_id, before, limit, joins=(
+        (Channel, Channel.channel_id == Message.channel_id),
+        (ServerMember, and_(ServerMember.server_id == Channel.server_id, ServerMember.user_id == user_id))
+    ))
+
+# Search direct messages sent or received by user
+def search_direct(text, user_id):
+    before, _, limit = page_args()
+    scope = and_(Message.channel_id.is_(None),
+                 or_(Message.sender_user_id == user_id, Message.receiver_user_id == user_id))
+    return search_messages(text, scope, before, limit)
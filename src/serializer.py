@@ -0,0 +1,167 @@
+import functools
+import itertools
+import json
+from datetime import date, datetime
+
+from flask import current_app, make_response, request, stream_with_context
+from marshmallow import fields, missing
+
+from request_timing import timed
+
+# orjson is optional, without it encoding falls back to the standard json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_compiled = {}
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# Rows fetched from the database and written out together by a streamed list
+STREAM_BATCH = 500
+
+# Same conversion marshmallow's Inferred field applies to the value types our models return
+def _inferred(value):
+    value_type = type(value)
+    if value_type is datetime or value_type is date:
+        return value.isoformat()
+    if value_type in (str, int, bool) or value is None:
+        return value
+    return _FALLBACK
+
+def _string(value):
+    return None if value is None else str(value)
+
+# Marks a value the compiled converters do not handle, it is serialised by the field instead
+_FALLBACK = object()
+
+# Turn one schema field into a converter for the attribute value, None means use the field itself
+def _compile_field(field):
+    if isinstance(field, fields.List) and isinstance(field.inner, fields.Nested) and not field.inner.many:
+        inner = compile_schema(field.inner.schema)
+        return lambda value: None if value is None else [inner(item) for item in value]
+    if isinstance(field, fields.Nested):
+        nested = compile_schema(field.schema)
+        if field.many:
+            return lambda value: None if value is None else [nested(item) for item in value]
+        return lambda value: None if value is None else nested(value)
+    if type(field) in (fields.Inferred, fields.Raw):
+        return _inferred
+    if type(field) is fields.String or (type(field) is fields.Integer and field.as_string):
+        return _string
+    return None
+
+# Compile a schema (with its only/exclude already applied) into a flat function of one object
+# Field order, data keys and nested shapes come from the schema itself so output matches dump()
+def compile_schema(schema):
+    if schema in _compiled:
+        return _compiled[schema]
+    parts = []
+    for name, field in schema.dump_fields.items():
+        parts.append((field.data_key or name, field.attribute or name, _compile_field(field), field))
+
+    def dump_one(obj):
+        result = {}
+        for key, attribute, convert, field in parts:
+            if convert is not None:
+                value = getattr(obj, attribute, missing)
+                if value is missing:
+                    continue
+                value = convert(value)
+                if value is not _FALLBACK:
+                    result[key] = value
+                    continue
+            value = field.serialize(attribute, obj, accessor=schema.get_attribute)
+            if value is not missing:
+                result[key] = value
+        return result
+
+    _compiled[schema] = dump_one
+    return dump_one
+
+# Dump a list of objects through the compiled form of a schema
+def dump_many(schema, objs):
+    dump_one = compile_schema(schema)
+    with timed("serialize"):
+        return [dump_one(obj) for obj in objs]
+
+# Encode data as compact json with the app's json settings
+# orjson output is only used when it is plain ascii, which is when it matches json.dumps
+def _encode(provider, data):
+    if orjson is not None and not provider.sort_keys:
+        encoded = orjson.dumps(data)
+        if encoded.isascii():
+            return encoded
+    return json.dumps(data, ensure_ascii=provider.ensure_ascii, sort_keys=provider.sort_keys,
+                      separators=(",", ":"), default=provider.default).encode("utf-8")
+
+# Encode data as a json response, byte for byte what returning data from a view produces
+def json_response(data, status=200):
+    provider = current_app.json
+    compact = provider.compact if provider.compact is not None else not current_app.debug
+    if not compact:
+        response = provider.response(data)
+        response.status_code = status
+        return response
+    with timed("serialize"):
+        body = _encode(provider, data) + b"\n"
+    return current_app.response_class(body, status=status, mimetype=provider.mimetype)
+
+# Whether the client prefers NDJSON to JSON in its Accept header
+def wants_ndjson():
+    return request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+# Whether a list should be streamed, asked for with ?stream=1 or by accepting NDJSON
+def wants_stream():
+    return request.args.get("stream") == "1" or wants_ndjson()
+
+# Mark every response of a list view, errors and 304s included, as depending on Accept
+# Goes straight below jwt_required so shared caches never give an NDJSON body to a JSON client
+def varies_by_accept(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        response = make_response(fn(*args, **kwargs))
+        response.vary.add("Accept")
+        return response
+    return wrapper
+
+# Stream the objects of query as a compact json array, or one object per line when NDJSON is preferred
+# Rows are fetched STREAM_BATCH at a time with yield_per and each batch is written as one chunk,
+# so memory use stays the same however long the list is and the first rows go out straight away
+# Returns None when query has no rows, so the view can answer as it does for an empty list
+def stream_response(schema, query, status=200):
+    dump_one = compile_schema(schema)
+    provider = current_app.json
+    rows = iter(query.yield_per(STREAM_BATCH))
+    first = next(rows, None)
+    if first is None:
+        return None
+    ndjson = wants_ndjson()
+
+    def generate():
+        rows_left = itertools.chain([first], rows)
+        separator = b"\n" if ndjson else b","
+        prefix = b"" if ndjson else b"["
+        while True:
+            batch = list(itertools.islice(rows_left, STREAM_BATCH))
+            if not batch:
+                break
+            with timed("serialize"):
+                chunk = prefix + separator.join(_encode(provider, dump_one(obj)) for obj in batch)
+            prefix = separator
+            yield chunk
+        yield b"\n" if ndjson else b"]\n"
+
+    # The request context stays open until the last row is written, along with its database session
+    response = current_app.response_class(stream_with_context(generate()), status=status,
+                                          mimetype=NDJSON_MIMETYPE if ndjson else provider.mimetype)
+    response.vary.add("Accept")
+    return response
+
+# Compile the list schemas once at startup
+def init_app(app):
+    from models.message import messages_schema
+    from models.channel import channels_schema
+    compile_schema(messages_schema)
+    compile_schema(channels_schema)
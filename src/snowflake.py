@@ -0,0 +1,149 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
+
+# 64-bit time ordered ids: | 44 bits time in 100 microsecond ticks | 10 bits worker | 9 bits sequence |
+# The sign bit stays clear, 44 bits of ticks last about 55 years from EPOCH
+EPOCH = datetime(2020, 1, 1)
+TICKS_PER_SECOND = 10000
+WORKER_BITS = 10
+SEQUENCE_BITS = 9
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# Ids from the old 32-bit sequence are all below this
+LEGACY_ID_LIMIT = 1 << 31
+
+_EPOCH_SECONDS = EPOCH.replace(tzinfo=timezone.utc).timestamp()
+
+# First key of the Postgres advisory locks that claim worker ids, the worker id is the second
+WORKER_LOCK_KEY = 0x736E6F77
+
+# Raised when a process has no worker id set and cannot claim one, two processes sharing
+# a worker id would make the same ids
+class WorkerIdError(Exception):
+    pass
+
+# Ticks since EPOCH for a naive UTC datetime
+def _ticks(moment):
+    delta = moment - EPOCH
+    return (delta.days * 86400 + delta.seconds) * TICKS_PER_SECOND + delta.microseconds // 100
+
+# Pack tick, worker and sequence into one id
+def make_id(ticks, worker_id=0, sequence=0):
+    return (ticks << (WORKER_BITS + SEQUENCE_BITS)) | (worker_id << SEQUENCE_BITS) | sequence
+
+# Increasing ids for a run of non-decreasing naive UTC times, used when back-filling rows
+# Times that share a tick take the next sequence numbers, spilling into later ticks when they run out
+# after carries on from the last id of an earlier run, so runs fed in batches never repeat an id
+# Ids in taken are skipped, for filling in around rows an earlier back-fill already wrote
+def ids_for_times(times, worker_id=0, after=None, taken=frozenset()):
+    last_ticks, sequence = -1, 0
+    if after is not None:
+        last_ticks, sequence = after >> (WORKER_BITS + SEQUENCE_BITS), after & MAX_SEQUENCE
+    for moment in times:
+        ticks = max(_ticks(moment), last_ticks)
+        sequence = sequence + 1 if ticks == last_ticks else 0
+        while True:
+            if sequence > MAX_SEQUENCE:
+                ticks += 1
+                sequence = 0
+            new_id = make_id(ticks, worker_id, sequence)
+            if new_id not in taken:
+                break
+            sequence += 1
+        last_ticks = ticks
+        yield new_id
+
+# Smallest id made at or after a naive UTC time, for turning time ranges into id ranges
+def first_id_at(moment):
+    return make_id(_ticks(moment))
+
+# Naive UTC time an id was generated at, to 100 microseconds
+def id_time(snowflake_id):
+    ticks = snowflake_id >> (WORKER_BITS + SEQUENCE_BITS)
+    return EPOCH + timedelta(microseconds=ticks * 100)
+
+# Generates increasing ids for one worker, safe to share between threads
+# Each process needs its own worker id: SNOWFLAKE_WORKER_ID when set, otherwise one claimed from Postgres
+class SnowflakeGenerator:
+    def __init__(self, worker_id=None):
+        self.worker_id = worker_id
+        self.database_uri = None
+        self._worker_id = None
+        self._claims = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._last_ticks = 0
+        self._sequence = 0
+
+    def init_app(self, app):
+        worker_id = app.config.get("SNOWFLAKE_WORKER_ID")
+        with self._lock:
+            self.worker_id = int(worker_id) if worker_id not in (None, "") else None
+            self.database_uri = app.config.get("SQLALCHEMY_DATABASE_URI")
+            self._worker_id = None
+        app.extensions["snowflake"] = self
+
+    # Claim the lowest worker id no other process holds with a session advisory lock, on a connection of
+    # its own kept open while the process runs. Postgres drops the lock when the process goes away
+    # MAX_WORKER_ID is left for server imports (see exports.py)
+    def _claim_worker_id(self):
+        if not self.database_uri or make_url(self.database_uri).get_backend_name() != "postgresql":
+            raise WorkerIdError("SNOWFLAKE_WORKER_ID must be set, worker ids are only claimed on Postgres")
+        if os.environ.get("DB_POOLER_MODE", "session") == "transaction":
+            raise WorkerIdError("SNOWFLAKE_WORKER_ID must be set, advisory locks do not last through "
+                                "a transaction pooler")
+        connection = create_engine(self.database_uri, poolclass=NullPool).connect()
+        for worker_id in range(MAX_WORKER_ID):
+            claimed = connection.scalar(text("SELECT pg_try_advisory_lock(:key, :worker_id)"),
+                                        {"key": WORKER_LOCK_KEY, "worker_id": worker_id})
+            if claimed:
+                connection.commit()
+                self._claims.append(connection)
+                return worker_id
+        connection.close()
+        raise WorkerIdError(f"every worker id below {MAX_WORKER_ID} is claimed by another process")
+
+    def _current_worker_id(self):
+        # A forked process needs an id of its own. Claims inherited from the parent stay open,
+        # closing one here would end the parent's session and free its worker id
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._worker_id = None
+            self._last_ticks = 0
+            self._sequence = 0
+        if self._worker_id is None:
+            worker_id = self.worker_id if self.worker_id is not None else self._claim_worker_id()
+            if not 0 <= worker_id <= MAX_WORKER_ID:
+                raise ValueError(f"snowflake worker id must be between 0 and {MAX_WORKER_ID}")
+            self._worker_id = worker_id
+        return self._worker_id
+
+    def next_id(self):
+        with self._lock:
+            worker_id = self._current_worker_id()
+            ticks = int((time.time() - _EPOCH_SECONDS) * TICKS_PER_SECOND)
+            # If the clock goes back, or a tick runs out of sequence numbers, carry on from
+            # the last tick used so ids from this worker never repeat or go backwards
+            if ticks <= self._last_ticks:
+                ticks = self._last_ticks
+                self._sequence += 1
+                if self._sequence > MAX_SEQUENCE:
+                    ticks += 1
+                    self._sequence = 0
+            else:
+                self._sequence = 0
+            self._last_ticks = ticks
+            return make_id(ticks, worker_id, self._sequence)
+
+snowflake = SnowflakeGenerator()
+
+# Column default for primary keys
+def next_id():
+    return snowflake.next_id()
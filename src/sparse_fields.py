@@ -0,0 +1,59 @@
+from flask import request
+from marshmallow import ValidationError
+from sqlalchemy import inspect
+from sqlalchemy.orm import load_only
+
+from eager_loading import eager_load, nested_schema
+
+_schemas = {}
+
+# Read a comma separated list from the query string, None when not given
+def _names(arg):
+    value = request.args.get(arg)
+    if value is None:
+        return None
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+# Narrow schema to ?fields= and ?expand=, both left out keeps the full response
+# fields lists the attributes to return, all plain fields when not given
+# expand lists the nested fields to embed, none are embedded when not given
+def _select_schema(schema, requested, expand):
+    available = list(schema.fields)
+    expandable = [name for name in available if nested_schema(schema.fields[name]) is not None]
+    if requested is None:
+        requested = [name for name in available if name not in expandable]
+    errors = {}
+    unknown = [name for name in requested if name not in available]
+    if unknown:
+        errors["fields"] = [f"unknown field {name}" for name in unknown]
+    unknown = [name for name in expand or [] if name not in expandable]
+    if unknown:
+        errors["expand"] = [f"cannot expand {name}" for name in unknown]
+    if errors:
+        raise ValidationError(errors)
+    only = tuple(name for name in available if name in requested or name in (expand or []))
+    # Narrowed schemas are reused so their loader options and compiled serializers are cached too
+    key = (type(schema), only, schema.many)
+    if key not in _schemas:
+        _schemas[key] = type(schema)(only=only, many=schema.many)
+    return _schemas[key]
+
+# Get the schema to dump model instances with and the loader options for querying them
+# Unrequested relationships are neither joined nor dumped, so they are never queried,
+# and with ?fields= only the requested columns of model itself are selected
+# Nested fields named in opt_in are left out of the full response too, unless ?expand= names them
+def select_fields(schema, model, opt_in=()):
+    requested, expand = _names("fields"), _names("expand")
+    if requested is None and expand is None:
+        if not opt_in:
+            return schema, eager_load(schema, model)
+        expand = [name for name in schema.fields if nested_schema(schema.fields[name]) is not None
+                  and name not in opt_in]
+    schema = _select_schema(schema, requested, expand)
+    options = list(eager_load(schema, model))
+    if requested is not None:
+        mapper = inspect(model)
+        names = [mapper.get_property_by_column(column).key for column in mapper.primary_key]
+        names += [name for name in schema.fields if name in mapper.column_attrs and name not in names]
+        options.append(load_only(*[getattr(model, name) for name in names]))
+    return schema, options
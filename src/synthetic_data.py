@@ -0,0 +1,195 @@
+import csv
+import io
+import itertools
+import random
+import time
+from datetime import date, datetime, timedelta, timezone
+
+from sqlalchemy import insert
+
+from main import db, bcrypt
+from snowflake import id_time, ids_for_times
+from counters import reconcile_all
+from read_markers import add_missing_markers
+from partitions import ensure_partitions
+from models.user import User
+from models.server import Server
+from models.server_member import ServerMember
+from models.channel import Channel
+from models.message import Message
+
+# Every synthetic user shares this password so it only has to be hashed once
+SYNTHETIC_PASSWORD = "123456Aa!"
+
+# Zipf exponent for server popularity, higher means a few servers get more of everything
+SERVER_SKEW = 1.1
+
+# Average number of servers each user joins
+SERVERS_PER_USER = 3
+
+# Share of messages sent as direct messages rather than to a channel
+DIRECT_MESSAGE_SHARE = 0.1
+
+# Messages are spread over this many days before now
+HISTORY_DAYS = 90
+
+STATUSES = ("online", "offline", "away")
+WORDS = ("hello", "anyone", "around", "meeting", "today", "thanks", "deploy", "lunch", "ok",
+         "great", "idea", "later", "check", "this", "out", "release", "bug", "fixed", "agree", "see")
+
+# Insert rows in batches and return generated primary keys in the same order as rows
+def _insert_returning(model, key_column, rows, batch_size):
+    ids = []
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return ids
+        stmt = insert(model).returning(key_column, sort_by_parameter_order=True)
+        ids.extend(db.session.scalars(stmt, batch).all())
+        db.session.commit()
+
+# Insert rows in batches without fetching keys back
+def _insert_many(model, rows, batch_size):
+    total = 0
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return total
+        db.session.execute(insert(model), batch)
+        db.session.commit()
+        total += len(batch)
+
+# Stream message rows into Postgres with COPY, one buffer per batch
+def _copy_messages(rows, batch_size, report):
+    columns = ("message_id", "title", "content", "timestamp", "channel_id", "sender_user_id", "receiver_user_id")
+    sql = f"COPY {Message.__tablename__} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+    total = 0
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return total
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in batch:
+            writer.writerow([row[column] for column in columns])
+        buffer.seek(0)
+        cursor = db.session.connection().connection.dbapi_connection.cursor()
+        cursor.copy_expert(sql, buffer)
+        db.session.commit()
+        total += len(batch)
+        report(total)
+
+# Weight of each server, the first servers are the huge ones and the rest form a long tail
+def _server_weights(count):
+    return [1 / (rank + 1) ** SERVER_SKEW for rank in range(count)]
+
+# Split total into parts proportional to weights, giving every part at least minimum
+def _split(total, weights, minimum=1):
+    weight_sum = sum(weights)
+    return [max(minimum, round(total * weight / weight_sum)) for weight in weights]
+
+# Generate a skewed dataset of users, servers, members, channels and messages
+def seed_synthetic(users, servers, channels, messages, seed=None, batch_size=10000):
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    today = date.today()
+
+    def report(stage, count):
+        print(f"{stage}: {count} rows ({time.perf_counter() - started:.1f}s)")
+
+    # Users, with one shared password hash
+    password = bcrypt.generate_password_hash(SYNTHETIC_PASSWORD).decode("utf-8")
+    run_tag = rng.getrandbits(32)
+    user_ids = _insert_returning(User, User.user_id, (
+        {
+            "username": f"user_{run_tag:08x}_{index}",
+            "email": f"user_{run_tag:08x}_{index}@example.com",
+            "password": password,
+            "name": f"user {index}",
+            "status": rng.choice(STATUSES)
+        }
+        for index in range(users)
+    ), batch_size)
+    report("users", len(user_ids))
+
+    # Servers, each created by a random user
+    creators = [rng.choice(user_ids) for _ in range(servers)]
+    server_ids = _insert_returning(Server, Server.server_id, (
+        {
+            "server_name": f"server {index}",
+            "created_on": today,
+            "creator_user_id": creator
+        }
+        for index, creator in enumerate(creators)
+    ), batch_size)
+    report("servers", len(server_ids))
+
+    # Members, a few servers hold most users while the tail has a handful each
+    weights = _server_weights(len(server_ids))
+    sizes = _split(len(user_ids) * min(SERVERS_PER_USER, len(server_ids)), weights)
+    members_by_server = {}
+    member_rows = []
+    for server_id, creator, size in zip(server_ids, creators, sizes):
+        members = set(rng.sample(user_ids, min(size, len(user_ids))))
+        members.discard(creator)
+        members_by_server[server_id] = [creator] + list(members)
+        member_rows.append({"joined_on": today, "is_admin": True, "server_id": server_id, "user_id": creator})
+        member_rows.extend({"joined_on": today, "is_admin": False, "server_id": server_id, "user_id": user_id}
+                           for user_id in members)
+    report("server members", _insert_many(ServerMember, member_rows, batch_size))
+    del member_rows
+
+    # Channels, bigger servers get more of them
+    channel_counts = _split(max(channels, len(server_ids)), weights)
+    channel_servers = [server_id for server_id, count in zip(server_ids, channel_counts) for _ in range(count)]
+    channel_ids = _insert_returning(Channel, Channel.channel_id, (
+        {
+            "channel_name": f"channel {index}",
+            "created_on": today,
+            "creator_user_id": members_by_server[server_id][0],
+            "server_id": server_id
+        }
+        for index, server_id in enumerate(channel_servers)
+    ), batch_size)
+    report("channels", len(channel_ids))
+
+    # Messages, channels in bigger servers are busier, timestamps only move forward
+    # Ids are made from each message's time, as if it had been posted then
+    channel_weights = list(itertools.accumulate(len(members_by_server[server_id]) for server_id in channel_servers))
+    start_time = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=HISTORY_DAYS)
+    step = timedelta(days=HISTORY_DAYS) / max(messages, 1)
+
+    def message_rows():
+        message_ids = ids_for_times(start_time + step * index for index in range(messages))
+        for message_id in message_ids:
+            timestamp = id_time(message_id)
+            content = " ".join(rng.choices(WORDS, k=rng.randint(2, 12)))
+            if rng.random() < DIRECT_MESSAGE_SHARE or not channel_ids:
+                sender, receiver = rng.sample(user_ids, 2) if len(user_ids) > 1 else (user_ids[0], user_ids[0])
+                yield {"message_id": message_id, "title": None, "content": content, "timestamp": timestamp,
+                       "channel_id": None, "sender_user_id": sender, "receiver_user_id": receiver}
+            else:
+                position = rng.choices(range(len(channel_ids)), cum_weights=channel_weights)[0]
+                sender = rng.choice(members_by_server[channel_servers[position]])
+                yield {"message_id": message_id, "title": None, "content": content, "timestamp": timestamp,
+                       "channel_id": channel_ids[position], "sender_user_id": sender, "receiver_user_id": None}
+
+    if db.engine.dialect.name == "postgresql":
+        total = _copy_messages(message_rows(), batch_size, lambda count: report("messages", count))
+    else:
+        total = _insert_many(Message, message_rows(), batch_size)
+        report("messages", total)
+
+    # Bulk inserts skip the session events, so fill in counters from the rows afterwards
+    servers_fixed, channels_fixed = reconcile_all(db.session, batch_size)
+    report("counters", servers_fixed + channels_fixed)
+    # Members start with everything read, and users with a marker for each conversation they received
+    channel_markers, direct_markers = add_missing_markers(db.session.connection())
+    db.session.commit()
+    report("read markers", channel_markers + direct_markers)
+    # Months of history land in the default partition on Postgres, give each month its own
+    report("partitions", len(ensure_partitions(db.engine)))
+    print(f"synthetic data seeded, password for every user is {SYNTHETIC_PASSWORD}")
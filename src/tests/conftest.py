@@ -0,0 +1,92 @@
+import contextlib
+from datetime import date
+
+import pytest
+from flask_jwt_extended import create_access_token
+from sqlalchemy import event
+
+from main import create_app, db
+from models.user import User
+from models.server import Server
+from models.server_member import ServerMember
+from models.channel import Channel
+from models.message import Message
+
+# Ids of the rows every test starts with
+# user 1 created server 1 and is its admin, user 2 is a plain member and user 3 is not a member
+SEED = {"admin_id": 1, "member_id": 2, "outsider_id": 3, "server_id": 1, "channel_id": 1}
+
+def _seed():
+    db.session.add_all([
+        User(user_id=user_id, username=f"user{user_id}", email=f"user{user_id}@email.com",
+             password="not a hash", name=f"user {user_id}", status="online")
+        for user_id in (SEED["admin_id"], SEED["member_id"], SEED["outsider_id"])
+    ])
+    db.session.flush()
+    db.session.add(Server(server_id=SEED["server_id"], server_name="server 1", created_on=date.today(),
+                          creator_user_id=SEED["admin_id"]))
+    db.session.flush()
+    db.session.add_all([
+        ServerMember(member_id=1, joined_on=date.today(), is_admin=True, server_id=SEED["server_id"],
+                     user_id=SEED["admin_id"]),
+        ServerMember(member_id=2, joined_on=date.today(), is_admin=False, server_id=SEED["server_id"],
+                     user_id=SEED["member_id"]),
+        Channel(channel_id=SEED["channel_id"], channel_name="channel 1", created_on=date.today(),
+                server_id=SEED["server_id"], creator_user_id=SEED["admin_id"])
+    ])
+    db.session.flush()
+    message = Message(title="title 1", content="message 1", channel_id=SEED["channel_id"],
+                      sender_user_id=SEED["member_id"])
+    db.session.add(message)
+    db.session.commit()
+    return {**SEED, "message_id": message.message_id}
+
+# Fresh app on its own SQLite database for every test, so caches and rows never leak between tests
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'test.db'}",
+        "JWT_SECRET_KEY": "test secret",
+        "SNOWFLAKE_WORKER_ID": 0,
+        "TESTING": True
+    })
+    with app.app_context():
+        db.create_all()
+        app.config["SEED"] = _seed()
+        db.session.remove()
+    yield app
+    with app.app_context():
+        db.engine.dispose()
+
+@pytest.fixture
+def seed(app):
+    return app.config["SEED"]
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+# Authorization header for the given user
+@pytest.fixture
+def auth_headers(app):
+    def headers(user_id):
+        with app.app_context():
+            return {"Authorization": f"Bearer {create_access_token(identity=str(user_id))}"}
+    return headers
+
+# Record every SQL statement sent while the block runs
+@pytest.fixture
+def statements(app):
+    @contextlib.contextmanager
+    def record():
+        sent = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            sent.append(statement)
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield sent
+        finally:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return record
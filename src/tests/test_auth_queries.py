@@ -0,0 +1,88 @@
+import pytest
+
+# Every route behind a utils.py guard, who calls it, its body, its status and the statements it sends in total
+# The route's server, channel, message and memberships all come from one joined authorisation SELECT
+ROUTES = [
+    ("GET", "/server/{server_id}/member/all", "member_id", None, 200, 3),
+    ("GET", "/server/{server_id}/member/{member_id}", "member_id", None, 200, 2),
+    ("POST", "/server/{server_id}/member/add/{outsider_id}", "admin_id", None, 201, 9),
+    ("PATCH", "/server/{server_id}/member/update/{member_id}", "admin_id", {"is_admin": True}, 200, 6),
+    ("DELETE", "/server/{server_id}/member/delete/{member_id}", "admin_id", None, 200, 6),
+    ("GET", "/server/{server_id}/channel/all", "member_id", None, 200, 4),
+    ("GET", "/server/{server_id}/channel/{channel_id}", "member_id", None, 200, 3),
+    ("POST", "/server/{server_id}/channel/create", "admin_id", {"channel_name": "channel 2"}, 201, 7),
+    ("PATCH", "/server/{server_id}/channel/update/{channel_id}", "admin_id", {"channel_name": "channel renamed"}, 200, 5),
+    ("DELETE", "/server/{server_id}/channel/delete/{channel_id}", "admin_id", None, 200, 4),
+    ("GET", "/server/{server_id}/message/search?q=message", "member_id", None, 200, 2),
+    ("GET", "/channel/{channel_id}/message/all", "member_id", None, 200, 2),
+    ("GET", "/channel/{channel_id}/message/{message_id}", "member_id", None, 200, 2),
+    ("GET", "/channel/{channel_id}/message/search?q=message", "member_id", None, 200, 2),
+    ("POST", "/channel/{channel_id}/message/read", "member_id", {}, 200, 9),
+    ("POST", "/channel/{channel_id}/message/post", "member_id", {"title": "title 2", "content": "message 2"}, 201, 9),
+    ("POST", "/channel/{channel_id}/message/bulk", "member_id", [{"content": "message 2"}, {"content": "message 3"}],
+     201, 10),
+    ("PATCH", "/message/update/{message_id}", "member_id", {"content": "message edited"}, 200, 7),
+    ("DELETE", "/message/delete/{message_id}", "member_id", None, 200, 6),
+]
+
+# Server routes check the creator on the server row itself, without the joined query
+SERVER_ROUTES = [
+    ("PATCH", "/server/update/{server_id}", {"server_name": "server renamed"}, 200, 5),
+    ("DELETE", "/server/delete/{server_id}", None, 200, 28),
+]
+
+# The authorisation query outer joins every route id onto a single anchor row
+def _auth_queries(sent):
+    return [statement for statement in sent if "AS anchor" in statement]
+
+@pytest.mark.parametrize("method, path, user, body, status, expected", ROUTES)
+def test_guarded_route_query_count(client, auth_headers, statements, seed, method, path, user, body, status, expected):
+    with statements() as sent:
+        response = client.open(path.format(**seed), method=method, json=body, headers=auth_headers(seed[user]))
+    assert response.status_code == status
+    assert len(_auth_queries(sent)) == 1
+    assert len(sent) == expected
+
+# Membership is cached after a first request to the server, the joined query still runs once for the route's rows
+@pytest.mark.parametrize("method, path, user, body, status, expected", ROUTES)
+def test_guarded_route_query_count_cached_membership(client, auth_headers, statements, seed, method, path, user, body,
+                                                      status, expected):
+    headers = auth_headers(seed[user])
+    client.get(f"/server/{seed['server_id']}/member/all", headers=headers)
+    with statements() as sent:
+        response = client.open(path.format(**seed), method=method, json=body, headers=headers)
+    assert response.status_code == status
+    assert len(_auth_queries(sent)) == 1
+    assert len(sent) <= expected
+
+@pytest.mark.parametrize("method, path, body, status, expected", SERVER_ROUTES)
+def test_server_route_query_count(client, auth_headers, statements, seed, method, path, body, status, expected):
+    with statements() as sent:
+        response = client.open(path.format(**seed), method=method, json=body, headers=auth_headers(seed["admin_id"]))
+    assert response.status_code == status
+    assert len(sent) == expected
+
+# The event stream only queries to authorise, events come from the broker
+def test_stream_query_count(client, auth_headers, statements, seed):
+    with statements() as sent:
+        response = client.get(f"/channel/{seed['channel_id']}/message/stream", headers=auth_headers(seed["member_id"]),
+                              buffered=False)
+        assert next(response.response) == b"retry: 3000\n\n"
+        response.close()
+    assert response.status_code == 200
+    assert len(sent) == 1
+    assert len(_auth_queries(sent)) == 1
+
+# Rejected requests stop after the authorisation query
+@pytest.mark.parametrize("path, status", [
+    ("/server/{server_id}/channel/all", 400),
+    ("/server/999/channel/all", 404),
+    ("/server/{server_id}/channel/999", 404),
+    ("/channel/999/message/all", 404),
+])
+def test_rejected_route_query_count(client, auth_headers, statements, seed, path, status):
+    with statements() as sent:
+        response = client.get(path.format(**seed), headers=auth_headers(seed["outsider_id"]))
+    assert response.status_code == status
+    assert len(sent) == 1
+    assert len(_auth_queries(sent)) == 1
@@ -0,0 +1,77 @@
+import io
+import json
+
+import pytest
+
+import controllers.message_controller as message_controller
+from main import db
+from models.channel import Channel
+from models.message import Message
+
+def _path(seed):
+    return f"/channel/{seed['channel_id']}/message/bulk"
+
+def _channel_messages(app, seed):
+    with app.app_context():
+        return db.session.scalars(db.select(Message.content).where(Message.channel_id == seed["channel_id"])
+                                  .order_by(Message.message_id)).all()
+
+def test_bulk_posts_every_message_in_one_insert(app, client, auth_headers, statements, seed):
+    items = [{"title": f"title {number}", "content": f"message {number}"} for number in range(2, 12)]
+    with statements() as sent:
+        response = client.post(_path(seed), json=items, headers=auth_headers(seed["member_id"]))
+    assert response.status_code == 201
+    results = response.get_json()["results"]
+    assert [result["index"] for result in results] == list(range(10))
+    assert {result["status"] for result in results} == {201}
+    assert [result["message"]["content"] for result in results] == [item["content"] for item in items]
+    assert len([statement for statement in sent if statement.startswith("INSERT INTO messages")]) == 1
+    assert _channel_messages(app, seed) == ["message 1", *[item["content"] for item in items]]
+    with app.app_context():
+        assert db.session.get(Channel, seed["channel_id"]).message_count == 11
+
+# Invalid items get their own errors in place, the valid ones around them are still posted
+def test_bulk_reports_errors_per_item(app, client, auth_headers, seed):
+    items = [{"content": "message 2"}, {"title": "no content"}, {"content": "bad id", "message_id": "abc"},
+             "not a message", {"content": "message 3"}]
+    response = client.post(_path(seed), json=items, headers=auth_headers(seed["member_id"]))
+    assert response.status_code == 207
+    results = response.get_json()["results"]
+    assert [result["status"] for result in results] == [201, 400, 400, 400, 201]
+    assert results[1]["error"] == {"content": ["Missing data for required field."]}
+    assert results[2]["error"] == {"message_id": ["Not a valid integer."]}
+    assert results[4]["message"]["content"] == "message 3"
+    assert _channel_messages(app, seed) == ["message 1", "message 2", "message 3"]
+
+# Nothing is inserted when every item is invalid
+def test_bulk_with_no_valid_items(app, client, auth_headers, seed):
+    response = client.post(_path(seed), json=[{"title": "no content"}], headers=auth_headers(seed["member_id"]))
+    assert response.status_code == 207
+    assert response.get_json()["results"][0]["status"] == 400
+    assert _channel_messages(app, seed) == ["message 1"]
+
+@pytest.mark.parametrize("body", [[], {"content": "not an array"}, [{"content": "message"}] * 501])
+def test_bulk_rejects_bodies_outside_the_cap(app, client, auth_headers, seed, body):
+    response = client.post(_path(seed), json=body, headers=auth_headers(seed["member_id"]))
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "body must be an array of 1 to 500 messages"}
+    assert _channel_messages(app, seed) == ["message 1"]
+
+def test_bulk_rejects_large_body(app, client, auth_headers, seed, monkeypatch):
+    monkeypatch.setattr(message_controller, "MAX_BULK_BYTES", 100)
+    response = client.post(_path(seed), json=[{"content": "message " * 20}], headers=auth_headers(seed["member_id"]))
+    assert response.status_code == 413
+    assert _channel_messages(app, seed) == ["message 1"]
+
+# A chunked body has no Content-Length, so its size cannot be checked before it is read
+def test_bulk_requires_content_length(app, client, auth_headers, seed):
+    body = json.dumps([{"content": "message 2"}]).encode("utf-8")
+    response = client.post(_path(seed), input_stream=io.BytesIO(body),
+                           headers={**auth_headers(seed["member_id"]), "Content-Type": "application/json",
+                                    "Transfer-Encoding": "chunked"})
+    assert response.status_code == 411
+    assert _channel_messages(app, seed) == ["message 1"]
+
+def test_bulk_needs_membership(client, auth_headers, seed):
+    response = client.post(_path(seed), json=[{"content": "message 2"}], headers=auth_headers(seed["outsider_id"]))
+    assert response.status_code == 400
@@ -0,0 +1,37 @@
+# A post changes its channel's counters and version, so the channel list is not answered with a 304
+def test_post_updates_channel_counters(client, auth_headers, seed):
+    headers = auth_headers(seed["member_id"])
+    path = f"/server/{seed['server_id']}/channel/all"
+    before = client.get(path, headers=headers)
+    client.post(f"/channel/{seed['channel_id']}/message/post", json={"content": "message 2"}, headers=headers)
+    after = client.get(path, headers={**headers, "If-None-Match": before.headers["ETag"]})
+    assert after.status_code == 200
+    assert after.get_json()[0]["message_count"] == before.get_json()[0]["message_count"] + 1
+
+# Server responses leave the counters out of their channels, so a post does not make them stale
+def test_server_response_has_no_channel_counters(client, auth_headers, seed):
+    headers = auth_headers(seed["member_id"])
+    path = f"/server/{seed['server_id']}"
+    before = client.get(path, headers=headers)
+    for channel in before.get_json()["channels"]:
+        assert "message_count" not in channel
+        assert "last_message_at" not in channel
+    client.post(f"/channel/{seed['channel_id']}/message/post", json={"content": "message 2"}, headers=headers)
+    after = client.get(path, headers=headers)
+    assert after.get_json() == before.get_json()
+
+# The channel list is versioned from the server row alone, a post bumps it without touching the server's own version
+def test_channel_list_version_is_one_lookup(client, auth_headers, statements, seed):
+    headers = auth_headers(seed["member_id"])
+    channels_path = f"/server/{seed['server_id']}/channel/all"
+    channels = client.get(channels_path, headers=headers)
+    server = client.get(f"/server/{seed['server_id']}", headers=headers)
+    with statements() as sent:
+        not_modified = client.get(channels_path, headers={**headers, "If-None-Match": channels.headers["ETag"]})
+    assert not_modified.status_code == 304
+    assert len(sent) == 2
+    assert "JOIN" not in sent[1] and "sum(" not in sent[1].lower()
+    client.post(f"/channel/{seed['channel_id']}/message/post", json={"content": "message 2"}, headers=headers)
+    assert client.get(channels_path, headers={**headers, "If-None-Match": channels.headers["ETag"]}).status_code == 200
+    assert client.get(f"/server/{seed['server_id']}",
+                      headers={**headers, "If-None-Match": server.headers["ETag"]}).status_code == 304
@@ -0,0 +1,30 @@
+import pytest
+from sqlalchemy import update
+
+from main import db
+from versioning import utcnow
+from models.server import Server
+
+# Hide the server as delete does while its rows are removed in the background
+def _start_deleting(app, server_id):
+    with app.app_context():
+        db.session.execute(update(Server).where(Server.server_id == server_id).values(deleted_at=utcnow()))
+        db.session.commit()
+
+@pytest.mark.parametrize("method, path", [
+    ("GET", "/channel/{channel_id}/message/all"),
+    ("GET", "/channel/{channel_id}/message/{message_id}"),
+    ("POST", "/channel/{channel_id}/message/post"),
+    ("GET", "/server/{server_id}/channel/all"),
+    ("GET", "/server/{server_id}/member/all"),
+    ("POST", "/server/{server_id}/channel/create"),
+])
+def test_routes_of_server_being_deleted_are_not_found(app, client, auth_headers, seed, method, path):
+    headers = auth_headers(seed["admin_id"])
+    # Membership is cached by the first request
+    client.get(f"/server/{seed['server_id']}/member/all", headers=headers)
+    _start_deleting(app, seed["server_id"])
+    response = client.open(path.format(**seed), method=method, headers=headers,
+                           json={"content": "message", "channel_name": "channel 2"})
+    assert response.status_code == 404
+    assert response.get_json() == {"error": f"server with id {seed['server_id']} not found"}
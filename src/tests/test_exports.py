@@ -0,0 +1,20 @@
+from sqlalchemy import func, select
+
+from main import db
+from exports import export_server, import_server
+from models.message import Message
+
+def _message_count():
+    return db.session.scalar(select(func.count()).select_from(Message))
+
+# Loading one export twice gives two servers, the second import's message ids step around the first's
+def test_import_same_export_twice(app, seed, tmp_path):
+    path = tmp_path / "server.ndjson.gz"
+    with app.app_context():
+        export_server(db.engine, seed["server_id"], path)
+        before = _message_count()
+        first_id, first_counts = import_server(db.engine, path, batch_size=1, worker_id=1023)
+        second_id, second_counts = import_server(db.engine, path, batch_size=1, worker_id=1023)
+        assert first_id != second_id
+        assert first_counts["message"] == second_counts["message"] == 1
+        assert _message_count() == before + 2
@@ -0,0 +1,99 @@
+import sqlite3
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+import controllers.message_controller as message_controller
+from main import db
+from group_commit import GroupCommitter
+from models.message import Message
+
+# A committer of its own for every test, the shared one keeps the engine of the first app it ran for
+@pytest.fixture
+def committer(app):
+    committer = GroupCommitter()
+    committer.init_app(app)
+    committer.enabled = True
+    return committer
+
+# Same columns as the rows save() queues for a channel post
+def _row(seed, content):
+    return {"title": None, "content": content, "channel_id": seed["channel_id"], "sender_user_id": seed["member_id"],
+            "receiver_user_id": None}
+
+# Queue rows straight away and return their futures, so tests never wait on the flusher without a limit
+def _queue(committer, rows):
+    futures = []
+    for row in rows:
+        future = Future()
+        committer._queue.put((row, future))
+        futures.append(future)
+    committer._ensure_thread()
+    return futures
+
+def _contents(app):
+    with app.app_context():
+        return dict(db.session.execute(db.select(Message.message_id, Message.content)).all())
+
+# Rows queued before the flusher starts all go in one batch, their ids follow the order they were queued in
+def test_batch_returns_ids_in_submission_order(app, committer, seed):
+    futures = _queue(committer, [_row(seed, f"message {number + 2}") for number in range(20)])
+    message_ids = [future.result(timeout=10) for future in futures]
+    assert message_ids == sorted(set(message_ids))
+    assert committer.batches == 1
+    contents = _contents(app)
+    assert [contents[message_id] for message_id in message_ids] == [f"message {number + 2}" for number in range(20)]
+
+# Concurrent callers share transactions and each gets the id of its own row
+def test_concurrent_inserts_are_batched(app, committer, seed):
+    committer.window = 0.05
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        message_ids = list(executor.map(lambda number: committer.insert_message(_row(seed, f"message {number}")),
+                                        range(2, 32)))
+    assert committer.rows == 30
+    assert committer.batches < 30
+    contents = _contents(app)
+    assert [contents[message_id] for message_id in message_ids] == [f"message {number}" for number in range(2, 32)]
+
+# A row that fails is retried alone and gets its own error, the rest of its batch is still written
+def test_failed_row_does_not_fail_its_batch(app, committer, seed):
+    futures = _queue(committer, [_row(seed, "message 2"), _row(seed, None), _row(seed, "message 3")])
+    first, last = futures[0].result(timeout=10), futures[2].result(timeout=10)
+    with pytest.raises(IntegrityError):
+        futures[1].result(timeout=10)
+    contents = _contents(app)
+    assert contents[first] == "message 2" and contents[last] == "message 3"
+    assert len(contents) == 3
+
+# While the flusher is stuck writing one row, a post that waits too long gets a 503 and is never written
+def test_timed_out_post_is_never_inserted(app, client, auth_headers, committer, seed, monkeypatch):
+    monkeypatch.setattr(message_controller, "group_committer", committer)
+    committer.timeout = 0.3
+    with app.app_context():
+        path = db.engine.url.database
+    # Holding the database write lock keeps the flusher waiting on its insert
+    blocker = sqlite3.connect(path, isolation_level=None)
+    blocker.execute("BEGIN IMMEDIATE")
+    stuck = ThreadPoolExecutor(max_workers=1)
+    try:
+        first = stuck.submit(committer.insert_message, _row(seed, "message 2"))
+        while not committer._queue.empty():
+            time.sleep(0.01)
+        time.sleep(0.1)
+        response = client.post(f"/channel/{seed['channel_id']}/message/post", json={"content": "timed out"},
+                               headers=auth_headers(seed["member_id"]))
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+    finally:
+        blocker.execute("ROLLBACK")
+        blocker.close()
+    first_id = first.result(timeout=10)
+    stuck.shutdown()
+    # Rows are taken in order, so once a later row is written the timed out one has been passed over
+    last_id = _queue(committer, [_row(seed, "message 3")])[0].result(timeout=10)
+    contents = _contents(app)
+    assert contents[first_id] == "message 2" and contents[last_id] == "message 3"
+    assert "timed out" not in contents.values()
+    assert committer.rows == 2
@@ -0,0 +1,55 @@
+import json
+
+from message_events import message_events
+
+def _event(chunk):
+    fields = dict(line.split(": ", 1) for line in chunk.decode("utf-8").strip().splitlines())
+    return int(fields["id"]), fields["event"], json.loads(fields["data"])
+
+def _stream(client, headers, seed, **extra):
+    response = client.get(f"/channel/{seed['channel_id']}/message/stream", headers={**headers, **extra},
+                          buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    assert next(response.response) == b"retry: 3000\n\n"
+    return response
+
+def test_stream_receives_posted_message(client, auth_headers, seed):
+    headers = auth_headers(seed["member_id"])
+    stream = _stream(client, headers, seed)
+    try:
+        posted = client.post(f"/channel/{seed['channel_id']}/message/post", json={"content": "message 2"},
+                             headers=headers).get_json()
+        assert _event(next(stream.response)) == (1, "message.created", posted)
+    finally:
+        stream.close()
+
+# A reconnecting client gets the events after the last one it saw, then live ones
+def test_stream_replays_missed_events(client, auth_headers, seed):
+    headers = auth_headers(seed["member_id"])
+    message_id = str(seed["message_id"])
+    client.post(f"/channel/{seed['channel_id']}/message/post", json={"content": "message 2"}, headers=headers)
+    client.patch(f"/message/update/{message_id}", json={"content": "message edited"}, headers=headers)
+    client.delete(f"/message/delete/{message_id}", headers=headers)
+    stream = _stream(client, headers, seed, **{"Last-Event-ID": "1"})
+    try:
+        seq, kind, data = _event(next(stream.response))
+        assert (seq, kind, data["message_id"], data["content"]) == (2, "message.updated", message_id, "message edited")
+        assert _event(next(stream.response)) == (3, "message.deleted", {"message_id": message_id})
+    finally:
+        stream.close()
+
+def test_stream_needs_membership(client, auth_headers, seed):
+    response = client.get(f"/channel/{seed['channel_id']}/message/stream", headers=auth_headers(seed["outsider_id"]))
+    assert response.status_code == 400
+
+# Direct messages have no channel, so editing or deleting one publishes nothing
+def test_direct_message_changes_are_not_published(client, auth_headers, seed, monkeypatch):
+    published = []
+    monkeypatch.setattr(message_events, "publish", lambda *args: published.append(args))
+    headers = auth_headers(seed["admin_id"])
+    sent = client.post(f"/user/message/send/{seed['member_id']}", json={"content": "direct message"}, headers=headers)
+    message_id = sent.get_json()["message_id"]
+    assert client.patch(f"/message/update/{message_id}", json={"content": "edited"}, headers=headers).status_code == 200
+    assert client.delete(f"/message/delete/{message_id}", headers=headers).status_code == 200
+    assert published == []
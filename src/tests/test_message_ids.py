@@ -0,0 +1,23 @@
+from pagination import decode_cursor, encode_values
+
+# Ids are past 2^53, JavaScript would round them if they were sent as numbers
+def test_message_ids_are_strings(client, auth_headers, seed):
+    headers = auth_headers(seed["member_id"])
+    response = client.post(f"/channel/{seed['channel_id']}/message/post", json={"content": "message 2"},
+                           headers=headers)
+    message_id = response.get_json()["message_id"]
+    assert isinstance(message_id, str) and int(message_id) > 2 ** 53
+    page = client.get(f"/channel/{seed['channel_id']}/message/all", headers=headers).get_json()
+    assert [message["message_id"] for message in page["messages"]] == [message_id, str(seed["message_id"])]
+
+def test_cursor_takes_string_and_number_ids(seed):
+    assert decode_cursor(encode_values([str(seed["message_id"])])) == seed["message_id"]
+    assert decode_cursor(encode_values([seed["message_id"]])) == seed["message_id"]
+
+def test_read_up_to_string_id(client, auth_headers, seed):
+    headers = auth_headers(seed["admin_id"])
+    response = client.post(f"/channel/{seed['channel_id']}/message/read",
+                           json={"message_id": str(seed["message_id"])}, headers=headers)
+    assert response.status_code == 200
+    assert response.get_json()["last_read_message_id"] == str(seed["message_id"])
+    assert response.get_json()["unread_count"] == 0
@@ -0,0 +1,43 @@
+from sqlalchemy import delete, text, update
+
+from main import db
+from migrations import schema_migrations, stamp, upgrade
+from snowflake import LEGACY_ID_LIMIT
+from models.message import Message
+
+# A database from before message ids and search changed: sequence ids and no FTS table
+def _old_database(seed):
+    db.session.execute(update(Message).where(Message.message_id == seed["message_id"]).values(message_id=1))
+    for name in ("messages_fts_insert", "messages_fts_delete", "messages_fts_update"):
+        db.session.execute(text(f"DROP TRIGGER {name}"))
+    db.session.execute(text("DROP TABLE messages_fts"))
+    db.session.commit()
+    stamp(db.engine)
+    db.session.execute(delete(schema_migrations).where(schema_migrations.c.version >= 4))
+    db.session.commit()
+
+def test_upgrade_moves_ids_and_adds_search(app, client, auth_headers, seed):
+    with app.app_context():
+        _old_database(seed)
+        applied = upgrade(db.engine)
+        assert applied == ["time ordered 64-bit message ids", "message search index",
+                           "monthly message partitions and message retention", "channel list versions"]
+        message_ids = db.session.execute(db.select(Message.message_id)).scalars().all()
+        assert message_ids and all(message_id >= LEGACY_ID_LIMIT for message_id in message_ids)
+        assert upgrade(db.engine) == []
+    response = client.get(f"/channel/{seed['channel_id']}/message/search?q=message",
+                          headers=auth_headers(seed["member_id"]))
+    assert response.status_code == 200
+    assert [message["content"] for message in response.get_json()["messages"]] == ["message 1"]
+
+def test_upgrade_adds_channel_list_versions(app, client, auth_headers, seed):
+    with app.app_context():
+        stamp(db.engine)
+        for column in ("channels_version", "channels_updated_at"):
+            db.session.execute(text(f"ALTER TABLE servers DROP COLUMN {column}"))
+        db.session.execute(delete(schema_migrations).where(schema_migrations.c.version == 7))
+        db.session.commit()
+        assert upgrade(db.engine) == ["channel list versions"]
+    response = client.get(f"/server/{seed['server_id']}/channel/all", headers=auth_headers(seed["member_id"]))
+    assert response.status_code == 200
+    assert response.headers["ETag"]
@@ -0,0 +1,30 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from password_hasher import PasswordHasher, HasherBusyError
+
+def _wait(event):
+    event.wait(5)
+    return True
+
+# A hash that times out keeps its place in the queue until the pool has actually finished it
+def test_timed_out_hash_counts_until_finished(app):
+    hasher = PasswordHasher()
+    hasher.pool_size, hasher.queue_limit, hasher.timeout = 1, 4, 0.05
+    # Threads stand in for worker processes so the test can hold the work back
+    hasher._pool = ThreadPoolExecutor(max_workers=1)
+    release = threading.Event()
+    with app.test_request_context():
+        with pytest.raises(HasherBusyError):
+            hasher._run(_wait, release)
+        assert hasher.queue_depth == 1
+        # Queued behind the running one, so cancelling it frees its place straight away
+        with pytest.raises(HasherBusyError):
+            hasher._run(_wait, release)
+        assert hasher.queue_depth == 1
+        release.set()
+        hasher._pool.shutdown(wait=True)
+    assert hasher.queue_depth == 0
+    assert hasher.rejected == 2
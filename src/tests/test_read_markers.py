@@ -0,0 +1,36 @@
+from sqlalchemy import func, select, update
+
+from main import db
+from read_markers import reconcile_all_markers
+from synthetic_data import seed_synthetic
+from models.read_marker import ReadMarker
+
+def _unread(user_id, channel_id):
+    return db.session.scalar(select(ReadMarker.unread_count)
+                             .where(ReadMarker.user_id == user_id, ReadMarker.channel_id == channel_id))
+
+def test_read_channel_clears_unread(client, auth_headers, seed):
+    headers = auth_headers(seed["admin_id"])
+    client.post(f"/channel/{seed['channel_id']}/message/post", json={"content": "message 2"},
+                headers=auth_headers(seed["member_id"]))
+    response = client.post(f"/channel/{seed['channel_id']}/message/read", json={}, headers=headers)
+    assert response.status_code == 200
+    assert response.get_json()["unread_count"] == 0
+
+def test_reconcile_fixes_wrong_unread_counts(app, seed):
+    with app.app_context():
+        expected = _unread(seed["admin_id"], seed["channel_id"])
+        db.session.execute(update(ReadMarker).values(unread_count=ReadMarker.unread_count + 5))
+        db.session.commit()
+        assert reconcile_all_markers(db.session, batch_size=1) == 2
+        assert _unread(seed["admin_id"], seed["channel_id"]) == expected
+        assert reconcile_all_markers(db.session, batch_size=1) == 0
+
+# Synthetic rows are bulk inserted past the session events, markers are added afterwards
+def test_synthetic_seed_adds_read_markers(app):
+    with app.app_context():
+        seed_synthetic(users=20, servers=3, channels=6, messages=200, seed=1, batch_size=50)
+        assert db.session.scalar(select(func.count()).select_from(ReadMarker)
+                                 .where(ReadMarker.channel_id.is_not(None))) > 0
+        assert db.session.scalar(select(func.count()).select_from(ReadMarker)
+                                 .where(ReadMarker.peer_user_id.is_not(None))) > 0
@@ -0,0 +1,112 @@
+from datetime import date
+
+import pytest
+from sqlalchemy import text
+
+from main import db
+from models.server import Server
+from models.server_member import ServerMember
+from models.channel import Channel
+from models.message import Message
+
+# Channel 1 gets apple messages of its own, and a second server user 2 is not in gets a channel with one more
+@pytest.fixture
+def messages(app, seed):
+    with app.app_context():
+        db.session.add(Server(server_id=2, server_name="server 2", created_on=date.today(),
+                              creator_user_id=seed["outsider_id"]))
+        db.session.flush()
+        db.session.add_all([
+            ServerMember(joined_on=date.today(), is_admin=True, server_id=2, user_id=seed["outsider_id"]),
+            Channel(channel_id=2, channel_name="channel 2", created_on=date.today(), server_id=2,
+                    creator_user_id=seed["outsider_id"])
+        ])
+        db.session.flush()
+        rows = [
+            Message(title="fruit", content="apple apple apple", channel_id=seed["channel_id"],
+                    sender_user_id=seed["admin_id"]),
+            Message(content="an apple among many other words in a long message", channel_id=seed["channel_id"],
+                    sender_user_id=seed["member_id"]),
+            Message(content="banana bread", channel_id=seed["channel_id"], sender_user_id=seed["member_id"]),
+            Message(content="secret apple", channel_id=2, sender_user_id=seed["outsider_id"]),
+            Message(content="direct apple", sender_user_id=seed["admin_id"], receiver_user_id=seed["member_id"]),
+            Message(content="other direct apple", sender_user_id=seed["admin_id"], receiver_user_id=seed["outsider_id"])
+        ]
+        db.session.add_all(rows)
+        db.session.commit()
+        return {row.content: str(row.message_id) for row in rows}
+
+def _search(client, headers, path, **args):
+    response = client.get(path, query_string=args, headers=headers)
+    assert response.status_code == 200
+    return response.get_json()
+
+def _contents(body):
+    return [message["content"] for message in body["messages"]]
+
+def test_channel_search_ranks_best_match_first(client, auth_headers, seed, messages):
+    body = _search(client, auth_headers(seed["member_id"]), f"/channel/{seed['channel_id']}/message/search", q="apple")
+    assert _contents(body) == ["apple apple apple", "an apple among many other words in a long message"]
+    assert body["before"] is None
+
+# Titles are searched along with content
+def test_search_matches_title(client, auth_headers, seed, messages):
+    body = _search(client, auth_headers(seed["member_id"]), f"/channel/{seed['channel_id']}/message/search", q="fruit")
+    assert _contents(body) == ["apple apple apple"]
+
+def test_search_pages_on_rank(client, auth_headers, seed, messages):
+    headers = auth_headers(seed["member_id"])
+    path = f"/channel/{seed['channel_id']}/message/search"
+    first = _search(client, headers, path, q="apple", limit=1)
+    second = _search(client, headers, path, q="apple", limit=1, before=first["before"])
+    assert _contents(first) + _contents(second) == ["apple apple apple",
+                                                    "an apple among many other words in a long message"]
+    assert second["before"] is None
+
+# Server search covers every channel of the server and nothing outside it
+def test_server_search_stays_in_server(client, auth_headers, seed, messages):
+    headers = auth_headers(seed["member_id"])
+    body = _search(client, headers, f"/server/{seed['server_id']}/message/search", q="apple")
+    assert sorted(_contents(body)) == ["an apple among many other words in a long message", "apple apple apple"]
+    assert client.get("/server/2/message/search?q=apple", headers=headers).status_code == 400
+    assert client.get("/channel/2/message/search?q=apple", headers=headers).status_code == 400
+
+def test_direct_search_only_finds_own_messages(client, auth_headers, seed, messages):
+    body = _search(client, auth_headers(seed["member_id"]), "/user/message/search", q="apple")
+    assert _contents(body) == ["direct apple"]
+    body = _search(client, auth_headers(seed["admin_id"]), "/user/message/search", q="apple")
+    assert sorted(_contents(body)) == ["direct apple", "other direct apple"]
+
+def _indexed_ids(app, word):
+    with app.app_context():
+        return {str(rowid) for rowid in db.session.execute(
+            text("SELECT rowid FROM messages_fts WHERE messages_fts MATCH :word"), {"word": word}
+        ).scalars()}
+
+# The triggers keep the FTS table in step with edits and deletes
+def test_edited_and_deleted_messages_leave_the_index(app, client, auth_headers, seed, messages):
+    headers = auth_headers(seed["member_id"])
+    path = f"/channel/{seed['channel_id']}/message/search"
+    deleted_id = messages["an apple among many other words in a long message"]
+    assert deleted_id in _indexed_ids(app, "apple")
+    client.delete(f"/message/delete/{deleted_id}", headers=headers)
+    assert deleted_id not in _indexed_ids(app, "apple")
+    assert messages["banana bread"] in _indexed_ids(app, "banana")
+    client.patch(f"/message/update/{messages['banana bread']}", json={"content": "cherry bread"}, headers=headers)
+    assert _contents(_search(client, headers, path, q="apple")) == ["apple apple apple"]
+    assert _contents(_search(client, headers, path, q="banana")) == []
+    assert _contents(_search(client, headers, path, q="cherry")) == ["cherry bread"]
+    assert messages["banana bread"] not in _indexed_ids(app, "banana")
+
+# Words are quoted, so FTS5 operators and stray quotes are searched for as text
+@pytest.mark.parametrize("text", ['apple"', "apple OR", "NEAR(apple", "content:apple"])
+def test_search_text_is_not_query_syntax(client, auth_headers, seed, messages, text):
+    response = client.get(f"/channel/{seed['channel_id']}/message/search", query_string={"q": text},
+                          headers=auth_headers(seed["member_id"]))
+    assert response.status_code == 200
+
+def test_search_needs_text(client, auth_headers, seed):
+    response = client.get(f"/channel/{seed['channel_id']}/message/search?q=%20",
+                          headers=auth_headers(seed["member_id"]))
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "search query q is required"}
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+from flask import current_app
+
+from main import db
+from serializer import compile_schema, dump_many, json_response
+from sparse_fields import select_fields
+from models.channel import Channel, channels_schema
+from models.message import Message, messages_schema
+
+# Messages covering each kind of value the schema dumps: no title, non-ascii text, a direct message
+def _add_messages(seed):
+    db.session.add_all([
+        Message(title=None, content="no title", channel_id=seed["channel_id"], sender_user_id=seed["admin_id"]),
+        Message(title="café", content="日本語 \U0001f600", channel_id=seed["channel_id"],
+                sender_user_id=seed["member_id"]),
+        Message(content="direct", sender_user_id=seed["admin_id"], receiver_user_id=seed["member_id"])
+    ])
+    db.session.commit()
+
+# Compare the compiled dump with marshmallow's one object and one field at a time
+def _assert_same(expected, actual):
+    assert len(actual) == len(expected)
+    for expected_obj, actual_obj in zip(expected, actual):
+        assert list(actual_obj) == list(expected_obj)
+        for name in expected_obj:
+            assert actual_obj[name] == expected_obj[name], name
+
+def test_message_dump_matches_marshmallow(app, seed):
+    with app.app_context():
+        _add_messages(seed)
+        messages = Message.query.order_by(Message.message_id).all()
+        _assert_same(messages_schema.dump(messages), dump_many(messages_schema, messages))
+
+def test_channel_dump_matches_marshmallow(app, seed):
+    with app.app_context():
+        _add_messages(seed)
+        channels = Channel.query.all()
+        _assert_same(channels_schema.dump(channels), dump_many(channels_schema, channels))
+
+@pytest.mark.parametrize("query", ["fields=message_id,title", "expand=sender_user,channel",
+                                   "fields=content&expand=receiver_user"])
+def test_narrowed_message_dump_matches_marshmallow(app, seed, query):
+    with app.test_request_context(f"/?{query}"):
+        _add_messages(seed)
+        schema, _ = select_fields(messages_schema, Message)
+        messages = Message.query.order_by(Message.message_id).all()
+        _assert_same(schema.dump(messages), dump_many(schema, messages))
+
+# The encoded body is byte for byte what Flask makes from the same data
+def test_json_response_matches_flask(app, seed):
+    with app.test_request_context("/"):
+        _add_messages(seed)
+        data = {"messages": messages_schema.dump(Message.query.order_by(Message.message_id).all()), "before": None}
+        assert json_response(data).get_data() == current_app.json.response(data).get_data()
+        assert json.loads(json_response(data).get_data()) == data
+
+def test_compiled_schema_is_reused():
+    assert compile_schema(messages_schema) is compile_schema(messages_schema)
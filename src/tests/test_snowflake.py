@@ -0,0 +1,44 @@
+import pytest
+from flask import Flask
+
+from snowflake import MAX_WORKER_ID, SEQUENCE_BITS, SnowflakeGenerator, WorkerIdError
+
+def _worker(snowflake_id):
+    return (snowflake_id >> SEQUENCE_BITS) & MAX_WORKER_ID
+
+# A generator of its own on a bare app, so the app's shared generator keeps its settings
+def _generator(tmp_path, **config):
+    app = Flask(__name__)
+    app.config.update({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'ids.db'}", **config})
+    generator = SnowflakeGenerator()
+    generator.init_app(app)
+    return generator
+
+def test_configured_worker_id(tmp_path):
+    generator = _generator(tmp_path, SNOWFLAKE_WORKER_ID="7")
+    ids = [generator.next_id() for _ in range(1000)]
+    assert ids == sorted(set(ids))
+    assert {_worker(snowflake_id) for snowflake_id in ids} == {7}
+
+def test_message_ids_use_configured_worker(client, auth_headers, seed):
+    response = client.post(f"/channel/{seed['channel_id']}/message/post", json={"content": "message 2"},
+                           headers=auth_headers(seed["member_id"]))
+    assert _worker(int(response.get_json()["message_id"])) == 0
+
+# Without a worker id set, only Postgres can hand out one no other process holds
+def test_unset_worker_id_fails_without_postgres(tmp_path):
+    generator = _generator(tmp_path)
+    with pytest.raises(WorkerIdError):
+        generator.next_id()
+
+# Session advisory locks do not stay with one client behind a transaction pooler
+def test_unset_worker_id_fails_behind_transaction_pooler(tmp_path, monkeypatch):
+    monkeypatch.setenv("DB_POOLER_MODE", "transaction")
+    generator = _generator(tmp_path, SQLALCHEMY_DATABASE_URI="postgresql://localhost/unused")
+    with pytest.raises(WorkerIdError):
+        generator.next_id()
+
+def test_worker_id_out_of_range(tmp_path):
+    generator = _generator(tmp_path, SNOWFLAKE_WORKER_ID=MAX_WORKER_ID + 1)
+    with pytest.raises(ValueError):
+        generator.next_id()
@@ -0,0 +1,58 @@
+import json
+
+import pytest
+from sqlalchemy import insert
+
+from main import db
+from serializer import NDJSON_MIMETYPE
+from models.message import Message
+
+LIST_PATHS = ["/server/{server_id}/channel/all", "/server/{server_id}/member/all", "/server/all/user/{admin_id}"]
+
+@pytest.mark.parametrize("path", LIST_PATHS)
+def test_list_responses_vary_by_accept(client, auth_headers, seed, path):
+    headers = auth_headers(seed["admin_id"])
+    for accept in ("application/json", NDJSON_MIMETYPE):
+        response = client.get(path.format(**seed), headers={**headers, "Accept": accept})
+        assert response.status_code == 200
+        assert "Accept" in response.vary
+
+def test_ndjson_list(client, auth_headers, seed):
+    response = client.get(f"/server/{seed['server_id']}/member/all",
+                          headers={**auth_headers(seed["admin_id"]), "Accept": NDJSON_MIMETYPE})
+    assert response.mimetype == NDJSON_MIMETYPE
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [row["member_id"] for row in rows] == [1, 2]
+
+# A JSON ETag must not revalidate an NDJSON request, or the client would keep a body in the wrong format
+@pytest.mark.parametrize("path", LIST_PATHS[:2])
+def test_etag_depends_on_format(client, auth_headers, seed, path):
+    headers = auth_headers(seed["admin_id"])
+    json_response = client.get(path.format(**seed), headers={**headers, "Accept": "application/json"})
+    ndjson_response = client.get(path.format(**seed), headers={**headers, "Accept": NDJSON_MIMETYPE,
+                                                                "If-None-Match": json_response.headers["ETag"]})
+    assert ndjson_response.status_code == 200
+    assert ndjson_response.headers["ETag"] != json_response.headers["ETag"]
+    not_modified = client.get(path.format(**seed), headers={**headers, "Accept": NDJSON_MIMETYPE,
+                                                             "If-None-Match": ndjson_response.headers["ETag"]})
+    assert not_modified.status_code == 304
+    assert "Accept" in not_modified.vary
+
+# Streamed channels would otherwise load every message of the server with each batch of channels
+def test_streamed_channels_leave_out_messages(app, client, auth_headers, statements, seed):
+    with app.app_context():
+        db.session.execute(insert(Message), [{"content": f"message {number}", "channel_id": seed["channel_id"],
+                                              "sender_user_id": seed["member_id"]} for number in range(2, 1002)])
+        db.session.commit()
+    headers = {**auth_headers(seed["admin_id"]), "Accept": NDJSON_MIMETYPE}
+    path = f"/server/{seed['server_id']}/channel/all"
+    with statements() as sent:
+        response = client.get(path, headers=headers)
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [row["channel_id"] for row in rows] == [seed["channel_id"]]
+    assert "messages" not in rows[0]
+    assert rows[0]["user"]["user_id"] == seed["admin_id"]
+    assert not [statement for statement in sent if "FROM messages" in statement]
+    expanded = client.get(path + "?expand=messages", headers=headers)
+    rows = [json.loads(line) for line in expanded.get_data(as_text=True).splitlines()]
+    assert len(rows[0]["messages"]) == 1001
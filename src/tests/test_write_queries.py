@@ -0,0 +1,58 @@
+from datetime import date
+
+import pytest
+
+from main import db
+from models.user import User
+from models.server import Server
+from models.server_member import ServerMember
+from models.channel import Channel
+from models.message import Message
+
+# Write routes dump the row they saved with its nested members, channels and messages
+WRITE_ROUTES = [
+    ("POST", "/server/create", {"server_name": "server 2"}),
+    ("PATCH", "/server/update/{server_id}", {"server_name": "server renamed"}),
+    ("POST", "/server/{server_id}/channel/create", {"channel_name": "channel 2"}),
+    ("PATCH", "/server/{server_id}/channel/update/{channel_id}", {"channel_name": "channel renamed"}),
+    ("PATCH", "/user/updateaccount", {"status": "away"}),
+]
+
+# Give the admin more servers and the seeded server more members, channels and messages, each from a new user
+def _add_rows(app, seed, rows):
+    with app.app_context():
+        users = [User(username=f"extra{number}", email=f"extra{number}@email.com", password="not a hash",
+                      name=f"extra {number}", status="online") for number in range(rows)]
+        db.session.add_all(users)
+        db.session.flush()
+        for number, user in enumerate(users):
+            db.session.add_all([
+                Server(server_name=f"extra server {number}", created_on=date.today(), creator_user_id=seed["admin_id"]),
+                ServerMember(joined_on=date.today(), server_id=seed["server_id"], user_id=user.user_id),
+                Channel(channel_name=f"extra channel {number}", created_on=date.today(), server_id=seed["server_id"],
+                        creator_user_id=user.user_id),
+                Message(content=f"extra message {number}", channel_id=seed["channel_id"], sender_user_id=user.user_id)
+            ])
+        db.session.commit()
+
+def _count(client, statements, method, path, body, headers):
+    with statements() as sent:
+        response = client.open(path, method=method, json=body, headers=headers)
+    assert response.status_code in (200, 201)
+    return len(sent)
+
+# Relationships are loaded with the saved row, so more rows to dump never means more queries
+@pytest.mark.parametrize("method, path, body", WRITE_ROUTES)
+def test_write_route_query_count_does_not_grow(app, client, auth_headers, statements, seed, method, path, body):
+    headers = auth_headers(seed["admin_id"])
+    path = path.format(**seed)
+    client.open(path, method=method, json=body, headers=headers)
+    before = _count(client, statements, method, path, body, headers)
+    _add_rows(app, seed, 10)
+    after = _count(client, statements, method, path, body, headers)
+    assert after == before
+
+def test_update_account_dumps_requested_fields(client, auth_headers, seed):
+    response = client.patch("/user/updateaccount?fields=user_id,status", json={"status": "away"},
+                            headers=auth_headers(seed["admin_id"]))
+    assert response.get_json() == {"user_id": seed["admin_id"], "status": "away"}
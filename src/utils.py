@@ -1,24 +1,120 @@
 import functools
 
+from flask import g, request
 from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import and_, literal, select
+from sqlalchemy.orm import aliased
 
+from main import db
+from membership_cache import membership_cache, MISSING
+from models.user import User
 from models.server import Server
 from models.server_member import ServerMember
 from models.channel import Channel
 from models.message import Message
 
+# Server, channel, message and membership rows the current request is about
+class AuthContext:
+    def __init__(self, server=None, channel=None, message=None, member=None, target_member=None):
+        self.server = server
+        self.channel = channel
+        self.message = message
+        # Server membership of the logged in user, a ServerMember or CachedMember
+        self.member = member
+        # Server membership referenced by member_id in the route
+        self.target_member = target_member
+
+# Fetch user unless missing or being deleted
+def active_user(user_id):
+    user = db.session.get(User, user_id)
+    return user if user and user.deleted_at is None else None
+
+# Fetch server unless missing or being deleted
+def active_server(server_id):
+    server = db.session.get(Server, server_id)
+    return server if server and server.deleted_at is None else None
+
+# Resolve everything the route ids point at in one joined query
+# Each id in the route is outer joined onto a single anchor row, so missing
+# rows come back as None and the decorators can still report which one is missing
+def load_auth_context(server_id=None, channel_id=None, message_id=None, member_id=None):
+    # Membership of the caller may already be cached when the server id is in the route
+    user_id = get_jwt_identity()
+    cached_member = MISSING
+    if server_id is not None:
+        cached_member = membership_cache.get(user_id, server_id)
+
+    anchor = select(literal(1).label("anchor")).subquery()
+    caller = aliased(ServerMember)
+    target = aliased(ServerMember)
+    entities = []
+    stmt = select().select_from(anchor)
+
+    if message_id is not None:
+        entities.append(Message)
+        stmt = stmt.outerjoin(Message, Message.message_id == message_id)
+
+    if channel_id is not None:
+        entities.append(Channel)
+        stmt = stmt.outerjoin(Channel, Channel.channel_id == channel_id)
+
+    # Server comes from the route, or from the channel when only a channel is given
+    if server_id is not None:
+        entities.append(Server)
+        stmt = stmt.outerjoin(Server, and_(Server.server_id == server_id, Server.deleted_at.is_(None)))
+    elif channel_id is not None:
+        entities.append(Server)
+        stmt = stmt.outerjoin(Server, and_(Server.server_id == Channel.server_id, Server.deleted_at.is_(None)))
+
+    if Server in entities and cached_member is MISSING:
+        entities.append(caller)
+        stmt = stmt.outerjoin(caller, and_(caller.server_id == Server.server_id,
+                                           caller.user_id == user_id))
+
+    if member_id is not None:
+        entities.append(target)
+        stmt = stmt.outerjoin(target, target.member_id == member_id)
+
+    # The anchor column keeps the row when every entity is missing, the ORM drops a row whose only entity is None
+    row = db.session.execute(stmt.add_columns(anchor.c.anchor, *entities)).one()
+    loaded = dict(zip(entities, row[1:]))
+    server = loaded.get(Server)
+    member = loaded.get(caller)
+    if cached_member is not MISSING:
+        member = cached_member
+    elif server:
+        membership_cache.set(user_id, server.server_id, member)
+    return AuthContext(
+        server=server,
+        channel=loaded.get(Channel),
+        message=loaded.get(Message),
+        member=member,
+        target_member=loaded.get(target)
+    )
+
+# Get authorisation context for current request, loading it on first use
+def auth_context():
+    if "auth_context" not in g:
+        view_args = request.view_args or {}
+        g.auth_context = load_auth_context(
+            server_id=view_args.get("server_id"),
+            channel_id=view_args.get("channel_id"),
+            message_id=view_args.get("message_id"),
+            member_id=view_args.get("member_id")
+        )
+    return g.auth_context
+
 # Check if user is existing member of server using server_id
 def current_member(id_arg_name):
     def decorator(fn):
         @functools.wraps(fn)
-        def wrapper(*args, **kwargs): 
+        def wrapper(*args, **kwargs):
             server_id = kwargs.get(id_arg_name)
-            server = Server.query.get(server_id)
-            if not server:
+            context = auth_context()
+            if not context.server:
                 return {"error": f"server with id {server_id} not found"}, 404
-            server_member = ServerMember.query.filter_by(server=server, user_id=get_jwt_identity()).first()
-            if not server_member:
-                return {"error": f"user not a member of server {server.server_name}"}, 400
+            if not context.member:
+                return {"error": f"user not a member of server {context.server.server_name}"}, 400
             return fn(*args, **kwargs)
         return wrapper
     return decorator
@@ -27,11 +123,12 @@ def current_member(id_arg_name):
 def auth_as_admin (id_arg_name):
     def decorator(fn):
         @functools.wraps(fn)
-        def wrapper(*args, **kwargs): 
+        def wrapper(*args, **kwargs):
             server_id = kwargs.get(id_arg_name)
-            server = Server.query.get(server_id)
-            server_member = ServerMember.query.filter_by(server=server, user_id=get_jwt_identity()).first()
-            if not server_member.is_admin:
+            context = auth_context()
+            if not context.server:
+                return {"error": f"server with id {server_id} not found"}, 404
+            if not context.member or not context.member.is_admin:
                 return {"error": "user not authorised to perform this action"}, 403
             return fn(*args, **kwargs)
         return wrapper
@@ -41,18 +138,16 @@ def auth_as_admin (id_arg_name):
 def member_exist(id1_arg_name, id2_arg_name):
     def decorator(fn):
         @functools.wraps(fn)
-        def wrapper(*args, **kwargs): 
+        def wrapper(*args, **kwargs):
             server_id = kwargs.get(id1_arg_name)
             member_id = kwargs.get(id2_arg_name)
-            server = Server.query.get(server_id)
-            server_member = ServerMember.query.get(member_id)
-            if not server:
+            context = auth_context()
+            if not context.server:
                 return {"error": f"server with id {server_id} not found"}, 404
-            if not server_member:
+            if not context.target_member:
                 return {"error": f"member with id {member_id} not found"}, 404
-            member_filter = ServerMember.query.filter_by(server_id=server_id, member_id=member_id).first()
-            if not member_filter:
-                return {"error": f"member with id {member_id} not found in server {server.server_name}"}, 404
+            if context.target_member.server_id != context.server.server_id:
+                return {"error": f"member with id {member_id} not found in server {context.server.server_name}"}, 404
             return fn(*args, **kwargs)
         return wrapper
     return decorator
@@ -61,38 +156,37 @@ def member_exist(id1_arg_name, id2_arg_name):
 def channel_exist(id1_arg_name, id2_arg_name):
     def decorator(fn):
         @functools.wraps(fn)
-        def wrapper(*args, **kwargs): 
+        def wrapper(*args, **kwargs):
             server_id = kwargs.get(id1_arg_name)
             channel_id = kwargs.get(id2_arg_name)
-            server = Server.query.get(server_id)
-            channel = Channel.query.get(channel_id)
-            if not server:
+            context = auth_context()
+            if not context.server:
                 return {"error": f"server with id {server_id} not found"}, 404
-            if not channel:
+            if not context.channel:
                 return {"error": f"channel with id {channel_id} not found"}, 404
-            channel_filter = Channel.query.filter_by(server=server, channel_id=channel_id).first()
-            if not channel_filter:
-                return {"error": f"channel with id {channel_id} not found in server {server.server_name}"}, 404
+            if context.channel.server_id != context.server.server_id:
+                return {"error": f"channel with id {channel_id} not found in server {context.server.server_name}"}, 404
             return fn(*args, **kwargs)
         return wrapper
     return decorator
 
-# Check if message exusts in channel 
+# Check if message exusts in channel
 def channel_message_exist(id1_arg_name, id2_arg_name):
     def decorator(fn):
         @functools.wraps(fn)
-        def wrapper(*args, **kwargs): 
+        def wrapper(*args, **kwargs):
             channel_id = kwargs.get(id1_arg_name)
             message_id = kwargs.get(id2_arg_name)
-            channel = Channel.query.get(channel_id)
-            message = Message.query.get(message_id)
-            if not channel:
+            context = auth_context()
+            if not context.channel:
                 return {"error": f"channel with id {channel_id} not found"}, 404
-            if not message:
+            # Server is None while it is being deleted
+            if not context.server:
+                return {"error": f"server with id {context.channel.server_id} not found"}, 404
+            if not context.message:
                 return {"error": f"message with id {message_id} not found"}, 404
-            message_filter = Message.query.filter_by(channel=channel, message_id=message_id).first()
-            if not message_filter:
-                return {"error": f"message with id {message_id} not found in channel {channel.channel_name}"}, 404
+            if context.message.channel_id != context.channel.channel_id:
+                return {"error": f"message with id {message_id} not found in channel {context.channel.channel_name}"}, 404
             return fn(*args, **kwargs)
         return wrapper
     return decorator
@@ -101,13 +195,12 @@ def channel_message_exist(id1_arg_name, id2_arg_name):
 def message_exist(id1_arg_name):
     def decorator(fn):
         @functools.wraps(fn)
-        def wrapper(*args, **kwargs): 
+        def wrapper(*args, **kwargs):
             message_id = kwargs.get(id1_arg_name)
-            message = Message.query.get(message_id)
-            if not message:
+            context = auth_context()
+            if not context.message:
                 return {"error": f"message with id {message_id} not found"}, 404
-            message_filter = Message.query.filter_by(message_id=message_id, sender_user_id=get_jwt_identity()).first()
-            if not message_filter:
+            if str(context.message.sender_user_id) != get_jwt_identity():
                 return {"error": f"message with id {message_id} does not belong to user"}, 404
             return fn(*args, **kwargs)
         return wrapper
@@ -117,15 +210,16 @@ def message_exist(id1_arg_name):
 def current_member_check(id_arg_name):
     def decorator(fn):
         @functools.wraps(fn)
-        def wrapper(*args, **kwargs): 
+        def wrapper(*args, **kwargs):
             channel_id = kwargs.get(id_arg_name)
-            channel = Channel.query.get(channel_id)
-            if not channel:
+            context = auth_context()
+            if not context.channel:
                 return {"error": f"channel with id {channel_id} not found"}, 404
-            server = Server.query.get(channel.server.server_id)
-            server_member = ServerMember.query.filter_by(server=server, user_id=get_jwt_identity()).first()
-            if not server_member:
-                return {"error": f"user not a member of server {server.server_name}"}, 400
+            # Server is None while it is being deleted
+            if not context.server:
+                return {"error": f"server with id {context.channel.server_id} not found"}, 404
+            if not context.member:
+                return {"error": f"user not a member of server {context.server.server_name}"}, 400
             return fn(*args, **kwargs)
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
@@ -0,0 +1,144 @@
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy import event, inspect, select, update
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+# User fields shown inside server, member and channel responses
+USER_DISPLAY_FIELDS = ("username", "name", "status")
+
+# Naive UTC time for updated_at columns
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+
+# Called with the scopes ("server:<id>", "user:<creator id>") of committed changes
+_commit_listeners = []
+
+# Register a function to run with changed scopes after every commit that changed them
+def on_commit(listener):
+    if listener not in _commit_listeners:
+        _commit_listeners.append(listener)
+
+# Tell listeners about changes committed outside the session, e.g. by group commit
+def notify_committed(scopes):
+    if scopes:
+        for listener in _commit_listeners:
+            # The change is already committed, a failing listener must not fail the caller
+            try:
+                listener(scopes)
+            except Exception:
+                logger.exception("commit listener %r failed", listener)
+
+# Add one to version and set updated_at of the given servers and channels
+# Bumped channels also bump channels_version of their servers, which versions the channel list
+# Changes to a user's display fields bump every server they belong to or created,
+# and every channel in those servers, since their responses embed the user
+# Returns the scopes whose responses changed
+def bump_versions(connection, server_ids=(), channel_ids=(), user_ids=()):
+    from models.server import Server
+    from models.server_member import ServerMember
+    from models.channel import Channel
+    servers = Server.__table__
+    channels = Channel.__table__
+    now = utcnow()
+    scopes = set()
+    server_ids = {server_id for server_id in server_ids if server_id is not None}
+    channel_ids = {channel_id for channel_id in channel_ids if channel_id is not None}
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if user_ids:
+        user_server_ids = set(connection.execute(
+            select(ServerMember.__table__.c.server_id).where(ServerMember.__table__.c.user_id.in_(user_ids))
+            .union(select(servers.c.server_id).where(servers.c.creator_user_id.in_(user_ids)))
+        ).scalars())
+        if user_server_ids:
+            connection.execute(update(channels).where(channels.c.server_id.in_(sorted(user_server_ids)))
+                               .values(version=channels.c.version + 1, updated_at=now))
+        server_ids |= user_server_ids
+    if server_ids:
+        rows = connection.execute(update(servers).where(servers.c.server_id.in_(sorted(server_ids)))
+                                  .values(version=servers.c.version + 1, updated_at=now)
+                                  .returning(servers.c.server_id, servers.c.creator_user_id))
+        for server_id, creator_user_id in rows:
+            scopes.update((f"server:{server_id}", f"user:{creator_user_id}"))
+    if channel_ids:
+        channel_server_ids = set(connection.execute(
+            update(channels).where(channels.c.channel_id.in_(sorted(channel_ids)))
+            .values(version=channels.c.version + 1, updated_at=now)
+            .returning(channels.c.server_id)
+        ).scalars())
+        # Channels are locked before their server, the order every other write takes them in
+        if channel_server_ids:
+            connection.execute(update(servers).where(servers.c.server_id.in_(sorted(channel_server_ids)))
+                               .values(channels_version=servers.c.channels_version + 1, channels_updated_at=now))
+        scopes.update(f"server:{server_id}" for server_id in channel_server_ids)
+    return scopes
+
+# Bump versions inside the session's transaction, listeners hear about it once the session commits
+def bump_session_versions(session, server_ids=(), channel_ids=(), user_ids=()):
+    scopes = bump_versions(session.connection(), server_ids, channel_ids, user_ids)
+    session.info.setdefault("changed_scopes", set()).update(scopes)
+
+# Models whose own version and updated_at change with every update
+def _versioned():
+    from models.server import Server
+    from models.server_member import ServerMember
+    from models.channel import Channel
+    from models.message import Message
+    return (Server, Channel, ServerMember, Message)
+
+# Bump modified rows in the same UPDATE and note which parents need bumping after the flush
+# A new child whose parent is also new has no parent id yet, the new parent starts at version 1
+def _before_flush(session, flush_context, instances):
+    from models.user import User
+    from models.server import Server
+    from models.server_member import ServerMember
+    from models.channel import Channel
+    from models.message import Message
+    versioned = _versioned()
+    modified = [obj for obj in session.dirty if session.is_modified(obj, include_collections=False)]
+    bumps = session.info.setdefault("version_bumps",
+                                    {"servers": set(), "channels": set(), "users": set(), "server_rows": []})
+    now = utcnow()
+    for obj in modified:
+        if isinstance(obj, versioned):
+            obj.version = type(obj).version + 1
+            obj.updated_at = now
+        if isinstance(obj, User) and any(inspect(obj).attrs[name].history.has_changes()
+                                         for name in USER_DISPLAY_FIELDS):
+            bumps["users"].add(obj.user_id)
+    for obj in [*session.new, *modified, *session.deleted]:
+        if isinstance(obj, Server):
+            bumps["server_rows"].append(obj)
+        elif isinstance(obj, Message):
+            bumps["channels"].add(obj.channel_id)
+        elif isinstance(obj, (Channel, ServerMember)):
+            bumps["servers"].add(obj.server_id)
+
+# Servers written by the flush itself have their ids once it is done, new ones included
+def _after_flush(session, flush_context):
+    bumps = session.info.pop("version_bumps", None)
+    if not bumps:
+        return
+    scopes = session.info.setdefault("changed_scopes", set())
+    for server in bumps["server_rows"]:
+        scopes.update((f"server:{server.server_id}", f"user:{server.creator_user_id}"))
+    if bumps["servers"] or bumps["channels"] or bumps["users"]:
+        bump_session_versions(session, bumps["servers"], bumps["channels"], bumps["users"])
+
+def _after_commit(session):
+    notify_committed(session.info.pop("changed_scopes", None))
+
+def _after_rollback(session, previous_transaction):
+    session.info.pop("changed_scopes", None)
+    session.info.pop("version_bumps", None)
+
+# Register session events that keep version columns current for ORM writes and report them on commit
+# Writes that bypass the unit of work (bulk inserts, group commit) bump versions themselves
+def init_app(app):
+    if not event.contains(Session, "before_flush", _before_flush):
+        event.listen(Session, "before_flush", _before_flush)
+        event.listen(Session, "after_flush", _after_flush)
+        event.listen(Session, "after_commit", _after_commit)
+        event.listen(Session, "after_soft_rollback", _after_rollback)